@@ -16,7 +16,7 @@ from feabas import config, dal, logging, storage
 from feabas.mesh import Mesh, transform_mesh
 from feabas.concurrent import submit_to_workers, REMOTE_FRAMEWORKS, is_daemon_process
 from feabas.spatial import scale_coordinates
-from feabas.matcher import section_matcher
+from feabas.matcher import section_matcher, section_matcher_coroutine, BatchedXcorrEngine
 from feabas.optimizer import SLM
 import feabas.constant as const
 from feabas.common import str_to_numpy_ascii, Match, rearrange_section_order, parse_json_file, numpy_array
@@ -44,7 +44,7 @@ def read_matches_from_h5(match_name, target_resolution=None):
     return Match(xy0, xy1, weight, strain)
 
 
-def match_section_from_initial_matches(match_name, meshes, loaders, out_dir, conf=None, ignore_initial_match=False):
+def match_section_from_initial_matches(match_name, meshes, loaders, out_dir, conf=None, ignore_initial_match=False, **kwargs):
     """
     given the coarse matches saved in H5 format, caculate the fine matches.
     Args:
@@ -59,19 +59,94 @@ def match_section_from_initial_matches(match_name, meshes, loaders, out_dir, con
         out_dir(str): output directory to save the results.
         conf: the alignment configurations. Could be the path to a YAML config
             file or a dictionary containing the settings.
+    Kwargs:
+        logger: the logger to report the loader metrics to.
     """
-    outname = storage.join_paths(out_dir, os.path.basename(match_name))
-    if storage.file_exists(outname):
+    logger_info = kwargs.get('logger', None)
+    task = _section_matching_task(match_name, meshes, loaders, out_dir, conf=conf, ignore_initial_match=ignore_initial_match)
+    if task is None:
         return None
+    xy0, xy1, weight, strain = section_matcher(*task['args'], **task['kwargs'])
+    _report_loader_metrics(task, logger_info)
+    return _save_section_matches(task, xy0, xy1, weight, strain)
+
+
+def match_section_list_from_initial_matches(tasks, out_dir, conf=None, **kwargs):
+    """
+    match multiple section pairs in the same process, with the template matching
+    blocks of different pairs batched together by matcher.BatchedXcorrEngine.
+    Args:
+        tasks(list): list of (match_name, meshes, loaders, ignore_initial_match)
+            tuples. See match_section_from_initial_matches for the definition
+            of each field.
+        out_dir(str): output directory to save the results.
+        conf: the alignment configurations.
+    Kwargs:
+        max_active(int): number of section pairs to match at the same time.
+            The blocks of a pair are only pooled when matched in this process,
+            so if max_active > 1, each pair is matched with a single worker
+            regardless of matcher_config.num_workers. To use multiple cores,
+            distribute the pairs over multiple processes instead.
+        memory_budget(float): estimated memory limit of each FFT batch in MiB.
+        pad_tolerance(float): maximum FFT size ratio between the padded blocks
+            and the original blocks when pooling blocks of different shapes.
+        logger: the logger to report the loader metrics to.
+    Yields:
+        (match_name, num_matches): number of matches is None if the output
+            already exists.
+    """
+    max_active = kwargs.get('max_active', 1)
+    memory_budget = kwargs.get('memory_budget', 2048)
+    pad_tolerance = kwargs.get('pad_tolerance', 1.5)
+    logger_info = kwargs.get('logger', None)
+    conf = _matching_config(conf)
+    if max_active > 1:
+        conf = conf.copy()
+        conf['matcher_config'] = conf.get('matcher_config', {}).copy()
+        conf['matcher_config']['num_workers'] = 1
+    engine = BatchedXcorrEngine(max_active=max_active, memory_budget=memory_budget, pad_tolerance=pad_tolerance)
+    task_list = []
+    def _coroutines():
+        for match_name, meshes, loaders, ignore_initial_match in tasks:
+            task = _section_matching_task(match_name, meshes, loaders, out_dir, conf=conf, ignore_initial_match=ignore_initial_match)
+            task_list.append((match_name, task))
+            if task is None:
+                yield _empty_coroutine()
+            else:
+                yield section_matcher_coroutine(*task['args'], **task['kwargs'])
+    for k, res in engine.run(_coroutines()):
+        match_name, task = task_list[k]
+        task_list[k] = None
+        if task is None:
+            yield match_name, None
+        else:
+            _report_loader_metrics(task, logger_info)
+            yield match_name, _save_section_matches(task, *res)
+
+
+def _empty_coroutine():
+    return None
+    yield
+
+
+def _matching_config(conf):
     if isinstance(conf, str) and conf.lower().endswith('.yaml'):
         with storage.File(conf, 'r') as f:
             conf = yaml.safe_load(f)
-    if 'matching' in conf:
-        conf = conf['matching']
-    elif conf is None:
+    if conf is None:
         conf = {}
     elif not isinstance(conf, dict):
         raise TypeError('configuration type not supported.')
+    elif 'matching' in conf:
+        conf = conf['matching']
+    return conf
+
+
+def _section_matching_task(match_name, meshes, loaders, out_dir, conf=None, ignore_initial_match=False):
+    outname = storage.join_paths(out_dir, os.path.basename(match_name))
+    if storage.file_exists(outname):
+        return None
+    conf = _matching_config(conf)
     match_name_delimiter = conf.get('match_name_delimiter', '__to__')
     working_mip_level = conf.get('working_mip_level', 0)
     resolution = config.montage_resolution() * (2 ** working_mip_level)
@@ -126,8 +201,24 @@ def match_section_from_initial_matches(match_name, meshes, loaders, out_dir, con
         initial_matches = None
     else:
         initial_matches = read_matches_from_h5(match_name, target_resolution=resolution)
-    xy0, xy1, weight, strain = section_matcher(mesh0, mesh1, loader0, loader1,
-        initial_matches=initial_matches, **matcher_config)
+    matcher_config['initial_matches'] = initial_matches
+    task = {'args': (mesh0, mesh1, loader0, loader1), 'kwargs': matcher_config,
+            'outname': outname, 'resolution': resolution, 'secnames': secnames}
+    return task
+
+
+def _report_loader_metrics(task, logger_info):
+    metrics = defaultdict(float)
+    for loader in task['args'][2:]:
+        if not hasattr(loader, 'metrics'):
+            continue
+        for key, val in loader.metrics().items():
+            metrics[key] += val
+    logging.report_metrics(logging.get_logger(logger_info), metrics)
+
+
+def _save_section_matches(task, xy0, xy1, weight, strain):
+    outname, resolution, secnames = task['outname'], task['resolution'], task['secnames']
     if xy0 is None:
         return 0
     else:
@@ -542,6 +633,7 @@ class Stack:
         worker_settings = kwargs.get('worker_settings', {}).copy()
         ensure_continuous = kwargs.pop('ensure_continuous', False) # ensure all sections are connected or linked to a reference section, otherwise align the largest bunch
         no_slide = kwargs.get('no_slide', False)    # align only small segments of the stack that can be done in one shot and don't require window to slide
+        concurrent_windows = kwargs.pop('concurrent_windows', False) # optimize multiple independent windows in parallel, then fill the gaps between them
         if kwargs.get('logger', None) is not None:
             self._logger = kwargs['logger']
         else:
@@ -620,6 +712,30 @@ class Stack:
                 else:
                     if no_slide:
                         break
+                    if concurrent_windows and (num_workers > 1):
+                        window_indices = self._independent_windows(to_optimize, window_size+buffer_size, num_workers)
+                    else:
+                        window_indices = []
+                    if len(window_indices) > 1:
+                        flag_opt = np.zeros_like(to_optimize)
+                        for indx_opt in window_indices:
+                            flag_opt[indx_opt] = True
+                        indx_cmt = self._committed_window_indices(flag_opt, to_optimize, buffer_size)
+                        seclist_cmt = [self.section_list[s] for s in indx_cmt]
+                        args_list = []
+                        for indx_opt in window_indices:
+                            seclist = self.pad_section_list_w_refs(section_list=[self.section_list[s] for s in indx_opt])
+                            args_list.append((self.init_dict(secnames=seclist, check_lock=True),))
+                        for reslt in submit_to_workers(Stack.subprocess_optimize_stack, args=args_list, kwargs=[kwargs], num_workers=num_workers, **worker_settings):
+                            snms, res = reslt
+                            updated_sections.extend(snms)
+                            residues.update(res)
+                            for sn in snms:
+                                self._mesh_cache.pop(sn, None)
+                        self._mesh_versions = None
+                        self.update_lock_flags({s: True for s in seclist_cmt})
+                        to_optimize = ~self.locked_array
+                        continue
                     seeding = to_optimize
                     if np.all(seeding):
                         seeding = seeding.copy()
@@ -644,14 +760,7 @@ class Stack:
                     else:
                         flag_opt = np.zeros_like(to_optimize)
                         flag_opt[indx_opt] = True
-                        flag_fut = to_optimize & (~flag_opt)
-                        dis_e = distance_transform_cdt(~flag_fut).clip(0, None)
-                        dis_t = -np.ones_like(dis_e, dtype=np.float32)
-                        lbl_opt = np.cumsum(np.diff(flag_opt, prepend=0).clip(0, None)) * flag_opt
-                        for lbl in range(1, np.max(lbl_opt)+1):
-                            idxt = lbl_opt == lbl
-                            dis_t[idxt] = min(np.max(dis_e[idxt]) / 2, buffer_size)
-                        indx_cmt = np.nonzero((dis_e > dis_t) & flag_opt)[0]
+                        indx_cmt = self._committed_window_indices(flag_opt, to_optimize, buffer_size)
                         seclist_cmt = [self.section_list[s] for s in indx_cmt]
                     seclist = self.pad_section_list_w_refs(section_list=seclist_opt)
                     if sent_to_remote:
@@ -675,6 +784,50 @@ class Stack:
         return updated_sections, residues
 
 
+    def _independent_windows(self, to_optimize, window_len, max_windows):
+        """
+        place windows evenly over the sections to optimize, so that no match
+        links sections from two different windows and the windows can be
+        optimized independently.
+        Args:
+            to_optimize(ndarray): flags of the sections to optimize.
+            window_len: number of sections to optimize in each window.
+            max_windows: maximum number of windows.
+        Return:
+            list of section index arrays, one for each window. Fewer than two
+            windows means the sections can't be divided.
+        """
+        free_indx = np.nonzero(to_optimize)[0]
+        A = self.section_connection_matrix.tocoo()
+        if A.nnz == 0:
+            span = 1
+        else:
+            span = int(np.max(np.abs(A.row.astype(np.int64) - A.col.astype(np.int64))))
+        gap = span + 1 # allow one section lost to rounding the window locations
+        Nfree = free_indx.size
+        num_windows = min(max_windows, (Nfree + gap) // (window_len + gap))
+        if num_windows < 2:
+            return []
+        starts = np.round(np.linspace(0, Nfree - window_len, num=num_windows)).astype(np.int64)
+        return [free_indx[s:(s+window_len)] for s in starts]
+
+
+    @staticmethod
+    def _committed_window_indices(flag_opt, to_optimize, buffer_size):
+        """
+        indices of the optimized sections that are far enough from the
+        sections still to be optimized to be committed.
+        """
+        flag_fut = to_optimize & (~flag_opt)
+        dis_e = distance_transform_cdt(~flag_fut).clip(0, None)
+        dis_t = -np.ones_like(dis_e, dtype=np.float32)
+        lbl_opt = np.cumsum(np.diff(flag_opt, prepend=0).clip(0, None)) * flag_opt
+        for lbl in range(1, np.max(lbl_opt)+1):
+            idxt = lbl_opt == lbl
+            dis_t[idxt] = min(np.max(dis_e[idxt]) / 2, buffer_size)
+        return np.nonzero((dis_e > dis_t) & flag_opt)[0]
+
+
     def optimize_section_list(self, section_list, **kwargs):
         target_gear = kwargs.get('target_gear', const.MESH_GEAR_MOVING)
         optimize_rigid = kwargs.get('optimize_rigid', True)
@@ -693,7 +846,8 @@ class Stack:
         if len(section_list) == 0:
             logger.info('no section to optimize.')
             return residue
-        optm = self.initialize_SLM(section_list)
+        matrix_free_crosslinks = elastic_params.pop('matrix_free_crosslinks', False)
+        optm = self.initialize_SLM(section_list, matrix_free_crosslinks=matrix_free_crosslinks)
         if len(optm.meshes) == 0:
             logger.info(f'{section_list[0]} -> {section_list[-1]}: all sections settled.')
             return residue
@@ -1634,4 +1788,4 @@ class Aligner():
                 f.create_dataset('name0', data=str_to_numpy_ascii(chnknames[0]))
                 f.create_dataset('name1', data=str_to_numpy_ascii(chnknames[1]))
             updated = np.sum(WTS)
-        return {outname: updated}
\ No newline at end of file
+        return {outname: updated}
\ No newline at end of file
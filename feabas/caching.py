@@ -1,23 +1,42 @@
 import collections
+from functools import lru_cache, wraps
 import gc
+import hashlib
+import os
 import sys
+import threading
+import time
 
 import numpy as np
 
+
 def getsizeof(data):
-    if isinstance(data, np.ndarray):
-        bt = sys.getsizeof(data) / (1024**2)
-    elif isinstance(data, (list, tuple)):
-        bt = 0.0
-        for d in data:
-            bt += getsizeof(d)
+    """
+    memory footprint of data in MiB. Arrays (numpy, memory-maps, tensorstore
+    etc.) are charged by the size of their elements, so that views are not
+    mistaken for empty objects.
+    """
+    return _nbytes(data) / (1024**2)
+
+
+def _nbytes(data):
+    if isinstance(data, (list, tuple)):
+        return sum(_nbytes(d) for d in data)
     elif isinstance(data, dict):
-        bt = 0.0
-        for d in data.values():
-            bt += getsizeof(d)
-    else:
-        bt = sys.getsizeof(data, default=0) / (1024**2)
-    return bt
+        return sum(_nbytes(d) for d in data.values())
+    nbytes = getattr(data, 'nbytes', None)
+    if isinstance(nbytes, (int, np.integer)):
+        return int(nbytes)
+    shape = getattr(data, 'shape', None)
+    dtype = getattr(data, 'dtype', None)
+    if (shape is not None) and (dtype is not None):
+        try:
+            # e.g. tensorstore.TensorStore, whose dtype wraps a numpy dtype
+            itemsize = np.dtype(getattr(dtype, 'numpy_dtype', dtype)).itemsize
+            return int(np.prod(shape)) * itemsize
+        except TypeError:
+            pass
+    return sys.getsizeof(data, 0)
 
 
 class Node:
@@ -162,18 +181,78 @@ class DoublyLinkedList:
 
 
 
+
+
+def _synchronized(func):
+    """serialize the calls to a cache method with the lock of the cache."""
+    @wraps(func)
+    def wrapped(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapped
+
+
 class CacheNull:
     """
     Cache class with no capacity. Mostlys to define Cache APIs.
+    The methods that read or modify the bookkeeping (listed in _SYNCHRONIZED)
+    are guarded by a reentrant lock, also in the subclasses, so that a cache
+    can be shared by the threads of one process (e.g. the concurrent reads in
+    common.render_by_subregions). Iteration is not guarded.
     Attributes:
         _maxlen: the maximum capacity of the cache. No upper limit if set to None.
+        _maxbytes: the maximum size of the cache in MiB. No upper limit if set to None.
+        _bytes(dict): the size of each cached item in bytes.
+        _nbytes_total: running total of the sizes of the cached items in bytes.
+        _stats(Counter): access statistics. see stats.
+        _lock(RLock): lock guarding the cache operations.
     """
+    _SYNCHRONIZED = ('clear', 'item_accessed', '__contains__', '__getitem__',
+                     '__setitem__', 'get', 'update_item', '_evict_item_by_key',
+                     'trim')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls._SYNCHRONIZED:
+            if name in cls.__dict__:
+                setattr(cls, name, _synchronized(cls.__dict__[name]))
+
     def __init__(self, maxlen=0, maxbytes=None):
         self._maxlen = maxlen
         self._maxbytes = maxbytes
+        self._bytes = {}
+        self._nbytes_total = 0
+        self._stats = collections.Counter()
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_lock', None)
+        return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def stats(self):
+        """
+        access statistics since the creation of the cache:
+            hits: number of items served from the cache.
+            misses: number of items added to the cache (each fill follows a miss).
+            evictions: number of items evicted by the replacement policy.
+            bytes_cached/bytes_evicted: total bytes added/evicted. Updating an
+                item only adds the change of its size to bytes_cached.
+        """
+        out = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_cached': 0, 'bytes_evicted': 0}
+        out.update(self._stats)
+        return out
+
+    @_synchronized
     def clear(self, instant_gc=False):
         """Clear cache"""
+        self._bytes.clear()
+        self._nbytes_total = 0
         if instant_gc:
             gc.collect()
 
@@ -196,7 +275,8 @@ class CacheNull:
 
     @property
     def total_bytes(self):
-        return 0
+        """total size of the cached items in MiB"""
+        return self._nbytes_total / (1024**2)
 
     def __setitem__(self, key, data):
         """Cache an item"""
@@ -218,25 +298,41 @@ class CacheNull:
         """remove an item by policy specific to the cache type."""
         pass
 
+    def _track_bytes(self, key, nbytes):
+        """record the size (in bytes) of a newly added or updated item"""
+        if key not in self._bytes:
+            self._stats['misses'] += 1
+        delta = nbytes - self._bytes.get(key, 0)
+        self._stats['bytes_cached'] += delta
+        self._nbytes_total += delta
+        self._bytes[key] = nbytes
+
+    def _untrack_bytes(self, key):
+        self._nbytes_total -= self._bytes.pop(key, 0)
+
+    def _admissible(self, nbytes):
+        """whether an item of nbytes fits in the cache at all"""
+        return (self._maxbytes is None) or (nbytes < self._maxbytes * (1024**2))
+
+    def _over_capacity(self):
+        if (self._maxlen is not None) and (len(self) > self._maxlen):
+            return True
+        if (self._maxbytes is not None) and (self._nbytes_total > self._maxbytes * (1024**2)):
+            return True
+        return False
+
+    @_synchronized
     def trim(self):
-        """remove items so that the data does not exceed its capacity"""
-        if len(self) == 0:
-            return
-        trimmed = False
-        if self._maxlen is not None:
-            while len(self) >= self._maxlen:
-                if len(self) == 0:
-                    break
-                self._evict_item_by_policy()
-                trimmed = True
-        if self._maxbytes is not None:
-            while  self.total_bytes >= self._maxbytes:
-                if len(self) == 0:
-                    break
-                self._evict_item_by_policy()
-                trimmed = True
-        if trimmed:
-            gc.collect()
+        """
+        remove items so that the data does not exceed its capacity. The evicted
+        data are released by reference counting, no garbage collection is
+        forced here.
+        """
+        while (len(self) > 0) and self._over_capacity():
+            nbytes = self._nbytes_total
+            self._evict_item_by_policy()
+            self._stats['evictions'] += 1
+            self._stats['bytes_evicted'] += nbytes - self._nbytes_total
 
 
 class CacheFIFO(CacheNull):
@@ -245,183 +341,97 @@ class CacheFIFO(CacheNull):
     """
     def __init__(self, maxlen=None, maxbytes=None):
         super().__init__(maxlen=maxlen, maxbytes=maxbytes)
-        self._keys = collections.deque(maxlen=maxlen)
-        self._vals = collections.deque(maxlen=maxlen)
-        self._bytes = collections.deque(maxlen=maxlen)
+        self._cached_data = collections.OrderedDict()   # first in first
 
 
     def clear(self, instant_gc=False):
-        self._keys.clear()
-        self._vals.clear()
-        self._bytes.clear()
-        if instant_gc:
-            gc.collect()
+        self._cached_data.clear()
+        super().clear(instant_gc=instant_gc)
 
 
     def __contains__(self, key):
-        return key in self._keys
+        return key in self._cached_data
 
 
     def __getitem__(self, key):
-        if key in self._keys:
-            indx = self._keys.index(key)
-            return self._vals[indx]
+        if key in self._cached_data:
+            self._stats['hits'] += 1
+            return self._cached_data[key]
         else:
             errmsg = "fail to access data with key {} from cached.".format(key)
             raise KeyError(errmsg)
 
 
     def __len__(self):
-        return len(self._keys)
-
-
-    @property
-    def total_bytes(self):
-        return np.sum(self._bytes)
+        return len(self._cached_data)
 
 
     def __setitem__(self, key, data):
-        if (self._maxlen) == 0 or (key in self._keys):
+        if (self._maxlen) == 0 or (key in self._cached_data):
             return
-        dtsz = getsizeof(data)
-        if (self._maxbytes is None) or (dtsz < self._maxbytes):
-            self._keys.append(key)
-            self._vals.append(data)
-            self._bytes.append(dtsz)
+        dtsz = _nbytes(data)
+        if self._admissible(dtsz):
+            self._cached_data[key] = data
+            self._track_bytes(key, dtsz)
         self.trim()
 
 
     def __iter__(self):
-        for key in self._keys:
+        for key in self._cached_data:
             yield key
 
 
     def update_item(self, key, data):
         if (self._maxlen) == 0:
             return
-        if key in self._keys:
-            indx = self._keys.index(key)
-            self._vals[indx] = data
-            self._bytes[indx] = getsizeof(data)
+        if key in self._cached_data:
+            self._cached_data[key] = data
+            self._track_bytes(key, _nbytes(data))
             self.trim()
         else:
             self.__setitem__(key, data)
 
 
     def _evict_item_by_key(self, key):
-        if (self._maxlen) == 0:
-            return
-        if key in self._keys:
-            indx = self._keys.index(key)
-            del self._vals[indx]
-            del self._keys[indx]
-            del self._bytes[indx]
+        if key in self._cached_data:
+            del self._cached_data[key]
+            self._untrack_bytes(key)
 
 
     def _evict_item_by_policy(self):
-        self._keys.popleft()
-        self._vals.popleft()
-        self._bytes.popleft()
+        key, _ = self._cached_data.popitem(last=False)
+        self._untrack_bytes(key)
 
 
 
-class CacheLRU(CacheNull):
+class CacheLRU(CacheFIFO):
     """
     Cache with least recently used (LRU) replacement policy
     """
-    def __init__(self, maxlen=None, maxbytes=None):
-        super().__init__(maxlen=maxlen, maxbytes=maxbytes)
-        self._cached_nodes = {}
-        self._cache_list = DoublyLinkedList() # head:old <-> tail:new
-        self._bytes = {}
-
-
-    def clear(self, instant_gc=False):
-        self._cached_nodes.clear()
-        self._cache_list.clear()
-        self._bytes.clear()
-        if instant_gc:
-            gc.collect()
-
-
     def item_accessed(self, key_list):
         for key in key_list:
             self._move_item_to_tail(key)
 
 
-    def _evict_item_by_key(self, key):
-        if key in self._cached_nodes:
-            node = self._cached_nodes.pop(key)
-            self._cache_list.remove_node(node)
-            self._bytes.pop(key, 0)
-
-
-    def _evict_item_by_policy(self):
-        node = self._cache_list.head
-        if node is not None:
-            key = node.key
-            self._evict_item_by_key(key)
-
-
     def _move_item_to_tail(self, key):
-        if key in self._cached_nodes:
-            node = self._cached_nodes[key]
-            if node.next is None:
-                return
-            node = self._cache_list.pop_node(node)
-            self._cache_list.insert_tail(node)
-
-
-    def __contains__(self, key):
-        return key in self._cached_nodes
+        if key in self._cached_data:
+            self._cached_data.move_to_end(key)
 
 
     def __getitem__(self, key):
-        if key in self._cached_nodes:
-            node = self._cached_nodes[key]
-            self._move_item_to_tail(key)
-            return node.data
+        if key in self._cached_data:
+            self._stats['hits'] += 1
+            self._cached_data.move_to_end(key)
+            return self._cached_data[key]
         else:
             errmsg = "fail to access data with key {} from cached.".format(key)
             raise KeyError(errmsg)
 
 
-    def __len__(self):
-        return len(self._cached_nodes)
-
-
-    @property
-    def total_bytes(self):
-        return np.sum(list(self._bytes.values()))
-
-
     def __setitem__(self, key, data):
-        if (self._maxlen == 0) or (self._maxbytes == 0) or (key in self._cached_nodes):
-            return
-        dtsz = getsizeof(data)
-        if (self._maxbytes is None) or (dtsz < self._maxbytes):
-            data_node = Node(key, data)
-            self._cache_list.insert_tail(data_node)
-            self._cached_nodes[key] = data_node
-            self._bytes[key] = dtsz
-        self.trim()
-
-
-    def __iter__(self):
-        for key in self._cached_nodes:
-            yield key
-
-
-    def update_item(self, key, data):
-        if self._maxlen == 0:
+        if self._maxbytes == 0:
             return
-        if key in self._cached_nodes:
-            data_node = self._cached_nodes[key]
-            data_node.modify_data(data)
-            self._bytes[key] = getsizeof(data)
-            self.trim()
-        else:
-            self.__setitem__(key, data)
+        super().__setitem__(key, data)
 
 
 
@@ -439,7 +449,6 @@ class CacheLFU(CacheNull):
         super().__init__(maxlen=maxlen, maxbytes=maxbytes)
         self._cached_nodes = {}
         self._freq_list = DoublyLinkedList()
-        self._bytes = {}
 
 
     def clear(self, instant_gc=False):
@@ -447,9 +456,7 @@ class CacheLFU(CacheNull):
         for key in cached_keys:
             self._evict_item_by_key(key)
         self._freq_list.clear()
-        self._bytes.clear()
-        if instant_gc:
-            gc.collect()
+        super().clear(instant_gc=instant_gc)
 
 
     def item_accessed(self, key_list):
@@ -463,7 +470,7 @@ class CacheLFU(CacheNull):
             freq_node = node.pointer
             cache_list = freq_node.pointer
             cache_list.remove_node(node)
-            self._bytes.pop(key, 0)
+            self._untrack_bytes(key)
             if (len(cache_list) == 0) and (freq_node.data != 0):
                 self._freq_list.remove_node(freq_node)
 
@@ -508,6 +515,7 @@ class CacheLFU(CacheNull):
 
     def __getitem__(self, key):
         if key in self._cached_nodes:
+            self._stats['hits'] += 1
             node = self._cached_nodes[key]
             self._increase_item_access_number_by_one(key)
             return node.data
@@ -520,26 +528,21 @@ class CacheLFU(CacheNull):
         return len(self._cached_nodes)
 
 
-    @property
-    def total_bytes(self):
-        return np.sum(list(self._bytes.values()))
-
-
     def __setitem__(self, key, data):
         if (self._maxlen == 0) or (self._maxbytes == 0) or (key in self._cached_nodes):
             return
         if (self._freq_list.head is None) or (self._freq_list.head.data != 0):
             self._freq_list.insert_head((None, 0))
             self._freq_list.head.pointer = DoublyLinkedList()
-        dtsz = getsizeof(data)
-        if (self._maxbytes is None) or (dtsz < self._maxbytes):
+        dtsz = _nbytes(data)
+        if self._admissible(dtsz):
             data_node = Node(key, data)
             freq_node = self._freq_list.head
             data_node.pointer = freq_node
             cache_list = freq_node.pointer
             cache_list.insert_tail(data_node)
             self._cached_nodes[key] = data_node
-            self._bytes[key] = dtsz
+            self._track_bytes(key, dtsz)
         self.trim()
 
 
@@ -554,7 +557,7 @@ class CacheLFU(CacheNull):
         if key in self._cached_nodes:
             data_node = self._cached_nodes[key]
             data_node.modify_data(data)
-            self._bytes[key] = getsizeof(data)
+            self._track_bytes(key, _nbytes(data))
             self.trim()
         else:
             self.__setitem__(key, data)
@@ -580,7 +583,385 @@ class CacheMFU(CacheLFU):
                 freq_node = freq_node.prev
 
 
+class CacheARC(CacheNull):
+    """
+    Cache with adaptive replacement cache (ARC) policy (Megiddo & Modha 2003).
+    Items seen once recently live in T1, items seen at least twice in T2. The
+    target size p of T1 adapts to the workload using the ghost lists B1/B2
+    that remember the keys recently evicted from T1/T2: a miss on a key in B1
+    means T1 was too small, a miss in B2 means T2 was too small. This makes it
+    scan resistant: a sweep through new images only churns T1 and does not
+    flush the images reused by neighboring reads from T2.
+    When only maxbytes is set, the ghost lists are bounded by the current
+    number of cached items.
+    """
+    def __init__(self, maxlen=None, maxbytes=None):
+        super().__init__(maxlen=maxlen, maxbytes=maxbytes)
+        self._t1 = collections.OrderedDict()    # oldest first
+        self._t2 = collections.OrderedDict()
+        self._b1 = collections.OrderedDict()    # ghost keys, values unused
+        self._b2 = collections.OrderedDict()
+        self._p = 0.0
+
+
+    def clear(self, instant_gc=False):
+        self._t1.clear()
+        self._t2.clear()
+        self._b1.clear()
+        self._b2.clear()
+        self._p = 0.0
+        super().clear(instant_gc=instant_gc)
+
+
+    def _capacity(self):
+        if self._maxlen is not None:
+            return self._maxlen
+        return max(1, len(self))
+
+
+    def item_accessed(self, key_list):
+        for key in key_list:
+            self._promote(key)
+
+
+    def _promote(self, key):
+        if key in self._t1:
+            self._t2[key] = self._t1.pop(key)
+        elif key in self._t2:
+            self._t2.move_to_end(key)
+
+
+    def __contains__(self, key):
+        return (key in self._t1) or (key in self._t2)
+
+
+    def __getitem__(self, key):
+        if key in self:
+            self._stats['hits'] += 1
+            self._promote(key)
+            return self._t2[key]
+        else:
+            errmsg = "fail to access data with key {} from cached.".format(key)
+            raise KeyError(errmsg)
+
+
+    def __len__(self):
+        return len(self._t1) + len(self._t2)
+
+
+    def __setitem__(self, key, data):
+        if (self._maxlen == 0) or (self._maxbytes == 0) or (key in self):
+            return
+        dtsz = _nbytes(data)
+        if self._admissible(dtsz):
+            c = self._capacity()
+            if key in self._b1:
+                self._p = min(c, self._p + max(1.0, len(self._b2) / len(self._b1)))
+                del self._b1[key]
+                self._t2[key] = data
+            elif key in self._b2:
+                self._p = max(0.0, self._p - max(1.0, len(self._b1) / len(self._b2)))
+                del self._b2[key]
+                self._t2[key] = data
+            else:
+                self._t1[key] = data
+            self._track_bytes(key, dtsz)
+        self.trim()
+        self._trim_ghosts()
+
+
+    def __iter__(self):
+        yield from self._t1
+        yield from self._t2
+
+
+    def update_item(self, key, data):
+        if self._maxlen == 0:
+            return
+        if key in self._t1:
+            self._t1[key] = data
+        elif key in self._t2:
+            self._t2[key] = data
+        else:
+            self.__setitem__(key, data)
+            return
+        self._track_bytes(key, _nbytes(data))
+        self.trim()
+        self._trim_ghosts()
+
+
+    def _evict_item_by_key(self, key):
+        if key in self._t1:
+            del self._t1[key]
+        elif key in self._t2:
+            del self._t2[key]
+        else:
+            return
+        self._untrack_bytes(key)
+
+
+    def _evict_item_by_policy(self):
+        if (len(self._t1) > 0) and ((len(self._t1) > self._p) or (len(self._t2) == 0)):
+            key, _ = self._t1.popitem(last=False)
+            self._b1[key] = None
+        else:
+            key, _ = self._t2.popitem(last=False)
+            self._b2[key] = None
+        self._untrack_bytes(key)
+
+
+    def _trim_ghosts(self):
+        c = self._capacity()
+        while (len(self._b1) > 0) and (len(self._t1) + len(self._b1) > c):
+            self._b1.popitem(last=False)
+        while (len(self._b2) > 0) and (len(self) + len(self._b1) + len(self._b2) > 2 * c):
+            self._b2.popitem(last=False)
+
+
+
+class CacheTraceRecorder(CacheNull):
+    """
+    Wrapper of a cache that records the keys looked up, for replaying the
+    access pattern with different policies (see tools/benchmark_cache_policies.py).
+    Each lookup of a key (the membership test that precedes every access) is
+    appended as one line to the trace file; consecutive lookups of the same
+    key count as one access.
+    Args:
+        cache(CacheNull): the cache to wrap.
+        filename(str): the trace file to append to.
+    """
+    def __init__(self, cache, filename, buffer_size=1024):
+        super().__init__(maxlen=cache._maxlen, maxbytes=cache._maxbytes)
+        self._cache = cache
+        self._filename = filename
+        self._buffer = []
+        self._buffer_size = buffer_size
+        self._last_key = None
+
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            with open(self._filename, 'a') as f:
+                f.write(''.join(self._buffer))
+            self._buffer = []
+
+
+    def __del__(self):
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+
+    def clear(self, instant_gc=False):
+        self._cache.clear(instant_gc=instant_gc)
+
+
+    def item_accessed(self, key_list):
+        self._cache.item_accessed(key_list)
+
+
+    def __contains__(self, key):
+        if key != self._last_key:
+            self._last_key = key
+            self._buffer.append(str(key).replace('\n', ' ') + '\n')
+            if len(self._buffer) >= self._buffer_size:
+                self.flush()
+        return key in self._cache
+
+
+    def __getitem__(self, key):
+        return self._cache[key]
+
+
+    def __len__(self):
+        return len(self._cache)
+
+
+    @property
+    def total_bytes(self):
+        return self._cache.total_bytes
+
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+
+    def __setitem__(self, key, data):
+        self._cache[key] = data
+
+
+    def __iter__(self):
+        yield from self._cache
+
+
+    def update_item(self, key, data):
+        self._cache.update_item(key, data)
+
+
+    def _evict_item_by_key(self, key):
+        self._cache._evict_item_by_key(key)
+
+
+    def trim(self):
+        self._cache.trim()
+
+
+class CacheDisk(CacheNull):
+    """
+    Persistent cache of numpy arrays on the local disk, shared by all the
+    processes on the same node. Each item is saved as a .npy file and loaded
+    back as a copy-on-write memory-map, so the pages are shared between
+    processes and read lazily. Least recently used items (by file modification
+    time, updated on access) are evicted when exceeding the capacity. Writes
+    are atomic so concurrent readers either miss or see the complete file.
+    Args:
+        cache_dir(str): local directory to save the cached arrays.
+    Kwargs:
+        maxlen: maximum number of items. No limit if None.
+        maxbytes: capacity in MiB. No limit if None.
+        check_interval: number of writes in between rescanning the folder to
+            account for the items added by other processes.
+    """
+    SUFFIX = '.npy'
+
+    def __init__(self, cache_dir, maxlen=None, maxbytes=None, check_interval=64):
+        super().__init__(maxlen=maxlen, maxbytes=maxbytes)
+        self._cache_dir = cache_dir
+        self._check_interval = check_interval
+        os.makedirs(cache_dir, exist_ok=True)
+        self._rescan()
+
+    def _rescan(self):
+        entries = []
+        for f in os.scandir(self._cache_dir):
+            if not f.name.endswith(self.SUFFIX):
+                continue
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f.path))
+        self._num_items = len(entries)
+        self._nbytes = sum(e[1] for e in entries) / (1024**2)
+        self._write_count = 0
+        return entries
+
+    def _filename(self, key):
+        hashkey = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, hashkey + self.SUFFIX)
+
+    def clear(self, instant_gc=False):
+        for f in os.scandir(self._cache_dir):
+            if f.name.endswith(self.SUFFIX):
+                try:
+                    os.remove(f.path)
+                except OSError:
+                    pass
+        self._rescan()
+        super().clear(instant_gc)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._filename(key))
+
+    def __getitem__(self, key):
+        fname = self._filename(key)
+        try:
+            data = np.load(fname, mmap_mode='c', allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            self._stats['misses'] += 1
+            raise KeyError(key)
+        self._stats['hits'] += 1
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+        return data
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return self._num_items
+
+    @property
+    def total_bytes(self):
+        return self._nbytes
+
+    def __setitem__(self, key, data):
+        data = np.asarray(data)
+        if data.dtype.hasobject:
+            return
+        fname = self._filename(key)
+        tmpname = fname + f'.{os.getpid()}_{time.monotonic_ns()}.tmp'
+        try:
+            with open(tmpname, 'wb') as f:
+                np.save(f, data, allow_pickle=False)
+            os.replace(tmpname, fname)
+        except OSError:
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+            return
+        self._num_items += 1
+        self._nbytes += os.path.getsize(fname) / (1024**2)
+        self._stats['bytes_cached'] += os.path.getsize(fname)
+        self._write_count += 1
+        if self._write_count >= self._check_interval:
+            self._rescan()
+        self.trim()
+
+    def update_item(self, key, data):
+        self[key] = data
+
+    def _evict_item_by_key(self, key):
+        fname = self._filename(key)
+        try:
+            sz = os.path.getsize(fname)
+            os.remove(fname)
+        except OSError:
+            return
+        self._num_items -= 1
+        self._nbytes -= sz / (1024**2)
+
+    def trim(self):
+        over_len = (self._maxlen is not None) and (self._num_items > self._maxlen)
+        over_bytes = (self._maxbytes is not None) and (self._nbytes > self._maxbytes)
+        if not (over_len or over_bytes):
+            return
+        entries = sorted(self._rescan())
+        # evict down to 90% of the capacity to avoid trimming at every write
+        for _, sz, fname in entries:
+            over_len = (self._maxlen is not None) and (self._num_items > 0.9 * self._maxlen)
+            over_bytes = (self._maxbytes is not None) and (self._nbytes > 0.9 * self._maxbytes)
+            if not (over_len or over_bytes):
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue    # removed by other processes, or still mapped on Windows
+            self._num_items -= 1
+            self._nbytes -= sz / (1024**2)
+            self._stats['evictions'] += 1
+            self._stats['bytes_evicted'] += sz
+
+
+@lru_cache(maxsize=None)
+def get_disk_cache(cache_dir, maxbytes=None, maxlen=None):
+    """shared CacheDisk instance of each cache directory in the process."""
+    return CacheDisk(cache_dir, maxlen=maxlen, maxbytes=maxbytes)
+
+
 def generate_cache(cache_type='fifo', maxlen=None, maxbytes=None):
+    """
+    Args:
+        cache_type(str): replacement policy. none/fifo/lru/lfu/mfu/arc.
+        maxlen(int): maximum number of items. No limit if None.
+        maxbytes(float): capacity in MiB. No limit if None.
+    """
     if (maxlen == 0) or (maxbytes == 0) or (cache_type.lower() == 'none'):
         return CacheNull()
     elif cache_type.lower() == 'fifo':
@@ -591,6 +972,8 @@ def generate_cache(cache_type='fifo', maxlen=None, maxbytes=None):
         return CacheLFU(maxlen=maxlen, maxbytes=maxbytes)
     elif cache_type.lower() == 'mfu':
         return CacheMFU(maxlen=maxlen, maxbytes=maxbytes)
+    elif cache_type.lower() == 'arc':
+        return CacheARC(maxlen=maxlen, maxbytes=maxbytes)
     else:
         errmsg = 'cache type {} not implemented'.format(cache_type)
         raise NotImplementedError(errmsg)
@@ -1,4 +1,4 @@
-from collections import namedtuple
+from collections import deque, namedtuple
 import cv2
 import importlib
 import json
@@ -253,17 +253,69 @@ def remap(image, map_x, map_y, **kwargs):
         return imgt.reshape(out_sz)
 
 
+def _plan_source_windows(map_x, map_y, mask, window_size, tile_grid=None):
+    """
+    bin the output pixels to render by the source window they sample from.
+    Args:
+        map_x, map_y (ndarray): source coordinates of the output pixels.
+        mask (ndarray): output pixels to render.
+        window_size (tuple): maximum (height, width) of a source window.
+    Kwargs:
+        tile_grid (tuple): (x0, y0, width, height) of the source tile grid. If
+            given, the windows are aligned to the grid.
+    Return:
+        list of (flat indices of the output pixels, source bounding box)
+    """
+    indx = np.flatnonzero(mask)
+    if indx.size == 0:
+        return []
+    mx = map_x.ravel()[indx]
+    my = map_y.ravel()[indx]
+    xmin, xmax = mx.min(), mx.max()
+    ymin, ymax = my.min(), my.max()
+    if ((xmax - xmin) < window_size[-1]) and ((ymax - ymin) < window_size[0]):
+        return [(indx, (xmin, ymin, xmax, ymax))]
+    if tile_grid is None:
+        x0, y0, wd, ht = xmin, ymin, window_size[-1], window_size[0]
+    else:
+        x0, y0 = tile_grid[0], tile_grid[1]
+        wd, ht = min(tile_grid[2], window_size[-1]), min(tile_grid[3], window_size[0])
+    wx = np.floor((mx - x0) / wd).astype(np.int64)
+    wy = np.floor((my - y0) / ht).astype(np.int64)
+    wx -= wx.min()
+    wy -= wy.min()
+    wid = wy * (wx.max() + 1) + wx
+    srt = np.argsort(wid, kind='stable')
+    wid = wid[srt]
+    stt = np.concatenate(([0], np.flatnonzero(np.diff(wid)) + 1))
+    indx, mx, my = indx[srt], mx[srt], my[srt]
+    bxmin, bxmax = np.minimum.reduceat(mx, stt), np.maximum.reduceat(mx, stt)
+    bymin, bymax = np.minimum.reduceat(my, stt), np.maximum.reduceat(my, stt)
+    windows = []
+    for k, idx in enumerate(np.split(indx, stt[1:])):
+        windows.append((idx, (bxmin[k], bymin[k], bxmax[k], bymax[k])))
+    return windows
+
+
 def render_by_subregions(map_x, map_y, mask, img_loader, fileid=None,  **kwargs):
     """
     break the render job to small regions in case the target source image is
-    too large to fit in RAM.
+    too large to fit in RAM. The output pixels are binned once by the source
+    window they sample from (aligned to the source tiles when the loader has
+    multiple files), and each window is read with a single crop.
+    Kwargs:
+        mx_dis: maximum half-size (in source pixels) of a source window,
+            (height, width) or scalar.
+        num_read_threads: number of threads to read the source windows. The
+            caches of the image loader are thread-safe, so the threads can
+            share img_loader.
     """
     rintp = kwargs.get('remap_interp', cv2.INTER_LANCZOS4)
     mx_dis = kwargs.get('mx_dis', 16300)
     fillval = kwargs.get('fillval', img_loader.default_fillval)
     dtype_out = kwargs.get('dtype_out', img_loader.dtype)
     return_empty = kwargs.get('return_empty', False)
-    seeds = kwargs.get('seeds', None)
+    num_read_threads = kwargs.get('num_read_threads', 1)
     if isinstance(rintp, str):
         rintp_dict = {'NEAREST': cv2.INTER_NEAREST,
                       'LINEAR': cv2.INTER_LINEAR,
@@ -280,73 +332,73 @@ def render_by_subregions(map_x, map_y, mask, img_loader, fileid=None,  **kwargs)
             return None
     tile_ht, tile_wd = mask.shape[:2]
     imgt = np.full_like(map_x, fillval, dtype=dtype_out)
-    to_render = mask
-    if seeds is None:
-        seed_indices = np.empty((0, 2), dtype=np.int8)
-    else:
-        seeds = np.atleast_1d(seeds).ravel()
-        num_r = seeds[0]
-        num_c = seeds[-1]
-        idx0 = np.unique(np.round(np.arange(tile_ht*0.5/num_r, tile_ht, tile_ht/num_r)))
-        idx1 = np.unique(np.round(np.arange(tile_wd*0.5/num_c, tile_wd, tile_wd/num_c)))
-        seed_idx0, seed_idx1 = np.meshgrid(idx0.astype(np.int32), idx1.astype(np.int32))
-        seed_idx0, seed_idx1 = seed_idx0.ravel(), seed_idx1.ravel()
-        seed_indices = np.stack((seed_idx0, seed_idx1), axis=-1)
-        sel_idx = to_render[seed_idx0, seed_idx1]
-        seed_indices = seed_indices[sel_idx]
-    multichannel = False
-    while np.any(to_render, axis=None):
-        if seed_indices.size > 0:
-            sel_idx = to_render[seed_indices[:,0], seed_indices[:,1]]
-            seed_indices = seed_indices[sel_idx]
-            indx0_sel = seed_indices[0, 0]
-            indx1_sel = seed_indices[0, 1]
-        else:
-            indx0, indx1 = np.nonzero(to_render)
-            indx0_sel = indx0[indx0.size//2]
-            indx1_sel = indx1[indx1.size//2]
-        xx0 = map_x[indx0_sel, indx1_sel]
-        yy0 = map_y[indx0_sel, indx1_sel]
-        mskt = (np.abs(map_x - xx0) < mx_dis[-1]) & (np.abs(map_y - yy0) < mx_dis[0]) & to_render
-        xmin = np.floor(map_x[mskt].min()) - 4 # Lanczos 8x8 kernel
-        xmax = np.ceil(map_x[mskt].max()) + 4
-        ymin = np.floor(map_y[mskt].min()) - 4
-        ymax = np.ceil(map_y[mskt].max()) + 4
-        bbox = (int(xmin), int(ymin), int(xmax), int(ymax))
+    tile_grid = None
+    if (fileid is None) and hasattr(img_loader, 'file_bboxes'):
+        file_bboxes = np.array(list(img_loader.file_bboxes(margin=0))).reshape(-1, 4)
+        if file_bboxes.shape[0] > 1:
+            tile_grid = (file_bboxes[:,0].min(), file_bboxes[:,1].min(),
+                         np.median(file_bboxes[:,2] - file_bboxes[:,0]),
+                         np.median(file_bboxes[:,3] - file_bboxes[:,1]))
+    windows = _plan_source_windows(map_x, map_y, mask, (2 * mx_dis[0], 2 * mx_dis[-1]), tile_grid=tile_grid)
+    def _read_window(bbox_f):
+        bbox = (int(np.floor(bbox_f[0])) - 4, int(np.floor(bbox_f[1])) - 4,  # Lanczos 8x8 kernel
+                int(np.ceil(bbox_f[2])) + 4, int(np.ceil(bbox_f[3])) + 4)
         if fileid is None:
-            img0 = img_loader.crop(bbox, **kwargs)
+            return bbox, img_loader.crop(bbox, **kwargs)
         else:
-            img0 = img_loader.crop(bbox, fileid, **kwargs)
-        if img0 is None:
-            to_render = to_render & (~mskt)
-            continue
-        if (len(img0.shape) > 2) and (not multichannel):
-            # multichannel
-            num_channel = img0.shape[-1]
-            imgt = np.stack((imgt, )*num_channel, axis=-1)
-            multichannel = True
-        cover_ratio = np.sum(mskt) / mskt.size
-        if cover_ratio > 0.25:
-            map_xt = map_x - xmin
-            map_yt = map_y - ymin
-            imgtt = remap(img0, map_xt.astype(np.float32), map_yt.astype(np.float32),
-                interpolation=rintp, borderMode=cv2.BORDER_CONSTANT, borderValue=fillval)
-            if multichannel:
-                mskt3 = np.stack((mskt, )*num_channel, axis=-1)
-                imgtt = imgtt.reshape(mskt3.shape)
-                imgt[mskt3] = imgtt[mskt3]
+            return bbox, img_loader.crop(bbox, fileid, **kwargs)
+    if (num_read_threads > 1) and (len(windows) > 1):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=num_read_threads)
+        pending = deque()
+        def _read_ahead():
+            # keep about num_read_threads windows in flight, so that only those
+            # and the one being remapped are held in memory
+            for _, bbox_f in windows:
+                pending.append(executor.submit(_read_window, bbox_f))
+                if len(pending) >= num_read_threads:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        reads = _read_ahead()
+    else:
+        executor = None
+        reads = map(_read_window, [bbox_f for _, bbox_f in windows])
+    multichannel = False
+    try:
+        for (pidx, _), (bbox, img0) in zip(windows, reads):
+            if img0 is None:
+                continue
+            if (len(img0.shape) > 2) and (not multichannel):
+                # multichannel
+                num_channel = img0.shape[-1]
+                imgt = np.stack((imgt, )*num_channel, axis=-1)
+                multichannel = True
+            xmin, ymin = bbox[0], bbox[1]
+            rr, cc = np.unravel_index(pidx, (tile_ht, tile_wd))
+            r0, r1, c0, c1 = rr.min(), rr.max() + 1, cc.min(), cc.max() + 1
+            if pidx.size > 0.25 * (r1 - r0) * (c1 - c0):
+                # dense remap of the bounding block of the window's pixels
+                map_xt = map_x[r0:r1, c0:c1] - xmin
+                map_yt = map_y[r0:r1, c0:c1] - ymin
+                imgtt = remap(img0, map_xt.astype(np.float32), map_yt.astype(np.float32),
+                    interpolation=rintp, borderMode=cv2.BORDER_CONSTANT, borderValue=fillval)
+                imgtt = imgtt.reshape((r1 - r0) * (c1 - c0), -1)
+                imgtt = imgtt[(rr - r0) * (c1 - c0) + (cc - c0)]
             else:
-                imgt[mskt] = imgtt[mskt]
-        else:
-            map_xt = map_x[mskt] - xmin
-            map_yt = map_y[mskt] - ymin
-            imgtt = remap(img0, map_xt, map_yt, interpolation=rintp, borderMode=cv2.BORDER_CONSTANT, borderValue=fillval)
+                map_xt = map_x.ravel()[pidx] - xmin
+                map_yt = map_y.ravel()[pidx] - ymin
+                imgtt = remap(img0, map_xt, map_yt, interpolation=rintp, borderMode=cv2.BORDER_CONSTANT, borderValue=fillval)
+                imgtt = imgtt.reshape(pidx.size, -1)
             if multichannel:
-                mskt3 = np.stack((mskt, )*imgtt.shape[-1], axis=-1)
-                imgt[mskt3] = imgtt.ravel()
+                imgt.reshape(-1, num_channel)[pidx] = imgtt
             else:
-                imgt[mskt] = imgtt.ravel()
-        to_render = to_render & (~mskt)
+                imgt.reshape(-1)[pidx] = imgtt.ravel()
+    finally:
+        if executor is not None:
+            for fut in pending:
+                fut.cancel()
+            executor.shutdown(wait=True)
     return imgt
 
 
@@ -882,6 +934,127 @@ def parse_json_file(filename, stream=None):
     return json_dict, file_read
 
 
+def divide_by_cost(costs, num_jobs, counts=None, max_count=None):
+    """
+    divide a sequence of items into contiguous groups of similar total costs.
+    Args:
+        costs(ndarray): predicted cost of each item.
+        num_jobs(int): number of groups.
+    Kwargs:
+        counts(ndarray): size of each item (e.g. number of chunks), default to 1.
+        max_count(float): maximum total size of a group. Groups exceeding it
+            are further divided evenly by size.
+    Return:
+        indices(ndarray): boundaries of the groups, so that the k-th group
+            consists of items[indices[k]:indices[k+1]].
+    """
+    costs = np.asarray(costs, dtype=np.float64).ravel()
+    num_items = costs.size
+    if counts is None:
+        counts = np.ones(num_items, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64).ravel()
+    if num_items == 0:
+        return np.zeros(1, dtype=np.int64)
+    if not (np.sum(costs) > 0):
+        costs = counts
+    cost_acc = np.insert(np.cumsum(costs), 0, 0)
+    cuts = np.linspace(0, cost_acc[-1], num=max(1, num_jobs)+1, endpoint=True)
+    indices = np.searchsorted(cost_acc, cuts, side='left').clip(1, num_items)
+    # cut at the item boundary closest to the target cost
+    indices = indices - (np.abs(cost_acc[indices-1] - cuts) < np.abs(cost_acc[indices] - cuts))
+    indices = np.unique(np.concatenate(([0], indices, [num_items])))
+    if max_count is not None:
+        count_acc = np.insert(np.cumsum(counts), 0, 0)
+        indices_split = [0]
+        for idx0, idx1 in zip(indices[:-1], indices[1:]):
+            num_split = int(np.ceil((count_acc[idx1] - count_acc[idx0]) / max_count))
+            if num_split > 1:
+                cuts = np.linspace(count_acc[idx0], count_acc[idx1], num=num_split+1, endpoint=True)
+                indices_split.extend(np.searchsorted(count_acc, cuts[1:-1], side='left').clip(idx0, idx1))
+            indices_split.append(idx1)
+        indices = np.unique(indices_split)
+    return indices.astype(np.int64)
+
+
+class RenderCostModel:
+    """
+    linear model that predicts the time to render output chunks from their
+    features (e.g. the number of sections or source tiles they overlap, the
+    number of mesh triangles inside), so that the render jobs can be divided
+    by predicted cost instead of by chunk count. If a record file is given,
+    the timings of the finished jobs are appended to it, and the weights are
+    refitted to the records of earlier runs once there are enough of them.
+    Args:
+        default_weights(dict): feature name -> cost per unit of the feature.
+    Kwargs:
+        record_file(str): json file to keep the timing records of the jobs.
+        max_records(int): maximum number of the most recent records to keep.
+    """
+    def __init__(self, default_weights, record_file=None, **kwargs):
+        self.features = list(default_weights.keys())
+        self.weights = np.array([default_weights[s] for s in self.features], dtype=np.float64)
+        self._record_file = record_file
+        self._max_records = kwargs.get('max_records', 2000)
+        self._records = []
+        if (record_file is not None) and storage.file_exists(record_file):
+            try:
+                with storage.File(record_file, 'r') as f:
+                    rec = json.load(f)
+                if rec.get('features', None) == self.features:
+                    self._records = rec.get('records', [])
+            except (ValueError, OSError):
+                self._records = []
+        self.fit()
+
+
+    def fit(self):
+        """refit the weights to the timing records if there are enough."""
+        from scipy.optimize import nnls
+        if len(self._records) < 4 * len(self.features):
+            return self.weights
+        rec = np.array(self._records, dtype=np.float64)
+        A, b = rec[:, :-1], rec[:, -1]
+        scl = np.maximum(A.max(axis=0), 1e-9)
+        w, _ = nnls(A / scl, b)
+        if np.any(w > 0):
+            self.weights = w / scl
+        return self.weights
+
+
+    def predict(self, features):
+        """
+        Args:
+            features(dict): feature name -> value of each item (ndarray).
+        Return:
+            costs(ndarray): predicted cost of each item.
+        """
+        costs = 0
+        for name, w in zip(self.features, self.weights):
+            if name in features:
+                costs = costs + w * np.asarray(features[name], dtype=np.float64)
+        return costs
+
+
+    def record(self, features, seconds):
+        """
+        add the timing of a finished job.
+        Args:
+            features(dict): feature name -> total value of the items in the job.
+            seconds(float): time it took to finish the job.
+        """
+        rec = [float(features.get(s, 0)) for s in self.features]
+        self._records.append(rec + [float(seconds)])
+
+
+    def save(self):
+        if self._record_file is None:
+            return
+        records = self._records[-self._max_records:]
+        storage.makedirs(os.path.dirname(self._record_file))
+        with storage.File(self._record_file, 'w') as f:
+            json.dump({'features': self.features, 'records': records}, f)
+
+
 def numpy_array(obj, copy=False):
     if np.__version__ < '2':
         return np.array(obj, copy=copy)
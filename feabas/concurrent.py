@@ -1,5 +1,9 @@
-from collections import defaultdict
+import atexit
+from collections import defaultdict, deque
+from functools import partial
+import itertools
 from feabas import config, storage
+import os
 import sys
 
 PY_VERSION = tuple(sys.version_info)
@@ -22,25 +26,563 @@ def parse_inputs(args, kwargs):
     return N, args, kwargs
 
 
+def _is_single(inputs):
+    return (inputs is not None) and hasattr(inputs, '__len__') and (len(inputs) == 1)
+
+
+def num_of_tasks(args, kwargs):
+    """number of tasks defined by args and kwargs. None if they are iterators of unknown length."""
+    N = 0
+    for inputs in (args, kwargs):
+        if inputs is None:
+            continue
+        if not hasattr(inputs, '__len__'):
+            return None
+        N = max(N, len(inputs))
+    return N
+
+
+def iterate_inputs(args, kwargs):
+    """
+    lazy counterpart of parse_inputs: yield the (args, kwargs) of each task.
+    args and kwargs can be any iterables, including generators. If one of them
+    has a single element, it is shared by all the tasks.
+    """
+    if (args is None) and (kwargs is None):
+        return
+    single_a, single_k = _is_single(args), _is_single(kwargs)
+    if args is None:
+        args = itertools.repeat([])
+    elif single_a and (kwargs is not None) and (not single_k):
+        args = itertools.repeat(args[0])
+    if kwargs is None:
+        kwargs = itertools.repeat({})
+    elif single_k and (not single_a) and (not isinstance(args, itertools.repeat)):
+        kwargs = itertools.repeat(kwargs[0])
+    yield from zip(args, kwargs)
+
+
+class SharedArray:
+    """
+    Picklable handle of a numpy array in multiprocessing.shared_memory. Only
+    the name, shape and dtype of the block cross the process boundary; the
+    receiving process attaches to the same memory without copying.
+    The process that creates the handle with SharedArray.from_array owns the
+    memory and should call unlink() when all the consumers are done.
+    The memory is shared by all the tasks that refer to the same array, so the
+    attached views are read-only: a task that needs to modify its input should
+    work on a copy.
+    """
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._shm = None
+        self._owner = False
+
+
+    @classmethod
+    def from_array(cls, arr):
+        import numpy as np
+        from multiprocessing import shared_memory
+        arr = np.asarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        shared = cls(shm.name, arr.shape, arr.dtype.str)
+        shared._shm = shm
+        shared._owner = True
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        return shared
+
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def asarray(self):
+        import numpy as np
+        from multiprocessing import shared_memory
+        if self._shm is None:
+            try:
+                self._shm = shared_memory.SharedMemory(name=self.name, track=False)
+            except TypeError:   # Python < 3.13
+                self._shm = shared_memory.SharedMemory(name=self.name)
+        arr = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=self._shm.buf)
+        arr.flags.writeable = False
+        return arr
+
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.asarray()
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+
+    def close(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # views of the memory still alive, leave the mapping to the GC
+                return
+            if not self._owner:
+                self._shm = None
+
+
+    def unlink(self):
+        if self._owner and (self._shm is not None):
+            self.close()
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            self._shm = None
+            self._owner = False
+
+
+def share_large_arrays(obj, threshold, shared=None, used=None):
+    """
+    replace the numpy arrays larger than threshold (in MiB) in obj (nested in
+    lists, tuples and dicts) with SharedArray handles.
+    Args:
+        obj: the object to convert.
+        threshold(float): size threshold in MiB.
+        shared(dict): {id(array): (array, SharedArray)} of the arrays already
+            shared, so that the same array used by many tasks is only copied
+            to shared memory once. Updated in place.
+        used(set): if provided, the keys in shared referred to by obj are
+            added to it.
+    Return:
+        the converted object.
+    """
+    import numpy as np
+    if shared is None:
+        shared = {}
+    if isinstance(obj, np.ndarray):
+        if (obj.dtype.hasobject) or (obj.nbytes < threshold * (1024**2)):
+            return obj
+        if id(obj) not in shared:
+            shared[id(obj)] = (obj, SharedArray.from_array(obj))
+        if used is not None:
+            used.add(id(obj))
+        return shared[id(obj)][1]
+    elif isinstance(obj, dict):
+        return {k: share_large_arrays(v, threshold, shared, used) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [share_large_arrays(v, threshold, shared, used) for v in obj]
+    elif isinstance(obj, tuple) and not hasattr(obj, '_fields'):
+        return tuple(share_large_arrays(v, threshold, shared, used) for v in obj)
+    else:
+        return obj
+
+
+def resolve_shared_arrays(obj, handles=None):
+    """
+    inverse of share_large_arrays: attach to the shared memory and replace the
+    SharedArray handles in obj with numpy arrays. The attached handles are
+    appended to the handles list if provided so they can be closed later.
+    """
+    if isinstance(obj, SharedArray):
+        if handles is not None:
+            handles.append(obj)
+        return obj.asarray()
+    elif isinstance(obj, dict):
+        return {k: resolve_shared_arrays(v, handles) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [resolve_shared_arrays(v, handles) for v in obj]
+    elif isinstance(obj, tuple) and not hasattr(obj, '_fields'):
+        return tuple(resolve_shared_arrays(v, handles) for v in obj)
+    else:
+        return obj
+
+
+class _SharedArrayTask:
+    """wrap a function so that its SharedArray arguments are resolved in the worker."""
+    def __init__(self, func):
+        self.func = func
+
+
+    def __call__(self, *args, **kwargs):
+        handles = []
+        args = resolve_shared_arrays(args, handles)
+        kwargs = resolve_shared_arrays(kwargs, handles)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            del args, kwargs
+            for h in handles:
+                h.close()
+
+
+class _SharedMemoryScope:
+    """
+    shared memory blocks of the large arrays of the tasks in flight. A block
+    is released as soon as none of the pending tasks refers to it.
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.shared = {}
+        self._refs = defaultdict(int)
+
+
+    def share(self, args, kwargs):
+        used = set()
+        args = share_large_arrays(args, self.threshold, self.shared, used)
+        kwargs = share_large_arrays(kwargs, self.threshold, self.shared, used)
+        for key in used:
+            self._refs[key] += 1
+        return args, kwargs, used
+
+
+    def release(self, used):
+        for key in used:
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                self._refs.pop(key)
+                _, sa = self.shared.pop(key)
+                sa.unlink()
+
+
+    def close(self):
+        for _, sa in self.shared.values():
+            sa.unlink()
+        self.shared.clear()
+        self._refs.clear()
+
+
+def _executor_submitter(executor, func):
+    def submit(args, kwargs):
+        return executor.submit(func, *args, **kwargs)
+    return submit
+
+
+def _dask_wait_first(futures):
+    from dask.distributed import wait
+    return wait(list(futures), return_when='FIRST_COMPLETED')
+
+
+def _stream_futures(submit, tasks, max_in_flight=None, ordered=False, wait=None, scope=None):
+    """
+    submit the tasks and yield the finished futures, keeping at most
+    max_in_flight of them pending, so that tasks from a generator are only
+    materialized shortly before the workers are ready for them.
+    Args:
+        submit(callable): submit(args, kwargs) -> future.
+        tasks(iterable): the (args, kwargs) of each task.
+    Kwargs:
+        max_in_flight(int): maximum number of futures submitted but not yet
+            yielded. None for no limit.
+        ordered(bool): yield the futures in the order of submission instead of
+            the order of completion.
+        wait(callable): wait(futures) -> (done, not_done), returns when at
+            least one of the futures is done. Default to concurrent.futures.
+        scope(_SharedMemoryScope): if provided, large arrays of each task are
+            moved to shared memory right before submission, and released once
+            the future is done.
+    """
+    if wait is None:
+        from concurrent.futures import wait as futures_wait, FIRST_COMPLETED
+        wait = partial(futures_wait, return_when=FIRST_COMPLETED)
+    if max_in_flight is None:
+        max_in_flight = float('inf')
+    max_in_flight = max(1, max_in_flight)
+    tasks = iter(tasks)
+    if ordered:
+        pending = deque()
+    else:
+        pending = set()
+    tokens = {}
+    exhausted = False
+    try:
+        while True:
+            while (not exhausted) and (len(pending) < max_in_flight):
+                try:
+                    args_b, kwargs_b = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if scope is not None:
+                    args_b, kwargs_b, token = scope.share(args_b, kwargs_b)
+                job = submit(args_b, kwargs_b)
+                if scope is not None:
+                    tokens[job] = token
+                if ordered:
+                    pending.append(job)
+                else:
+                    pending.add(job)
+            if len(pending) == 0:
+                break
+            if ordered:
+                done = [pending.popleft()]
+                wait(done)
+            else:
+                done, _ = wait(pending)
+                pending.difference_update(done)
+            for job in done:
+                if scope is not None:
+                    scope.release(tokens.pop(job))
+                yield job
+    finally:
+        # also reached when the consumer stops iterating early
+        for job in pending:
+            job.cancel()
+
+
+def _process_memory():
+    """resident memory of the current process in MiB."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / (1024**2)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / (1024**2)
+    else:
+        return maxrss / 1024
+
+
+class _MemoryReportingTask:
+    """wrap a function so that the worker also reports its memory usage after each call."""
+    def __init__(self, func):
+        self.func = func
+
+
+    def __call__(self, *args, **kwargs):
+        res = self.func(*args, **kwargs)
+        return res, _process_memory()
+
+
+_ACTIVE_POOLS = []
+
+
+def active_worker_pool(parallel_framework=None):
+    """the innermost WorkerPool currently in use, optionally of a given framework."""
+    for pool in _ACTIVE_POOLS[::-1]:
+        if (parallel_framework is None) or (pool.parallel_framework == parallel_framework):
+            return pool
+    return None
+
+
+class WorkerPool:
+    """
+    Long-lived pool of worker processes that can be reused by all the
+    submit_to_workers calls of a processing stage (or several stages), so that
+    each worker only pays the start-up cost (spawning the interpreter and
+    importing numpy, scipy, cv2 etc.) once. Used as a context manager:
+
+        with WorkerPool(num_workers=8):
+            ... # process/dask backends of submit_to_workers run on the pool
+
+    Workers are recycled based on their memory usage instead of the number of
+    tasks they have run: whenever a worker of the process backend reports a
+    resident memory larger than max_worker_memory after finishing a task, the
+    current executor is drained (its in-flight tasks finish and its workers
+    exit) before a fresh one is spawned, so the old and the new workers never
+    hold memory at the same time. The executor cannot restart one of its
+    workers on its own, so the whole executor is replaced. For the dask
+    backend, max_worker_memory is used as the memory limit of the nannies of
+    the LocalCluster, which restart only the workers that exceed it.
+    Kwargs:
+        num_workers(int): number of worker processes.
+        parallel_framework(str): process or dask. Pools of other frameworks
+            are accepted but not used (thread pools are cheap to create, and
+            remote clusters manage their own workers).
+        max_worker_memory(float): memory high-water mark in MiB above which
+            workers are recycled. None to never recycle. Default from the
+            general configuration.
+        threads_per_worker(int): threads per dask worker.
+    """
+    def __init__(self, num_workers=1, **kwargs):
+        self.num_workers = max(1, num_workers)
+        self.parallel_framework = kwargs.get('parallel_framework', DEFAUL_FRAMEWORK)
+        self.max_worker_memory = kwargs.get('max_worker_memory', config.max_worker_memory())
+        self._threads_per_worker = kwargs.get('threads_per_worker', 1)
+        self._executor = None
+        self._cluster = None
+        self._client = None
+        self.recycle_count = 0
+
+
+    def __enter__(self):
+        _ACTIVE_POOLS.append(self)
+        return self
+
+
+    def __exit__(self, *args):
+        if self in _ACTIVE_POOLS:
+            _ACTIVE_POOLS.remove(self)
+        self.close()
+
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        if self._cluster is not None:
+            self._cluster.close()
+            self._cluster = None
+
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+            self._executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=get_context('spawn'))
+        return self._executor
+
+
+    @property
+    def client(self):
+        if self._client is None:
+            from dask.distributed import LocalCluster, Client
+            if self.max_worker_memory is None:
+                memory_limit = 'auto'
+            else:
+                memory_limit = int(self.max_worker_memory * (1024**2))
+            self._cluster = LocalCluster(n_workers=self.num_workers, processes=True,
+                                         threads_per_worker=self._threads_per_worker,
+                                         memory_limit=memory_limit)
+            self._client = Client(self._cluster)
+        return self._client
+
+
+    def recycle(self):
+        """
+        retire the current executor after its in-flight tasks are finished; a
+        new one is spawned when next needed.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self.recycle_count += 1
+
+
+    def _submit(self, func, *args, **kwargs):
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            executor = self.executor
+            job = executor.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            # e.g. a worker got killed by the OOM killer
+            self.recycle()
+            executor = self.executor
+            job = executor.submit(func, *args, **kwargs)
+        return job, executor
+
+
+    def imap(self, func, tasks, num_workers=None, **kwargs):
+        """
+        run func(*args, **kwargs) for each (args, kwargs) in tasks on the pool
+        and yield the results.
+        Kwargs:
+            num_workers(int): maximum number of tasks to run at the same time.
+                Capped by the size of the pool.
+            max_in_flight(int): maximum number of tasks submitted but not yet
+                yielded. Default to 2 * num_workers.
+            ordered(bool): yield the results in the order of the tasks.
+            scope(_SharedMemoryScope): manager of the shared memory of the tasks.
+        """
+        if num_workers is None:
+            num_workers = self.num_workers
+        max_in_flight = kwargs.pop('max_in_flight', None)
+        if self.parallel_framework == 'dask':
+            if max_in_flight is None:
+                max_in_flight = _default_max_in_flight(num_workers)
+            submit = _executor_submitter(self.client, func)
+            for job in _stream_futures(submit, tasks, max_in_flight=max_in_flight, wait=_dask_wait_first, **kwargs):
+                yield job.result()
+            return
+        num_workers = max(1, min(num_workers, self.num_workers))
+        if max_in_flight is None:
+            max_in_flight = _default_max_in_flight(num_workers)
+        task = _MemoryReportingTask(func)
+        executors = {}
+        def submit(args_b, kwargs_b):
+            job, executor = self._submit(task, *args_b, **kwargs_b)
+            executors[job] = executor
+            return job
+        for job in _stream_futures(submit, tasks, max_in_flight=max_in_flight, **kwargs):
+            executor = executors.pop(job)
+            res, mem = job.result()
+            if (self.max_worker_memory is not None) and (mem > self.max_worker_memory):
+                if executor is self._executor:
+                    self.recycle()
+            yield res
+
+
+def start_worker_pool(num_workers=1, **kwargs):
+    """
+    create a WorkerPool that stays active until the interpreter exits, for
+    scripts that run all their submit_to_workers calls on the same workers.
+    See WorkerPool for the kwargs.
+    """
+    pool = WorkerPool(num_workers=num_workers, **kwargs)
+    pool.__enter__()
+    atexit.register(pool.__exit__)
+    return pool
+
+
 def is_daemon_process():
     from multiprocessing import current_process
     return current_process().daemon
 
 
+def _default_max_in_flight(num_workers):
+    # keep the workers busy without submitting (and sharing the arrays of)
+    # all the tasks up front
+    return 2 * num_workers
+
+
 def submit_to_workers(func, args=None, kwargs=None, **settings):
+    """
+    run func on each set of inputs with the configured parallel framework and
+    yield the results.
+    Args:
+        func(callable): the function to run.
+        args(iterable): the positional arguments (as lists or tuples) of the
+            tasks.
+        kwargs(iterable): the keyword arguments (as dicts) of the tasks.
+            args and kwargs can be generators, in which case each task is only
+            generated when there is room for it in the queue of submitted
+            tasks. If one of them has a single element, it is shared by all
+            the tasks.
+    Kwargs:
+        parallel_framework(str): process/thread/dask/slurm.
+        num_workers(int): number of workers.
+        force_remote(bool): submit to the workers even if there is only one
+            task or one worker.
+        max_in_flight(int): maximum number of tasks submitted but whose
+            results have not been yielded yet. Further tasks are generated
+            only after earlier results are consumed. Default to 2 * num_workers.
+        ordered(bool): yield the results in the order of the tasks instead of
+            in the order of completion. Default to False.
+    Other settings are passed to the backend.
+    """
     parallel_framework = settings.pop('parallel_framework', DEFAUL_FRAMEWORK)
     num_workers = settings.get('num_workers', 1)
     force_remote = settings.pop('force_remote', parallel_framework in REMOTE_FRAMEWORKS)
-    N, args_n, kwargs_n = parse_inputs(args, kwargs)
+    N = num_of_tasks(args, kwargs)
     if N == 0:
         return []
     if is_daemon_process():
         num_workers = 1
         force_remote = False
     if ((num_workers == 1) or (N == 1)) and (not force_remote):
-        for k in range(N):
-            args_b = args_n[k]
-            kwargs_b = kwargs_n[k]
+        for args_b, kwargs_b in iterate_inputs(args, kwargs):
             res = func(*args_b, **kwargs_b)
             yield res
     else:
@@ -58,89 +600,107 @@ def submit_to_workers(func, args=None, kwargs=None, **settings):
 
 def submit_to_process_pool(func, args=None, kwargs=None, **settings):
     """
-    Python built-in concurrent multiprocessing backend
+    Python built-in concurrent multiprocessing backend. If a process
+    WorkerPool is active, the tasks run on its workers instead of a new pool.
+    Kwargs:
+        num_workers(int): number of worker processes.
+        max_tasks_per_child(int): restart the workers after this many tasks.
+            Ignored by an active WorkerPool that recycles workers based on
+            memory usage.
+        shared_memory_threshold(float): numpy arrays in args/kwargs larger than
+            this (in MiB) are copied to shared memory right before submission
+            and only handles are sent to the workers as read-only arrays. The
+            memory is released when no pending task uses it any more, or when
+            the generator is exhausted or closed. None to always pickle.
+            Default from the general configuration.
+        max_in_flight(int), ordered(bool): see submit_to_workers.
     """
-    from concurrent.futures import ProcessPoolExecutor, as_completed
-    from multiprocessing import get_context
     num_workers = settings.get('num_workers', 1)
     max_tasks_per_child = settings.get('max_tasks_per_child', None)
-    N, args, kwargs = parse_inputs(args, kwargs)
-    if ((max_tasks_per_child is None) or (max_tasks_per_child == 1)) and (PY_VERSION[1]>10):
-        futures = []
-        with ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context('spawn'), max_tasks_per_child=max_tasks_per_child) as executor:
-            for k in range(N):
-                args_b = args[k]
-                kwargs_b = kwargs[k]
-                job = executor.submit(func, *args_b, **kwargs_b)
-                futures.append(job)
-            for job in as_completed(futures):
-                res = job.result()
-                yield res
-    else:
+    shm_threshold = settings.get('shared_memory_threshold', config.shared_memory_threshold())
+    stream_settings = {
+        'max_in_flight': settings.get('max_in_flight', _default_max_in_flight(num_workers)),
+        'ordered': settings.get('ordered', False)
+    }
+    tasks = iterate_inputs(args, kwargs)
+    if shm_threshold is None:
+        yield from _submit_to_process_pool(func, tasks, num_workers, max_tasks_per_child, **stream_settings)
+        return
+    scope = _SharedMemoryScope(shm_threshold)
+    try:
+        yield from _submit_to_process_pool(_SharedArrayTask(func), tasks, num_workers, max_tasks_per_child, scope=scope, **stream_settings)
+    finally:
+        scope.close()
+
+
+def _submit_to_process_pool(func, tasks, num_workers, max_tasks_per_child, **kwargs):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    pool = active_worker_pool('process')
+    if (pool is not None) and ((max_tasks_per_child is None) or (pool.max_worker_memory is not None)):
+        # with memory-based recycling, max_tasks_per_child is not needed to keep memory in check
+        yield from pool.imap(func, tasks, num_workers=num_workers, **kwargs)
+    elif (max_tasks_per_child is None) or ((max_tasks_per_child == 1) and (PY_VERSION[1]>10)):
         if max_tasks_per_child is None:
-            batch_size = N
+            executor_settings = {}
         else:
-            batch_size = num_workers * max_tasks_per_child
-        index0 = list(range(N))
-        indices = [index0[k:(k+batch_size)] for k in range(0, N, batch_size)]
-        for idx in indices:
-            futures = []
+            executor_settings = {'max_tasks_per_child': max_tasks_per_child}
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context('spawn'), **executor_settings) as executor:
+            for job in _stream_futures(_executor_submitter(executor, func), tasks, **kwargs):
+                yield job.result()
+    else:
+        batch_size = num_workers * max_tasks_per_child
+        tasks = iter(tasks)
+        while True:
+            batch = list(itertools.islice(tasks, batch_size))
+            if len(batch) == 0:
+                break
             with ProcessPoolExecutor(max_workers=num_workers, mp_context=get_context('spawn')) as executor:
-                for k in idx:
-                    args_b = args[k]
-                    kwargs_b = kwargs[k]
-                    job = executor.submit(func, *args_b, **kwargs_b)
-                    futures.append(job)
-                for job in as_completed(futures):
-                    res = job.result()
-                    yield res
+                for job in _stream_futures(_executor_submitter(executor, func), batch, **kwargs):
+                    yield job.result()
 
 
 def submit_to_thread_pool(func, args=None, kwargs=None, **settings):
     """
     Python built-in concurrent multithreading backend
     """
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from concurrent.futures import ThreadPoolExecutor
     num_workers = settings.get('num_workers', 1)
-    N, args, kwargs = parse_inputs(args, kwargs)
-    futures = []
+    max_in_flight = settings.get('max_in_flight', _default_max_in_flight(num_workers))
+    ordered = settings.get('ordered', False)
+    tasks = iterate_inputs(args, kwargs)
     with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        for k in range(N):
-            args_b = args[k]
-            kwargs_b = kwargs[k]
-            job = executor.submit(func, *args_b, **kwargs_b)
-            futures.append(job)
-        for job in as_completed(futures):
-            res = job.result()
-            yield res
+        for job in _stream_futures(_executor_submitter(executor, func), tasks, max_in_flight=max_in_flight, ordered=ordered):
+            yield job.result()
 
 
 def submit_to_dask_localcluster(func, args=None, kwargs=None, **settings):
     """
-    Dask Local Cluster scheduler: dask.distributed.LocalCluster
+    Dask Local Cluster scheduler: dask.distributed.LocalCluster. If a dask
+    WorkerPool is active, its cluster is reused.
     """
-    from dask.distributed import LocalCluster, Client, as_completed
+    from dask.distributed import LocalCluster, Client
     num_workers = settings.get('num_workers', 1)
+    max_in_flight = settings.get('max_in_flight', _default_max_in_flight(num_workers))
+    ordered = settings.get('ordered', False)
+    tasks = iterate_inputs(args, kwargs)
+    pool = active_worker_pool('dask')
+    if pool is not None:
+        yield from pool.imap(func, tasks, num_workers=num_workers, max_in_flight=max_in_flight, ordered=ordered)
+        return
     max_tasks_per_child = settings.get('max_tasks_per_child', None)
     memory_limit = settings.get('memory_limit', 'auto')
     threads_per_worker = settings.get('threads_per_worker', 1)
-    N, args, kwargs = parse_inputs(args, kwargs)
-    index0 = list(range(N))
     if max_tasks_per_child is None:
-        indices = [index0]
+        batches = [tasks]
     else:
         batch_size = num_workers * max_tasks_per_child
-        indices = [index0[k:(k+batch_size)] for k in range(0, N, batch_size)]
-    for idx in indices:
+        batches = iter(lambda: list(itertools.islice(tasks, batch_size)), [])
+    for batch in batches:
         with LocalCluster(n_workers=num_workers, processes=True, threads_per_worker=threads_per_worker, memory_limit=memory_limit) as cluster:
             with Client(cluster) as client:
-                futures = []
-                for k in idx:
-                    args_b = args[k]
-                    kwargs_b = kwargs[k]
-                    fut = client.submit(func, *args_b, **kwargs_b)
-                    futures.append(fut)
-                for fut in as_completed(futures):
+                submit = _executor_submitter(client, func)
+                for fut in _stream_futures(submit, batch, max_in_flight=max_in_flight, ordered=ordered, wait=_dask_wait_first):
                     yield fut.result()
 
 
@@ -149,9 +709,11 @@ def submit_to_dask_slurmcluster(func, args=None, kwargs=None, **settings):
     Dask SLURMCluster scheduler: dask_jobqueue.SLURMCluster
     """
     from dask_jobqueue import SLURMCluster
-    from dask.distributed import Client, as_completed
+    from dask.distributed import Client
     num_workers = settings.pop('num_workers', 1)
     config_name = settings.pop('config_name', None)
+    max_in_flight = settings.pop('max_in_flight', _default_max_in_flight(num_workers))
+    ordered = settings.pop('ordered', False)
     if (config_name is not None) and storage.file_exists(config_name):
         cluster_settings = storage.load_yaml(config_name)
         if 'jobqueue' in cluster_settings:
@@ -162,21 +724,17 @@ def submit_to_dask_slurmcluster(func, args=None, kwargs=None, **settings):
         cluster_settings = {'config_name': config_name}
     else:
         cluster_settings = settings
-    N, args, kwargs = parse_inputs(args, kwargs)
+    tasks = iterate_inputs(args, kwargs)
     with SLURMCluster(**cluster_settings) as cluster:
         cluster.scale(jobs=num_workers)
-        futures = []
         with Client(cluster) as client:
             client.wait_for_workers(num_workers)
             dask_queues = {}
-            for k in range(N):
-                args_b = args[k]
-                kwargs_b = kwargs[k]
-                dask_queues = replace_w_dask_queues(args_b, dask_queues)
-                dask_queues = replace_w_dask_queues(kwargs_b, dask_queues)
-                job = client.submit(func, *args_b, **kwargs_b)
-                futures.append(job)
-            for job in as_completed(futures):
+            def submit(args_b, kwargs_b):
+                replace_w_dask_queues(args_b, dask_queues)
+                replace_w_dask_queues(kwargs_b, dask_queues)
+                return client.submit(func, *args_b, **kwargs_b)
+            for job in _stream_futures(submit, tasks, max_in_flight=max_in_flight, ordered=ordered, wait=_dask_wait_first):
                 relay_dask_queue_records(dask_queues)
                 res = job.result()
                 yield res
@@ -48,6 +48,35 @@ def parallel_framework():
     return frmwk
 
 
+@lru_cache(maxsize=1)
+def fft_engine():
+    engine = general_settings().get('fft_engine', 'scipy')
+    if engine is None:
+        engine = 'scipy'
+    engine = engine.lower()
+    if engine not in ('scipy', 'pyfftw'):
+        raise ValueError(f'In {_default_configuration_folder}: unsupported FFT engine "{engine}"')
+    return engine
+
+
+@lru_cache(maxsize=1)
+def shared_memory_threshold():
+    """numpy arrays larger than this (in MiB) are sent to process-pool workers through shared memory."""
+    threshold = general_settings().get('shared_memory_threshold', None)
+    if threshold is None:
+        return None
+    return float(threshold)
+
+
+@lru_cache(maxsize=1)
+def max_worker_memory():
+    """workers of a persistent WorkerPool using more memory than this (in MiB) are recycled."""
+    mem = general_settings().get('max_worker_memory', None)
+    if mem is None:
+        return None
+    return float(mem)
+
+
 @lru_cache(maxsize=1)
 def get_work_dir():
     conf = general_settings()
@@ -298,6 +327,13 @@ def get_numpy_thread():
         return 1
 
 
+def get_fft_workers():
+    fft_workers = general_settings().get('fft_workers', None)
+    if fft_workers is None:
+        return get_numpy_thread()
+    return max(1, int(fft_workers))
+
+
 def set_numpy_thread_from_num_workers(num_workers):
     num_cpus = general_settings()['cpu_budget']
     if num_workers > num_cpus:
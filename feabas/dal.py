@@ -1,10 +1,11 @@
 from abc import ABC
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 from functools import partial
 import gc
 import json
 import os
 import re
+import time
 
 import cv2
 import numpy as np
@@ -13,7 +14,7 @@ from scipy.interpolate import interp1d
 import tensorstore as ts
 
 from feabas import common, caching
-from feabas.storage import File, join_paths, list_folder_content, file_exists
+from feabas.storage import File, join_paths, list_folder_content, file_exists, parse_file_driver
 from feabas.config import DEFAULT_RESOLUTION, TS_TIMEOUT, TS_RETRY, get_numpy_thread
 
 Nthreads = get_numpy_thread()
@@ -138,6 +139,17 @@ class AbstractImageLoader(ABC):
         tf_lut(dict|str): intensity transfer function (by 1d linear
             interpolation) for each image. format
             {filename_substr: ([src_grayscales], [targt_grayscales])} 
+        disk_cache_dir(str): if set, decoded (and preprocessed) images are also
+            saved to this local directory as memory-mapped arrays, shared by
+            all the processes on the node, so that an image is only decoded
+            once across workers and jobs. Keyed by the image path and the
+            preprocessing settings.
+        disk_cache_capacity(float): capacity of the disk cache in MiB.
+        cache_type(str): replacement policy of the image cache. see
+            caching.generate_cache.
+        cache_trace_dir(str): if set, record the keys looked up in the image
+            cache to a file in this local directory, to be replayed by
+            tools/benchmark_cache_policies.py.
     """
     def __init__(self, **kwargs):
         self._dtype = kwargs.get('dtype', None)
@@ -154,12 +166,34 @@ class AbstractImageLoader(ABC):
         self._init_tile_divider(**kwargs)
         self._cache_type = kwargs.get('cache_type', 'mfu')
         self._cache = caching.generate_cache(self._cache_type, maxlen=self._cache_size, maxbytes=self._cache_capacity)
+        cache_trace_dir = kwargs.get('cache_trace_dir', None)
+        if (cache_trace_dir is not None) and self._use_cache:
+            os.makedirs(cache_trace_dir, exist_ok=True)
+            trace_file = os.path.join(cache_trace_dir, f'cache_trace_{os.getpid()}_{id(self)}.txt')
+            self._cache = caching.CacheTraceRecorder(self._cache, trace_file)
         preprocess_factory = kwargs.get('preprocess', None)
         preprocess_parames = kwargs.get('preprocess_params', {})
         self.update_preprocess_function(preprocess_factory, **preprocess_parames)
         self.resolution = kwargs.get('resolution', DEFAULT_RESOLUTION)
         self._read_counter = 0
+        self._metrics = Counter()
         self._tf_lut = kwargs.get('tf_lut', {})
+        self._disk_cache_dir = kwargs.get('disk_cache_dir', None)
+        self._disk_cache_capacity = kwargs.get('disk_cache_capacity', 10240)
+
+
+    def metrics(self):
+        """
+        counters of the loader since its creation, to be reported with
+        logging.report_metrics: number/bytes of decoded images, time (in
+        seconds) spent in imread/conversion(channels, tf_lut)/CLAHE/preprocess, the hits/misses of
+        the disk cache, and the statistics of the RAM cache prefixed by cache_.
+        """
+        out = dict(getattr(self, '_metrics', {}))
+        cache = getattr(self, '_cache', None)
+        if cache is not None:
+            out.update({'cache_' + k: v for k, v in cache.stats.items()})
+        return out
 
 
     def clear_cache(self, instant_gc=False):
@@ -222,72 +256,82 @@ class AbstractImageLoader(ABC):
 
 
     def _crop_from_one_image(self, bbox, imgpath, return_empty=False, return_index=False, **kwargs):
-        fillval = kwargs.get('fillval', self._default_fillval)
-        dtype = kwargs.get('dtype', self.dtype)
-        number_of_channels = kwargs.get('number_of_channels', self.number_of_channels)
         if (not self._use_cache) or (imgpath not in self._cache):
             imgout = self._crop_from_one_image_without_cache(bbox, imgpath, return_empty=return_empty, return_index=return_index, **kwargs)
         else:
-            # find the intersection between crop bbox and cached block bboxes
-            bbox_img = self._get_image_bbox(imgpath)
-            hits = self._get_image_hits(imgpath, bbox)
-            if not hits:
-                # no overlap, return trivial results based on output control
-                if return_empty and not return_index:
-                    if dtype is None or number_of_channels is None:
-                      # not sufficient info to generate empty tile, read an image to get info
-                        img = self._read_image(imgpath, **kwargs)
-                        imgout = common.crop_image_from_bbox(img, bbox_img, bbox, return_index=False,
-                            return_empty=True, fillval=fillval)
-                    else:
-                        outht = bbox[3] - bbox[1]
-                        outwd = bbox[2] - bbox[0]
-                        if number_of_channels <= 1:
-                            outsz = (outht, outwd)
-                        else:
-                            outsz = (outht, outwd, number_of_channels)
-                        imgout = np.full(outsz, fillval, dtype=dtype)
-                elif return_index:
-                    imgout = None, None
-                else:
-                    imgout = None
-            elif any(item not in self._get_cached_dict(imgpath) for item in hits):
-                # has missing blocks from cache, need to read image anyway
+            try:
+                imgout = self._crop_from_one_image_with_cache(bbox, imgpath, return_empty=return_empty, return_index=return_index, **kwargs)
+            except KeyError:
+                # evicted by another thread sharing the cache after the membership test
                 imgout = self._crop_from_one_image_without_cache(bbox, imgpath, return_empty=return_empty, return_index=return_index, **kwargs)
-            else:
-                # read from cache
-                if return_index:
-                    px_max, py_max, px_min, py_min  = bbox_img
-                    for bbox_blk in hits.values():
-                        tx_min, ty_min, tx_max, ty_max = [int(s) for s in bbox_blk]
-                        px_min = min(px_min, tx_min)
-                        py_min = min(py_min, ty_min)
-                        px_max = max(px_max, tx_max)
-                        py_max = max(py_max, ty_max)
-                    bbox_partial = (px_min, py_min, px_max, py_max)
+        return imgout
+
+
+    def _crop_from_one_image_with_cache(self, bbox, imgpath, return_empty=False, return_index=False, **kwargs):
+        # crop the image from the cached blocks. raise KeyError if not cached
+        fillval = kwargs.get('fillval', self._default_fillval)
+        dtype = kwargs.get('dtype', self.dtype)
+        number_of_channels = kwargs.get('number_of_channels', self.number_of_channels)
+        # find the intersection between crop bbox and cached block bboxes
+        bbox_img = self._get_image_bbox(imgpath)
+        hits = self._get_image_hits(imgpath, bbox)
+        if not hits:
+            # no overlap, return trivial results based on output control
+            if return_empty and not return_index:
+                if dtype is None or number_of_channels is None:
+                  # not sufficient info to generate empty tile, read an image to get info
+                    img = self._read_image(imgpath, **kwargs)
+                    imgout = common.crop_image_from_bbox(img, bbox_img, bbox, return_index=False,
+                        return_empty=True, fillval=fillval)
                 else:
-                    bbox_partial = bbox
-                initialized = False
-                cache_dict = self._get_cached_dict(imgpath)
-                for blkid, blkbbox in hits.items():
-                    blkbbox = [int(s) for s in blkbbox]
-                    blk = cache_dict[blkid]
-                    if blk is None:
-                        continue
-                    if not initialized:
-                        imgp = common.crop_image_from_bbox(blk, blkbbox, bbox_partial,
-                            return_index=False, return_empty=True, fillval=fillval)
-                        initialized = True
+                    outht = bbox[3] - bbox[1]
+                    outwd = bbox[2] - bbox[0]
+                    if number_of_channels <= 1:
+                        outsz = (outht, outwd)
                     else:
-                        blkt, indx =  common.crop_image_from_bbox(blk, blkbbox, bbox_partial,
-                            return_index=True, return_empty=False, fillval=fillval)
-                        if indx is not None and blkt is not None:
-                            imgp[indx] = blkt
-                if return_index:
-                    imgout = common.crop_image_from_bbox(imgp, bbox_partial, bbox, return_index=True,
-                        return_empty=return_empty, fillval=fillval)
+                        outsz = (outht, outwd, number_of_channels)
+                    imgout = np.full(outsz, fillval, dtype=dtype)
+            elif return_index:
+                imgout = None, None
+            else:
+                imgout = None
+        elif any(item not in self._get_cached_dict(imgpath) for item in hits):
+            # has missing blocks from cache, need to read image anyway
+            imgout = self._crop_from_one_image_without_cache(bbox, imgpath, return_empty=return_empty, return_index=return_index, **kwargs)
+        else:
+            # read from cache
+            if return_index:
+                px_max, py_max, px_min, py_min  = bbox_img
+                for bbox_blk in hits.values():
+                    tx_min, ty_min, tx_max, ty_max = [int(s) for s in bbox_blk]
+                    px_min = min(px_min, tx_min)
+                    py_min = min(py_min, ty_min)
+                    px_max = max(px_max, tx_max)
+                    py_max = max(py_max, ty_max)
+                bbox_partial = (px_min, py_min, px_max, py_max)
+            else:
+                bbox_partial = bbox
+            initialized = False
+            cache_dict = self._get_cached_dict(imgpath)
+            for blkid, blkbbox in hits.items():
+                blkbbox = [int(s) for s in blkbbox]
+                blk = cache_dict[blkid]
+                if blk is None:
+                    continue
+                if not initialized:
+                    imgp = common.crop_image_from_bbox(blk, blkbbox, bbox_partial,
+                        return_index=False, return_empty=True, fillval=fillval)
+                    initialized = True
                 else:
-                    imgout = imgp
+                    blkt, indx =  common.crop_image_from_bbox(blk, blkbbox, bbox_partial,
+                        return_index=True, return_empty=False, fillval=fillval)
+                    if indx is not None and blkt is not None:
+                        imgp[indx] = blkt
+            if return_index:
+                imgout = common.crop_image_from_bbox(imgp, bbox_partial, bbox, return_index=True,
+                    return_empty=return_empty, fillval=fillval)
+            else:
+                imgout = imgp
         return imgout
 
 
@@ -331,6 +375,9 @@ class AbstractImageLoader(ABC):
         if cache_settings:
             out['cache_size'] = self._cache_size
             out['cache_type'] = self._cache_type
+            if self._disk_cache_dir is not None:
+                out['disk_cache_dir'] = self._disk_cache_dir
+                out['disk_cache_capacity'] = self._disk_cache_capacity
             if self._tile_divider_type == 'border':
                 out['cache_border_margin'] = self._cache_border_margin
             elif self._tile_divider_type == 'block':
@@ -385,14 +432,71 @@ class AbstractImageLoader(ABC):
             settings['cache_block_size'] = json_obj['cache_block_size']
         if 'tf_lut' in json_obj:
             settings['tf_lut'] = json_obj['tf_lut']
+        if 'disk_cache_dir' in json_obj:
+            settings['disk_cache_dir'] = json_obj['disk_cache_dir']
+        if 'disk_cache_capacity' in json_obj:
+            settings['disk_cache_capacity'] = json_obj['disk_cache_capacity']
         return settings, json_obj
 
 
+    @property
+    def disk_cache(self):
+        if self._disk_cache_dir is None:
+            return None
+        return caching.get_disk_cache(self._disk_cache_dir, maxbytes=self._disk_cache_capacity)
+
+
+    def _disk_cache_key(self, imgpath, **kwargs):
+        number_of_channels = kwargs.get('number_of_channels', self._number_of_channels)
+        dtype = kwargs.get('dtype', self._dtype)
+        apply_CLAHE = kwargs.get('apply_CLAHE', self._apply_CLAHE)
+        inverse = kwargs.get('inverse', self._inverse)
+        driver, fname = parse_file_driver(imgpath)
+        if driver == 'file':
+            st = os.stat(fname)
+            file_stamp = (st.st_size, st.st_mtime_ns)
+        else:
+            file_stamp = None
+        if dtype is not None:
+            dtype = np.dtype(dtype).str
+        if apply_CLAHE:
+            clahe_settings = self._clahe_clip_limit
+        else:
+            clahe_settings = None
+        if len(self.tf_lut) > 0:
+            tf_lut = json.dumps(self._tf_lut, sort_keys=True, default=str)
+        else:
+            tf_lut = None
+        if self._preprocess is not None:
+            preprocess = (common.func_to_str(self._preprocess_factory),
+                          json.dumps(self._preprocess_parames, sort_keys=True, default=str))
+        else:
+            preprocess = None
+        return (imgpath, file_stamp, number_of_channels, dtype, clahe_settings,
+                tf_lut, preprocess, inverse)
+
+
     def _read_image(self, imgpath, **kwargs):
+        disk_cache = self.disk_cache
+        if disk_cache is not None:
+            key = self._disk_cache_key(imgpath, **kwargs)
+            img = disk_cache.get(key)
+            if img is not None:
+                self._metrics['disk_cache_hits'] += 1
+                return img
+            self._metrics['disk_cache_misses'] += 1
+        img = self._decode_image(imgpath, **kwargs)
+        if disk_cache is not None:
+            disk_cache[key] = img
+        return img
+
+
+    def _decode_image(self, imgpath, **kwargs):
         number_of_channels = kwargs.get('number_of_channels', self._number_of_channels)
         dtype = kwargs.get('dtype', self._dtype)
         apply_CLAHE = kwargs.get('apply_CLAHE', self._apply_CLAHE)
         inverse = kwargs.get('inverse', self._inverse)
+        t0 = time.perf_counter()
         if (number_of_channels == 3) and (np.dtype(dtype) == np.uint8):
             img = common.imread(imgpath, flag=cv2.IMREAD_COLOR)
         elif (number_of_channels == 1) and np.dtype(dtype) == np.uint8:
@@ -402,6 +506,10 @@ class AbstractImageLoader(ABC):
         self._read_counter += 1
         if img is None:
             raise RuntimeError(f'Image file {imgpath} not valid!')
+        t1 = time.perf_counter()
+        self._metrics['images_decoded'] += 1
+        self._metrics['bytes_decoded'] += img.nbytes
+        self._metrics['time_imread'] += t1 - t0
         if dtype is None:
             dtype = img.dtype
         while (len(img.shape) > 2) and (img.shape[-1] == 1):
@@ -429,6 +537,7 @@ class AbstractImageLoader(ABC):
                 img[mask_t] = val_t
                 img = img.clip(np.iinfo(dtype).min, np.iinfo(dtype).max)
             img = img.astype(dtype)
+        t2 = time.perf_counter()
         if apply_CLAHE:
             if (len(img.shape) > 2) and (img.shape[-1] == 3):
                 img = cv2.cvtColor(img, cv2.COLOR_RGB2Lab)
@@ -436,8 +545,13 @@ class AbstractImageLoader(ABC):
                 img = cv2.cvtColor(img, cv2.COLOR_Lab2RGB)
             else:
                 img = self._CLAHE.apply(img)
+        t3 = time.perf_counter()
         if self._preprocess is not None:
             img = self._preprocess(img)
+        t4 = time.perf_counter()
+        self._metrics['time_convert'] += t2 - t1
+        self._metrics['time_CLAHE'] += t3 - t2
+        self._metrics['time_preprocess'] += t4 - t3
         if inverse:
             img = common.inverse_image(img, dtype)
         if (img.dtype == np.uint16) and (np.dtype(dtype) == np.uint8):
@@ -541,9 +655,15 @@ class DynamicImageLoader(AbstractImageLoader):
         # self._cache[imgpath] = ((0, 0, imgwd, imght), cache_dict{blkid: tile})
         if not self._use_cache:
             return
+        cached = None
         if imgpath in self._cache:
-            cache_dict = self._cache[imgpath]
-            bbox_img = cache_dict[0]
+            try:
+                cached = self._cache[imgpath]
+            except KeyError:
+                # evicted by another thread sharing the cache
+                pass
+        if cached is not None:
+            bbox_img, cache_dict = cached
             x0, y0, x1, y1 = bbox_img
             imgwd = x1 - x0
             imght = y1 - y0
@@ -707,10 +827,13 @@ class StaticImageLoader(AbstractImageLoader):
             if fileid == -1:
                 image_not_in_list = '{} not in the image loader list'.format(filepath)
                 raise KeyError(image_not_in_list)
+        cache_dict = {}
         if fileid in self._cache:
-            cache_dict = self._cache[fileid]
-        else:
-            cache_dict = {}
+            try:
+                cache_dict = self._cache[fileid]
+            except KeyError:
+                # evicted by another thread sharing the cache
+                pass
         new_cache = False
         divider = self.divider(fileid)
         for bid, blkbbox in divider.items():
@@ -723,7 +846,7 @@ class StaticImageLoader(AbstractImageLoader):
                 cache_dict[bid] = blk
                 new_cache = True
         if new_cache:
-            self._cache[fileid] = cache_dict
+            self._cache.update_item(fileid, cache_dict)
 
 
     def _export_dict(self, output_controls=True, cache_settings=True, image_list=True):
@@ -1444,6 +1567,41 @@ class TensorStoreWriter(TensorStoreLoader):
                 raise TimeoutError
 
 
+    def write_chunks_async(self, bboxes, imgs):
+        """
+        stage the chunks in a transaction and start committing it without
+        waiting for the result, so that the caller can keep working while the
+        data are being written.
+        Return:
+            commit: handle of the pending commit to pass to finish_commit.
+        """
+        txn = ts.Transaction()
+        for bbox, img in zip(bboxes, imgs):
+            self.write_single_chunk(bbox, img, txn=txn)
+        return txn.commit_async(), txn
+
+
+    def finish_commit(self, commit, bboxes, imgs):
+        """
+        wait for a commit started by write_chunks_async. If it got aborted, fall
+        back to writing the chunks synchronously with retries. A commit already
+        started cannot be aborted, so the chunks are only rewritten after it
+        settled, otherwise a late completion could overwrite the new data.
+        """
+        future, txn = commit
+        for _ in range(TS_RETRY+1):
+            try:
+                future.result(timeout=TS_TIMEOUT)
+                break
+            except TimeoutError:
+                continue
+        else:
+            raise TimeoutError
+        if txn.aborted:
+            self.reconnect()
+            self.write_chunks_w_transaction(bboxes, imgs)
+
+
     @property
     def write_grids(self):
         if (not hasattr(self, '_write_grids')) or (self._write_grids is None):
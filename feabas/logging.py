@@ -1,3 +1,5 @@
+from collections import Counter
+import json
 import logging
 import logging.handlers
 import os
@@ -65,6 +67,71 @@ class QueueHandler(logging.handlers.QueueHandler):
             self.queue.put(record)
 
 
+METRICS_ATTR = 'feabas_metrics'
+
+
+def _is_not_metrics(record):
+    return not hasattr(record, METRICS_ATTR)
+
+
+class MetricsHandler(logging.Handler):
+    """
+    Aggregate (by summation) the numeric metrics reported by report_metrics
+    from all the workers of a stage, and save the totals as JSON and CSV files
+    in the metrics folder next to the logs when the logger is shut down.
+    """
+    def __init__(self, filename_prefix):
+        super().__init__(level=logging.INFO)
+        self._prefix = filename_prefix
+        self._totals = Counter()
+        self._num_reports = 0
+        self.addFilter(lambda record: hasattr(record, METRICS_ATTR))
+
+    def emit(self, record):
+        self._num_reports += 1
+        for key, val in getattr(record, METRICS_ATTR).items():
+            if isinstance(val, (int, float)) and not isinstance(val, bool):
+                self._totals[key] += val
+
+    def summary(self):
+        out = {'number_of_reports': self._num_reports}
+        out.update(sorted(self._totals.items()))
+        for prefix in ('cache_', 'disk_cache_'):
+            hits = self._totals.get(prefix + 'hits', 0)
+            misses = self._totals.get(prefix + 'misses', 0)
+            if hits + misses > 0:
+                out[prefix + 'hit_rate'] = hits / (hits + misses)
+        return out
+
+    def close(self):
+        if self._num_reports > 0:
+            summary = self.summary()
+            try:
+                storage.makedirs(os.path.dirname(self._prefix))
+                with storage.File(self._prefix + '.json', 'w') as f:
+                    json.dump(summary, f, indent=2)
+                with storage.File(self._prefix + '.csv', 'w') as f:
+                    f.write('metric,value\n')
+                    for key, val in summary.items():
+                        f.write(f'{key},{val}\n')
+            except OSError:
+                pass
+            self._num_reports = 0
+            self._totals.clear()
+        super().close()
+
+
+def report_metrics(logger, metrics):
+    """
+    send a dict of numeric metrics (e.g. from AbstractImageLoader.metrics) to
+    the main logger, where they are summed over all the reports of the stage.
+    Args:
+        logger(logging.Logger): the logger from get_logger.
+        metrics(dict): metric name -> number.
+    """
+    logger.info('metrics', extra={METRICS_ATTR: dict(metrics)})
+
+
 def get_main_logger(logger_name):
     main_logger = logging.getLogger(logger_name)
     main_logger.setLevel(logging.WARNING)
@@ -72,32 +139,36 @@ def get_main_logger(logger_name):
     logger_prefix = logger_name.replace('.', '_')
     formatter = logging.Formatter(fmt='%(asctime)s-%(levelname)s: %(message)s',
                                 datefmt='%Y-%m-%d %H:%M:%S')
+    import socket
+    hostname = socket.gethostname()
+    hostname = hostname.split('.')[0]
+    file_prefix = _time_stamp + '_' + hostname + '_' + logger_prefix
+    metrics_prefix = storage.join_paths(log_dir, 'metrics', file_prefix + '_metrics')
+    metrics_handler = MetricsHandler(metrics_prefix)
+    main_logger.setLevel(min(main_logger.level, metrics_handler.level))
+    main_logger.addHandler(metrics_handler)
     if log_conf['console_level'] is not None:
-        main_logger.setLevel(logging.DEBUG)
+        main_logger.setLevel(min(main_logger.level, log_conf['console_level']))
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
         console_handler.setLevel(log_conf['console_level'])
+        console_handler.addFilter(_is_not_metrics)
         main_logger.addHandler(console_handler)
     if log_conf['archive_level'] is not None:
-        main_logger.setLevel(logging.DEBUG)
+        main_logger.setLevel(min(main_logger.level, log_conf['archive_level']))
         archive_dir = storage.join_paths(log_dir, 'archive')
-        import socket
-        hostname = socket.gethostname()
-        hostname = hostname.split('.')[0]
-        archivefile = storage.join_paths(archive_dir, _time_stamp + '_' + hostname + '_' + logger_prefix + '.log')
+        archivefile = storage.join_paths(archive_dir, file_prefix + '.log')
         archive_handler = FileHandler(archivefile, mode='a', delay=True)
         archive_handler.setFormatter(formatter)
         archive_handler.setLevel(log_conf['archive_level'])
+        archive_handler.addFilter(_is_not_metrics)
         main_logger.addHandler(archive_handler)
     if log_conf['logfile_level'] is not None:
-        main_logger.setLevel(logging.DEBUG)
-        import socket
-        hostname = socket.gethostname()
-        hostname = hostname.split('.')[0]
-        warnfile = storage.join_paths(log_dir, _time_stamp + '_' + hostname + '_' + logger_prefix + '.log')
+        warnfile = storage.join_paths(log_dir, file_prefix + '.log')
         warn_handler = FileHandler(warnfile, mode='a', delay=True)
         warn_handler.setFormatter(formatter)
         warn_handler.setLevel(logging.WARNING)
+        warn_handler.addFilter(_is_not_metrics)
         main_logger.addHandler(warn_handler)
     return main_logger
 
@@ -134,6 +205,7 @@ def get_logger(logger_info):
         logger.setLevel(logging.INFO)
         handler = logging.StreamHandler()
         handler.setFormatter(logging.Formatter('%(asctime)s-%(levelname)s: %(message)s'))
+        handler.addFilter(_is_not_metrics)
         logger.addHandler(handler)
     else:
         logger = logging.Logger('worker')
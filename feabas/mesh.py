@@ -4,7 +4,6 @@ import cv2
 import gc
 import h5py
 import inspect
-import matplotlib.tri
 import numpy as np
 from rtree import index
 from scipy.interpolate import interp1d
@@ -2011,12 +2010,12 @@ class Mesh:
 
     @config_cache('TBD')
     def tri_info(self, gear=None, tri_mask=None, include_flipped=False, contigeous=True, asymmetry=True):
-        # return geometry STRtree, matplotlib tri list, global index list and border segment STRtree
+        # return geometry STRtree, triangle rasterizer list, global index list and border segment STRtree
         if gear is None:
             gear = self._current_gear
         groupings = self.nonoverlap_triangle_groups(gear=gear, contigeous=contigeous, include_flipped=include_flipped, tri_mask=tri_mask, asymmetry=asymmetry)
         geometry_list = []
-        mattri_list = []
+        rasterizer_list = []
         tindex_list = []
         vindex_list = []
         segs = []
@@ -2027,8 +2026,8 @@ class Mesh:
             if not np.any(g_mask):
                 continue
             geometry_list.append(self.shapely_regions(gear=gear, tri_mask=g_mask, offsetting=False))
-            mpl_tri, v_indx, _ = self.mpl_tri(gear=gear, tri_mask=g_mask)
-            mattri_list.append(mpl_tri)
+            rstr, v_indx, _ = self.rasterizer(gear=gear, tri_mask=g_mask)
+            rasterizer_list.append(rstr)
             tindex_list.append(np.nonzero(g_mask)[0])
             vindex_list.append(v_indx)
             seg0, seg_tid0 = self.segments_w_triangle_ids(tri_mask=g_mask)
@@ -2040,19 +2039,27 @@ class Mesh:
         vertices = self.vertices(gear=gear)
         lines = shpgeo.MultiLineString(list(vertices[segs]))
         seg_tree = shapely.STRtree(shapely.get_parts(lines))
-        tri_info = {'region_tree': region_tree, 'matplotlib_tri': mattri_list,
+        tri_info = {'region_tree': region_tree, 'rasterizer': rasterizer_list,
             'triangle_index': tindex_list, 'vertex_index': vindex_list,
             'segment_tree': seg_tree, 'segment_tid': seg_tids}
         return tri_info
 
 
     def mpl_tri(self, gear=None, tri_mask=None):
+        import matplotlib.tri
         v_indx, new_T = self._filter_triangles(tri_mask)
         vertices = self.vertices(gear=gear)[v_indx]
         mpl_tri = matplotlib.tri.Triangulation(vertices[:,0], vertices[:,1], triangles=new_T)
         return mpl_tri, v_indx, new_T
 
 
+    def rasterizer(self, gear=None, tri_mask=None, **kwargs):
+        v_indx, new_T = self._filter_triangles(tri_mask)
+        vertices = self.vertices(gear=gear)[v_indx]
+        rstr = spatial.TriangleRasterizer(vertices, new_T, **kwargs)
+        return rstr, v_indx, new_T
+
+
     @config_cache('TBD')
     def triangle_collisions(self, gear=None, tri_mask=None):
         return self.find_triangle_overlaps(gear=gear, tri_mask=tri_mask)
@@ -2094,70 +2101,42 @@ class Mesh:
             gear = self._current_gear
         tri_info = self.tri_info(gear=gear, tri_mask=tri_mask, include_flipped=include_flipped, contigeous=contigeous, cache=inner_cache, asymmetry=asymmetry)
         tree = tri_info['region_tree']
-        mattri_list = tri_info['matplotlib_tri']
+        rasterizer_list = tri_info['rasterizer']
         index_list = tri_info['triangle_index']
         seg_tree = tri_info['segment_tree']
         seg_tids = tri_info['segment_tid']
         pts = (pts - self.offset(gear=gear)).reshape(-1,2)
-        if len(mattri_list) > 1:
-            mpts = shpgeo.MultiPoint(pts)
-            pts_list = list(mpts.geoms)
-            hits = tree.query(pts_list, predicate='intersects')
-        else:
-            hits = np.tile(np.arange(pts.shape[0]), (2,1))
-            hits[1] *= 0
         tid_out = np.full(pts.shape[0], -1, dtype=self.triangles.dtype)
-        if hits.size == 0:
-            return tid_out
-        hits_gidx_u = np.unique(hits[1])
-        tri_finders = {k: m.get_trifinder() for k, m in enumerate(mattri_list) if k in hits_gidx_u}
-        if len(mattri_list) > 1:
-            uhits, uidx, cnts = np.unique(hits[0], return_index=True, return_counts=True)
-            conflict = np.any(cnts > 1)
-            if conflict:
-                if mode == const.MESH_TRIFINDER_WHATEVER:
-                    hits = hits[:, uidx]
-                    conflict = False
-                elif mode == const.MESH_TRIFINDER_INNERMOST:
-                    conflict_pts_indices = uhits[cnts > 1]
-                    for pt_idx in conflict_pts_indices:
-                        pmask = hits[0] == pt_idx
-                        geo_indices = hits[1, pmask]
-                        mxdis = -1
-                        g_sel = geo_indices[0]
-                        for g in geo_indices:
-                            dis0 = tree.geometries[g].boundary.distance(pts_list[pt_idx])
-                            if dis0 >= mxdis:
-                                g_sel = g
-                                mxdis = dis0
-                        hits[1, pmask] = g_sel
-                    hits = hits[:, uidx]
-                    conflict = False
-        else:
-            conflict = False
-        hits_pidx = hits[0]
-        hits_gidx = hits[1]
         pts_indices = []
         tri_indices = []
-        for gindx in np.unique(hits_gidx):
-            pidx = hits_pidx[hits_gidx == gindx]
-            pxy = pts[pidx]
-            tid0 = tri_finders[gindx](pxy[:,0], pxy[:,1])
-            pts_indices.append(pidx[tid0 >= 0])
-            tri_indices.append(index_list[gindx][tid0[tid0 >= 0]])
+        grp_indices = []
+        for gindx, rstr in enumerate(rasterizer_list):
+            tid0 = rstr.find(pts[:,0], pts[:,1])
+            pidx = np.nonzero(tid0 >= 0)[0]
+            pts_indices.append(pidx)
+            tri_indices.append(index_list[gindx][tid0[pidx]])
+            grp_indices.append(np.full(pidx.size, gindx))
         pts_indices = np.concatenate(pts_indices, axis=0)
         tri_indices = np.concatenate(tri_indices, axis=0)
-        if conflict:
-            if mode == const.MESH_TRIFINDER_LEAST_DEFORM:
+        grp_indices = np.concatenate(grp_indices, axis=0)
+        _, cnts = np.unique(pts_indices, return_counts=True)
+        if np.any(cnts > 1):
+            # resolve points located in multiple groups
+            if mode == const.MESH_TRIFINDER_WHATEVER:
+                idxt = np.arange(pts_indices.size)
+            elif mode == const.MESH_TRIFINDER_INNERMOST:
+                boundaries = shapely.boundary(np.array(tree.geometries)[grp_indices])
+                dis = shapely.distance(boundaries, shapely.points(pts[pts_indices]))
+                idxt = np.argsort(-dis, kind='stable')
+            elif mode == const.MESH_TRIFINDER_LEAST_DEFORM:
                 deforms0 = self.triangle_tform_deform(gear=(const.MESH_GEAR_INITIAL, gear), tri_mask=None)
-                deforms = deforms0[tri_indices]
-                idxt = np.argsort(deforms)
-                pts_indices = pts_indices[idxt]
-                tri_indices = tri_indices[idxt]
-                pts_indices, uidx = np.unique(pts_indices, return_index=True)
-                tri_indices = tri_indices[uidx]
+                idxt = np.argsort(deforms0[tri_indices], kind='stable')
             else:
                 raise ValueError("Mesh tri_finder conflict resolution mode not implemented")
+            pts_indices = pts_indices[idxt]
+            tri_indices = tri_indices[idxt]
+            pts_indices, uidx = np.unique(pts_indices, return_index=True)
+            tri_indices = tri_indices[uidx]
         tid_out[pts_indices] = tri_indices
         if extrapolate and np.any(tid_out == -1):
             mepts = shpgeo.MultiPoint(pts[tid_out == -1])
@@ -2472,6 +2451,7 @@ class Mesh:
     def is_valid_legacy(self, gear=None, tri_mask=None):
         if gear is None:
             gear = self._current_gear
+        import matplotlib.tri
         vertices = self.vertices(gear=gear)
         if Mesh._masked_all(tri_mask):
             T = self.triangles
@@ -2988,6 +2968,34 @@ class Mesh:
         return shape_matrices
 
 
+    @config_cache(const.MESH_GEAR_INITIAL)
+    def element_assembly_map(self):
+        """
+        symbolic assembly of the element stiffness matrices. Only depends on the
+        mesh topology, so that the stiffness matrices at different vertex
+        positions can be assembled by summing the element entries into the
+        precomputed data slots, without building & sorting the COO triplets.
+        Return:
+            indptr, indices: CSR structure of the (2*num_vertices)^2 matrix.
+            slots (num_triangles x 36 ndarray): the data slots the entries of
+                the element matrices K[t].ravel() are added to, with K[t][a,b]
+                going to row 2*T[t,b//2]+b%2, column 2*T[t,a//2]+a%2.
+        """
+        num_dof = self.num_vertices * 2
+        T = np.repeat(self.triangles.astype(np.int64) * 2, 2, axis=-1)
+        T[:,1::2] += 1
+        keys = T.reshape(-1, 1, 6) * num_dof + T.reshape(-1, 6, 1)
+        uniq, slots = np.unique(keys.ravel(), return_inverse=True)
+        if max(uniq.size, num_dof) < np.iinfo(np.int32).max:
+            idx_dtype = np.int32
+        else:
+            idx_dtype = np.int64
+        indices = (uniq % num_dof).astype(idx_dtype)
+        indptr = np.zeros(num_dof + 1, dtype=idx_dtype)
+        indptr[1:] = np.cumsum(np.bincount(uniq // num_dof, minlength=num_dof))
+        return indptr, indices, slots.reshape(-1, 36).astype(idx_dtype)
+
+
     @config_cache('TBD')
     def nonengineering_stiffness_matrix(self, gear=(const.MESH_GEAR_FIXED, const.MESH_GEAR_MOVING), inner_cache=None):
         """
@@ -3004,9 +3012,6 @@ class Mesh:
         shape_matrices = self.nonengineering_element_stiffness_shape_matrices(gear=gear[0], cache=inner_cache)
         if len(shape_matrices) == 0:
             return STIFF_M, STRESS_v
-        material_table = self._material_table.id_table
-        multiplier = self.stiffness_multiplier
-        tri_areas = None
         T = np.repeat(self.triangles * 2, 2, axis=-1)
         T[:,1::2] += 1
         v0 = self.vertices(gear=gear[0])
@@ -3015,6 +3020,8 @@ class Mesh:
         material_table = self._material_table.id_table
         multiplier = self.stiffness_multiplier
         tri_areas = None
+        element_slots = []
+        element_values = []
         for mid, vals in shape_matrices.items():
             mat = material_table[mid]
             indx, Ms = vals
@@ -3039,18 +3046,16 @@ class Mesh:
             if K is None:
                 continue
             mm = multiplier[indx].reshape(-1,1,1) * modifier
-            idx_1d = T[indx]
-            idx_1 = np.tile(idx_1d.reshape(-1,1,6), (1,6,1))
-            idx_2 = np.swapaxes(idx_1, 1, 2)
-            idx_1 = idx_1.ravel()
-            idx_2 = idx_2.ravel()
-            V = (K * mm) .ravel()
-            M = sparse.csr_matrix((V, (idx_1, idx_2)),shape=(num_dof, num_dof))
-            if STIFF_M is None:
-                STIFF_M = M
-            else:
-                STIFF_M = STIFF_M + M
-            np.add.at(STRESS_v, idx_1d.ravel(), (P * mm).ravel())
+            element_slots.append(indx)
+            element_values.append((K * mm).ravel())
+            STRESS_v += np.bincount(T[indx].ravel(), weights=(P * mm).ravel(), minlength=num_dof).astype(np.float32)
+        if len(element_values) > 0:
+            indptr, indices, slots = self.element_assembly_map(cache=inner_cache)
+            element_slots = slots[np.concatenate(element_slots)].ravel()
+            element_values = np.concatenate(element_values)
+            data = np.bincount(element_slots, weights=element_values, minlength=indices.size)
+            STIFF_M = sparse.csr_matrix((data.astype(element_values.dtype, copy=False), indices, indptr),
+                                        shape=(num_dof, num_dof))
         return STIFF_M, STRESS_v
 
 
@@ -108,7 +108,6 @@ def mip_one_level(src_dir, out_dir, **kwargs):
         prefix = storage.join_paths(out_dir, prefix0)
         out_root_dir = os.path.dirname(prefix)
         storage.makedirs(out_root_dir, exist_ok=True)
-        kwargs.setdefault('seeds', downsample)
         kwargs.setdefault('mx_dis', (tile_size[0]/2+4, tile_size[-1]/2+4))
         rendered = render_whole_mesh(M, image_loader, prefix, tile_size=tile_size,
                                      pattern=pattern+'.'+ext_out, scale= 1/downsample,
@@ -181,13 +180,9 @@ def create_thumbnail(src_dir, outname=None, downsample=4, highpass=True, **kwarg
     if image_loader is None:
         return None
     M = _mesh_from_image_loader(image_loader)
-    bounds0 = M.bbox()
     for bbox in image_loader.file_bboxes(margin=0):
         tile_size0 = (bbox[3] - bbox[1], bbox[2] - bbox[0])
         break
-    n_col = round(bounds0[2] / tile_size0[1])
-    n_row = round(bounds0[3] / tile_size0[0])
-    kwargs.setdefault('seeds', (n_row, n_col))
     kwargs.setdefault('mx_dis', (tile_size0[0]/2+4, tile_size0[-1]/2+4))
     M.change_resolution(image_loader.resolution * downsample)
     bounds1 = M.bbox()
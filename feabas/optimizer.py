@@ -503,6 +503,7 @@ class SLM:
             self._stiffness_lambda = kwargs.get('stiffness_lambda', 1.0)
         self._crosslink_lambda = kwargs.get('crosslink_lambda', -1.0)
         self._shared_cache = kwargs.get('shared_cache', None)
+        self._matrix_free_crosslinks = kwargs.get('matrix_free_crosslinks', False)
         self.clear_cached_attr()
 
 
@@ -514,8 +515,10 @@ class SLM:
         self._linkage_adjacency = None
         self._connected_subsystems = None
         self._stiffness_matrix = None
+        self._stiffness_layout = None
         self._crosslink_terms = None
         self._crosslink_shape = None
+        self._amg_preconditioner = None
         if instant_gc:
             gc.collect()
 
@@ -544,8 +547,10 @@ class SLM:
         self._linkage_adjacency = None
         self._connected_subsystems = None
         self._stiffness_matrix = None
+        self._stiffness_layout = None
         self._crosslink_terms = None
         self._crosslink_shape = None
+        self._amg_preconditioner = None
         if instant_gc:
             gc.collect()
 
@@ -812,15 +817,17 @@ class SLM:
         if (self._stiffness_matrix is None) or force_update:
             STIFF_M = []
             STRESS_v = []
+            soft_factors = []
             for m in self.meshes:
                 if m.locked:
                     continue
                 stiff, stress = m.stiffness_matrix(gear=gear, **kwargs)
                 if stiff is None:
                     return None, None
-                STIFF_M.append(stiff * m.soft_factor)
+                STIFF_M.append(stiff.tocsr())
+                soft_factors.append(m.soft_factor)
                 STRESS_v.append(stress * m.soft_factor)
-            stiffness_matrix = sparse.block_diag(STIFF_M, format='csr')
+            stiffness_matrix = self._block_diag_stiffness(STIFF_M, soft_factors)
             stress_vector = np.concatenate(STRESS_v, axis=None)
             if to_cache:
                 self._stiffness_matrix = (stiffness_matrix, stress_vector)
@@ -829,9 +836,47 @@ class SLM:
             return self._stiffness_matrix
 
 
+    def _block_diag_stiffness(self, blocks, multipliers):
+        """
+        assemble the block-diagonal system stiffness matrix from the CSR
+        matrices of the meshes scaled by multipliers. The CSR structure of the
+        system is only rebuilt when that of the blocks changes: when the meshes
+        reuse their sparsity patterns across Newton steps (see
+        Mesh.element_assembly_map), only the data arrays are concatenated.
+        """
+        # the blocks sharing a cached pattern hold new views of its buffers, so
+        # compare the buffer addresses. The layout keeps the buffers alive so
+        # that their addresses cannot be reused by other arrays.
+        patterns = [(blk.indptr, blk.indices) for blk in blocks]
+        pattern_keys = [tuple((arr.__array_interface__['data'][0], arr.size) for arr in ptn) for ptn in patterns]
+        layout = self._stiffness_layout
+        if (layout is None) or (layout[0] != pattern_keys):
+            num_rows = np.array([blk.shape[0] for blk in blocks], dtype=np.int64)
+            num_cols = np.array([blk.shape[1] for blk in blocks], dtype=np.int64)
+            nnz = np.array([blk.indptr[-1] for blk in blocks], dtype=np.int64)
+            col_offsets = np.cumsum(num_cols) - num_cols
+            nnz_offsets = np.cumsum(nnz) - nnz
+            if max(np.sum(nnz), np.sum(num_cols)) < np.iinfo(np.int32).max:
+                idx_dtype = np.int32
+            else:
+                idx_dtype = np.int64
+            indptr = [(blk.indptr[:-1] + nz0).astype(idx_dtype) for blk, nz0 in zip(blocks, nnz_offsets)]
+            indptr.append(np.array([np.sum(nnz)], dtype=idx_dtype))
+            indptr = np.concatenate(indptr)
+            indices = np.concatenate([(blk.indices[:nz] + c0).astype(idx_dtype) for blk, nz, c0 in zip(blocks, nnz, col_offsets)])
+            shape = (int(np.sum(num_rows)), int(np.sum(num_cols)))
+            layout = (pattern_keys, patterns, indices, indptr, shape)
+            self._stiffness_layout = layout
+        _, _, indices, indptr, shape = layout
+        data = np.concatenate([blk.data[:blk.indptr[-1]] * mlt for blk, mlt in zip(blocks, multipliers)])
+        return sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+
     def crosslink_terms(self,  force_update=False, to_cache=True, **kwargs):
         """
         compute the terms associated with the links in the assembled equation.
+        If the system is initialized with matrix_free_crosslinks, the left-hand
+        side is returned as a CrosslinkOperator instead of a sparse matrix.
         Kwargs:
             start_gear: gear that associated with the vertices before applying
                 the displacement
@@ -856,10 +901,13 @@ class SLM:
                 m_rht[idx_t, :] = dxy
                 weights[idx_t] = wt
                 crnt_pos += wt.size
-            D = sparse.diags(weights, shape=(num_pts, num_pts))
-            Clft_x = (shpmat_x.T @ D @ shpmat_x).T
-            Clft_y = sparse.csr_matrix((Clft_x.data, Clft_x.indices+1, np.insert(Clft_x.indptr[:-1],0,0)), shape=Clft_x.shape)
-            Cs_lft = Clft_x + Clft_y
+            if self._matrix_free_crosslinks:
+                Cs_lft = CrosslinkOperator(shpmat_x, weights)
+            else:
+                D = sparse.diags(weights, shape=(num_pts, num_pts))
+                Clft_x = (shpmat_x.T @ D @ shpmat_x).T
+                Clft_y = sparse.csr_matrix((Clft_x.data, Clft_x.indices+1, np.insert(Clft_x.indptr[:-1],0,0)), shape=Clft_x.shape)
+                Cs_lft = Clft_x + Clft_y
             Cs_rht = shpmat_x.T.dot(weights*m_rht[:,0])
             Crht_y = shpmat_x.T.dot(weights*m_rht[:,1])
             Cs_rht[1:] = Cs_rht[1:] + Crht_y[0:-1]
@@ -1406,7 +1454,10 @@ class SLM:
                 T_m = sparse.csr_matrix((np.ones_like(indx0, dtype=np.float32),
                                         (indx1, indx0)), shape=(grouped_dof, stiff_m.shape[0]))
                 stiff_m = T_m @ stiff_m @ T_m.transpose() / np.mean(g_cnt)
-                Cs_lft = T_m @ Cs_lft @ T_m.transpose() / np.mean(g_cnt)
+                if isinstance(Cs_lft, CrosslinkOperator):
+                    Cs_lft = Cs_lft.project(T_m / np.sqrt(np.mean(g_cnt)))
+                else:
+                    Cs_lft = T_m @ Cs_lft @ T_m.transpose() / np.mean(g_cnt)
                 stress_v = T_m @ stress_v / np.mean(g_cnt)
                 Cs_rht = T_m @ Cs_rht / np.mean(g_cnt)
                 if edc is not None:
@@ -1414,9 +1465,12 @@ class SLM:
             else:
                 groupings = None
         stiffness_lambda, crosslink_lambda = self.relative_lambda_trace(stiffness_lambda, crosslink_lambda)
-        A = stiffness_lambda * stiff_m + crosslink_lambda * Cs_lft
+        if isinstance(Cs_lft, CrosslinkOperator):
+            A = Cs_lft.combine(explicit=stiffness_lambda * stiff_m, crosslink_lambda=crosslink_lambda)
+        else:
+            A = stiffness_lambda * stiff_m + crosslink_lambda * Cs_lft
         b = crosslink_lambda * Cs_rht - stiffness_lambda * stress_v
-        dd = solve(A, b, solver, tol=tol, maxiter=maxiter, check_converge=check_converge, atol=atol, M=M, extra_dof_constraint=edc, tolerated_perturbation=tolerated_perturbation, **callback_settings)
+        dd = solve(A, b, solver, tol=tol, maxiter=maxiter, check_converge=check_converge, atol=atol, M=M, extra_dof_constraint=edc, tolerated_perturbation=tolerated_perturbation, amg_cache=self.amg_preconditioner, **callback_settings)
         cost = (float(np.linalg.norm(b)), float(np.linalg.norm(A.dot(dd) - b)))
         if cost[1] < cost[0]:
             index_offsets = self.index_offsets
@@ -1564,6 +1618,8 @@ class SLM:
             stiff_m, _ = self._stiffness_matrix
             Cs_lft, _ = self._crosslink_terms
             nm_stiff = sparse.linalg.norm(stiff_m)
+            if isinstance(Cs_lft, CrosslinkOperator):
+                Cs_lft = Cs_lft.assemble()
             nm_cl = sparse.linalg.norm(Cs_lft)
             stiffness_lambda = abs(ratio * nm_cl / nm_stiff)
             crosslink_lambda = 1.0
@@ -1703,6 +1759,16 @@ class SLM:
         return self._connected_subsystems
 
 
+    @property
+    def amg_preconditioner(self):
+        """
+        smoothed aggregation hierarchy kept across the solves of this system.
+        """
+        if self._amg_preconditioner is None:
+            self._amg_preconditioner = AMGPreconditioner()
+        return self._amg_preconditioner
+
+
   ## ------------------------------ properties ----------------------------- ##
     @property
     def lock_flags(self):
@@ -1942,6 +2008,244 @@ class SLM_Callback:
         return False
 
 
+class CrosslinkOperator(LinearOperator):
+    """
+    matrix-free crosslink term of the system equation
+        C = Bx^T W Bx + S Bx^T W Bx S^T
+    where Bx is the crosslink shape matrix acting on the x-components of the
+    displacements, W the diagonal matrix of the link weights, and S shifts the
+    x-components to the y-components. The operator can be combined with an
+    explicitly assembled sparse matrix E and restricted by a projection P:
+        A = E + crosslink_lambda * P C P^T
+    Only the diagonal of C is assembled, so that the Jacobi or AMG
+    preconditioners can be built from E + diag(crosslink_lambda * P C P^T).
+    Args:
+        shape_matrix: the crosslink shape matrix Bx.
+        weights: the link weights of each row in the shape matrix.
+    Kwargs:
+        crosslink_lambda: multiplier of the crosslink term.
+        explicit: sparse matrix E added to the crosslink term.
+        projection: sparse matrix P to project the crosslink term.
+    """
+    def __init__(self, shape_matrix, weights, crosslink_lambda=1.0, explicit=None, projection=None):
+        self._shape_matrix = shape_matrix
+        self._weights = weights
+        self._crosslink_lambda = crosslink_lambda
+        self._explicit = explicit
+        self._projection = projection
+        self._crosslink_diagonal = None
+        if projection is None:
+            N = shape_matrix.shape[1]
+        else:
+            N = projection.shape[0]
+        super().__init__(dtype=np.float64, shape=(N, N))
+
+
+    def combine(self, explicit=None, crosslink_lambda=1.0):
+        """
+        return the operator explicit + crosslink_lambda * self.
+        """
+        if self._explicit is not None:
+            explicit0 = crosslink_lambda * self._explicit
+            if explicit is None:
+                explicit = explicit0
+            else:
+                explicit = explicit + explicit0
+        return CrosslinkOperator(self._shape_matrix, self._weights,
+            crosslink_lambda=crosslink_lambda*self._crosslink_lambda,
+            explicit=explicit, projection=self._projection)
+
+
+    def project(self, P):
+        """
+        return the operator P @ self @ P^T.
+        """
+        P = sparse.csr_matrix(P)
+        explicit = self._explicit
+        if explicit is not None:
+            explicit = P @ explicit @ P.T
+        if self._projection is None:
+            projection = P
+        else:
+            projection = P @ self._projection
+        return CrosslinkOperator(self._shape_matrix, self._weights,
+            crosslink_lambda=self._crosslink_lambda,
+            explicit=explicit, projection=projection)
+
+
+    def submatrix(self, mask):
+        """
+        return the operator restricted to the degrees of freedom in mask.
+        """
+        P = sparse.identity(self.shape[0], dtype=np.float32, format='csr')[mask]
+        return self.project(P)
+
+
+    def diagonal(self):
+        if self._crosslink_diagonal is None:
+            B = self._shape_matrix
+            w = self._weights.astype(np.float64)
+            if self._projection is None:
+                dg = B.multiply(B).T.dot(w)
+                dg[1:] = dg[1:] + dg[:-1]
+            else:
+                # diag(P C P^T) = sum_rows W (Bx Q)^2 for Q = P^T and S^T P^T,
+                # so that the cross terms between the merged dofs are kept
+                Pt = sparse.csr_matrix(self._projection.T)
+                Pt_s = sparse.vstack((Pt[1:], sparse.csr_matrix((1, Pt.shape[1]))), format='csr')
+                dg = np.zeros(Pt.shape[1], dtype=np.float64)
+                for Q in (Pt, Pt_s):
+                    BQ = sparse.csr_matrix(B @ Q)
+                    dg = dg + BQ.multiply(BQ).T.dot(w)
+            self._crosslink_diagonal = dg
+        dg = self._crosslink_lambda * self._crosslink_diagonal
+        if self._explicit is not None:
+            dg = dg + self._explicit.diagonal()
+        return dg
+
+
+    def trace(self):
+        return float(np.sum(self.diagonal()))
+
+
+    def sparse_approximation(self):
+        """
+        explicit part plus the diagonal of the crosslink term, used to build
+        the preconditioners.
+        """
+        dg = self.diagonal()
+        if self._explicit is not None:
+            dg = dg - self._explicit.diagonal()
+            return sparse.csr_matrix(self._explicit + sparse.diags(dg))
+        else:
+            return sparse.diags(dg, format='csr')
+
+
+    def assemble(self):
+        """
+        explicitly assemble the operator as a sparse matrix.
+        """
+        B = self._shape_matrix
+        D = sparse.diags(self._weights, shape=(B.shape[0], B.shape[0]))
+        Clft_x = (B.T @ D @ B).T
+        Clft_y = sparse.csr_matrix((Clft_x.data, Clft_x.indices+1, np.insert(Clft_x.indptr[:-1],0,0)), shape=Clft_x.shape)
+        C = Clft_x + Clft_y
+        if self._projection is not None:
+            C = self._projection @ C @ self._projection.T
+        C = self._crosslink_lambda * C
+        if self._explicit is not None:
+            C = C + self._explicit
+        return C
+
+
+    def _crosslink_matvec(self, x):
+        B = self._shape_matrix
+        w = self._weights
+        xx = np.zeros((x.size, 2), dtype=np.float64)
+        xx[:, 0] = x
+        xx[:-1, 1] = x[1:]
+        yy = B.T.dot(w.reshape(-1,1) * B.dot(xx))
+        y = yy[:, 0]
+        y[1:] = y[1:] + yy[:-1, 1]
+        return y
+
+
+    def _matvec(self, x):
+        x = np.ravel(x)
+        P = self._projection
+        if P is None:
+            y = self._crosslink_matvec(x)
+        else:
+            y = P.dot(self._crosslink_matvec(P.T.dot(x)))
+        y = self._crosslink_lambda * y
+        if self._explicit is not None:
+            y = y + self._explicit.dot(x)
+        return y
+
+
+    def _rmatvec(self, x):
+        return self._matvec(x)
+
+
+    def _adjoint(self):
+        return self
+
+
+
+class AMGPreconditioner:
+    """
+    smoothed aggregation preconditioner that is kept across solves. When the
+    new matrix has the same shape as the previous one, the aggregates of the
+    existing hierarchy are reused and only the prolongators and the coarse
+    operators are recomputed from the new values. The aggregation is redone
+    when the shape changes or when the measured convergence rate of the solves
+    with the refreshed hierarchy degrades.
+    Kwargs:
+        max_slowdown: rebuild the aggregation if the convergence rate per
+            iteration drops below the rate measured right after the last
+            rebuild divided by this factor.
+    """
+    def __init__(self, max_slowdown=2.0):
+        self._max_slowdown = max_slowdown
+        self._aggregates = None
+        self._shape = None
+        self._reference_rate = None
+        self._refreshed = False
+        self._stale = False
+
+
+    def preconditioner(self, A):
+        """
+        return the V-cycle preconditioner of matrix A as a LinearOperator.
+        """
+        solver_kwargs = {'presmoother': ('gauss_seidel', {'sweep': 'forward'}),
+                         'postsmoother': ('gauss_seidel', {'sweep': 'backward'}),
+                         'symmetry': 'symmetric',
+                         'smooth': ('jacobi', {'omega': 4.0/3.0}),
+                         'keep': True}
+        reuse = (not self._stale) and (self._aggregates is not None) and (A.shape == self._shape)
+        if reuse:
+            solver_kwargs.update({'strength': None, 'max_levels': len(self._aggregates) + 1,
+                'aggregate': [('predefined', {'AggOp': agg}) for agg in self._aggregates]})
+        ml = pyamg.smoothed_aggregation_solver(A, **solver_kwargs)
+        if not reuse:
+            self._aggregates = [lvl.AggOp for lvl in ml.levels[:-1]]
+            self._shape = A.shape
+            self._reference_rate = None
+            self._stale = False
+        for lvl in ml.levels[:-1]:
+            for attr in ('C', 'T', 'AggOp'):
+                lvl.__dict__.pop(attr, None)
+        self._refreshed = reuse
+        M =  ml.aspreconditioner(cycle='V')
+        return LinearOperator(shape=A.shape, matvec=M.matvec, rmatvec=M.matvec)
+
+
+    def report(self, iterations, residue_ratio):
+        """
+        record the convergence of a solve using the last preconditioner.
+        Args:
+            iterations: number of iterations of the solve.
+            residue_ratio: the final residue relative to the initial one.
+        """
+        if (iterations <= 0) or (self._aggregates is None):
+            return
+        rate = -np.log(max(residue_ratio, np.finfo(float).tiny)) / iterations
+        if (not self._refreshed) or (self._reference_rate is None):
+            self._reference_rate = rate
+        elif rate * self._max_slowdown < self._reference_rate:
+            self._stale = True
+
+
+    def reset(self):
+        self._aggregates = None
+        self._shape = None
+        self._reference_rate = None
+        self._refreshed = False
+        self._stale = False
+
+
+
 def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kwargs):
     timeout = kwargs.get('timeout', None)
     early_stop_thresh = kwargs.get('early_stop_thresh', None)
@@ -1951,7 +2255,10 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
     check_converge = kwargs.get('check_converge', config.OPT_CHECK_CONVERGENCE)
     tolerated_perturbation = kwargs.get('tolerated_perturbation', None) # if one round of optimization yields no larger benefit compared to recover from such perturbation, then do early stop.
     allow_direct_solve = kwargs.pop('allow_direct_solve', False)
-    A = 0.5 * (A + A.T)
+    amg_cache = kwargs.get('amg_cache', None) # AMGPreconditioner to reuse for smoothed aggregation
+    matrix_free = isinstance(A, CrosslinkOperator)
+    if not matrix_free:
+        A = 0.5 * (A + A.T)
     if tolerated_perturbation is not None:
         theta = np.random.uniform(low=0.0, high=2*np.pi, size=round((b.size + 0.1)/2))
         sin_t = np.sin(theta)
@@ -1964,11 +2271,11 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
         M0 = sparse.diags(1/(A_diag.clip(min(1.0, A_diag.max()/1000),None))) # Jacobi precondition
     else:
         M0 = None
+    use_amg = False
     if isinstance(M, str):
         if M.lower().startswith(('smooth', 'sa')):
-            ml = pyamg.smoothed_aggregation_solver(A, presmoother=('gauss_seidel', {'sweep': 'forward'}), postsmoother=('gauss_seidel', {'sweep': 'backward'}), symmetry='symmetric', smooth=('jacobi', {'omega': 4.0/3.0}))
-            M =  ml.aspreconditioner(cycle='V')
-            M = LinearOperator(shape=A.shape, matvec=M.matvec, rmatvec=M.matvec)
+            use_amg = True  # built after removing the constrained dofs
+            M = None
         else:
             M = M0
     if (maxiter == 0) or (np.linalg.norm(b) == 0):
@@ -1983,12 +2290,25 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
         elif not np.any(edc):
             return np.zeros_like(b)
         else:
-            A = A[edc][:, edc]
+            if matrix_free:
+                A = A.submatrix(edc)
+            else:
+                A = A[edc][:, edc]
             b = b[edc]
-            if M is not None:
+            if (M0 is not None) and (M is M0):
+                M0 = sparse.diags(M0.diagonal()[edc])
+                M = M0
+            elif M is not None:
                 M = sparse.csr_matrix(M)[edc][:, edc]
             if tolerated_perturbation is not None:
                 tolerated_perturbation = tolerated_perturbation[edc]
+    if use_amg:
+        if amg_cache is None:
+            amg_cache = AMGPreconditioner()
+        if matrix_free:
+            M = amg_cache.preconditioner(A.sparse_approximation())
+        else:
+            M = amg_cache.preconditioner(A)
     kwargs_solver =  {'x0': x0, 'M': M}
     if atol is not None:
         rtol0 = atol / np.linalg.norm(b)
@@ -2000,8 +2320,9 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
     else:
         x = x0
     tol0 = tol
+    total_iter = 0
     directly_solved = False
-    if allow_direct_solve and (b.shape[0] < DIRECT_SOLVER_SWITCH):
+    if allow_direct_solve and (b.shape[0] < DIRECT_SOLVER_SWITCH) and (not matrix_free):
         try:
             F = sparse.linalg.factorized(A.tocsc())
             x = F(b)
@@ -2010,6 +2331,8 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
         except Exception:
             pass
     if not directly_solved:
+        if use_amg:
+            res0 = np.linalg.norm(A.dot(x) - b)
         while True:
             # not sure how minres compute rtol... so need a loop to ensure target is met.
             cb = SLM_Callback(A, b, timeout=timeout_t, early_stop_thresh=early_stop_thresh, chances=chances, eval_step=eval_step, atol=atol)
@@ -2048,9 +2371,12 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
             except ValueError: # smoothed aggregation maybe non symmetric
                 if M is not M0:
                     M = M0
+                    use_amg = False
+                    kwargs_solver['M'] = M
                     continue
                 else :
                     raise
+            total_iter += cb._count
             if (cost <= atol) or (not check_converge):
                 break
             if tolerated_perturbation is not None:
@@ -2073,6 +2399,8 @@ def solve(A, b, solver, x0=None, tol=1e-7, atol=None, maxiter=None, M=None, **kw
                     break
             tol = max(tol0, 0.1 * atol / cost)
             kwargs_solver.update({'x0': x})
+        if use_amg and (res0 > 0):
+            amg_cache.report(total_iter, np.linalg.norm(A.dot(x) - b) / res0)
     if edc is not None:
         x0 = x
         x = np.zeros_like(b, shape=edc.shape)
@@ -1,8 +1,11 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 from functools import partial
-import matplotlib.tri
+import hashlib
+import itertools
 import numpy as np
 import json
+import os
+from scipy import sparse
 from scipy.sparse import csgraph
 import shapely
 import shapely.geometry as shpgeo
@@ -41,16 +44,55 @@ class MeshRenderer:
         self._affine_approximator = kwargs.get('affine_approximator', None)
         self._affine_approx_tol = kwargs.get('affine_approx_tol', 0)
         self._covered_region = kwargs.get('covered_region', None)
+        self._field_sampling_step = kwargs.get('field_sampling_step', 0)
+        self._field_sampling_tol = kwargs.get('field_sampling_tol', 0.1)
 
 
     @classmethod
     def from_mesh(cls, srcmesh, gear=(const.MESH_GEAR_MOVING, const.MESH_GEAR_INITIAL), **kwargs):
+        """
+        Args:
+            srcmesh (feabas.mesh.Mesh): the mesh to render.
+        Kwargs:
+            render_plan_dir: if set, look up the render plan of the mesh in this
+                directory by its MeshRenderer.plan_key, and only compile (and
+                save) it if not found.
+        Other kwargs refer to MeshRenderer.compile_plan & MeshRenderer.__init__.
+        """
+        render_plan_dir = kwargs.pop('render_plan_dir', None)
+        if render_plan_dir is None:
+            plan = MeshRenderer.compile_plan(srcmesh, gear=gear, **kwargs)
+        else:
+            plan = MeshRenderer.cached_plan_file(srcmesh, render_plan_dir, gear=gear, **kwargs)
+        return cls.from_plan(plan, resolution=srcmesh.resolution, **kwargs)
+
+
+    @staticmethod
+    def compile_plan(srcmesh, gear=(const.MESH_GEAR_MOVING, const.MESH_GEAR_INITIAL), **kwargs):
+        """
+        compile the resolution-independent part of the renderer setup of a mesh
+        (the non-overlapping regions & their triangulations, collision regions,
+        region weights, affine approximations...) into a render plan that
+        MeshRenderer.from_plan can build the renderer from without the mesh.
+        Args:
+            srcmesh (feabas.mesh.Mesh): the mesh to render.
+        Kwargs:
+            weight_params: the trifinder mode to resolve overlapping regions.
+            include_flipped: whether to include flipped triangles.
+            render_weight_threshold: materials with render weight below this
+                are not rendered.
+            geodesic_mask: whether to include geodesic distance information.
+            affine_approx_tol: if not 0, include the affine approximations.
+        Return:
+            plan (dict): the render plan at the mesh resolution. None if no
+                triangle to render.
+        """
         include_flipped = kwargs.get('include_flipped', False)
-        weight_params = kwargs.pop('weight_params', const.MESH_TRIFINDER_INNERMOST)
+        weight_params = kwargs.get('weight_params', const.MESH_TRIFINDER_INNERMOST)
         local_cache = kwargs.get('cache', False)
         render_weight_threshold = kwargs.get('render_weight_threshold', 0)
         geodesic_mask = kwargs.get('geodesic_mask', False)
-        affine_approx_tol = kwargs.pop('affine_approx_tol', 0)
+        affine_approx_tol = kwargs.get('affine_approx_tol', 0)
         msh_wt = srcmesh.weight_multiplier_for_render()
         if np.any(msh_wt != 1):
             weighted_material = True
@@ -71,100 +113,322 @@ class MeshRenderer:
             asymmetry = True
         tri_info = srcmesh.tri_info(gear=gear[0], tri_mask=render_mask,
             include_flipped=include_flipped, cache=local_cache, asymmetry=asymmetry)
-        offset0 = srcmesh.offset(gear=gear[0])
+        plan = {'resolution': srcmesh.resolution, 'offset': srcmesh.offset(gear=gear[0]),
+                'weight_params': weight_params}
         region_tree = tri_info['region_tree']
-        mattri_list = tri_info['matplotlib_tri']
+        rasterizer_list = tri_info['rasterizer']
         tidx_list = tri_info['triangle_index']
         vidx_list = tri_info['vertex_index']
         vertices_img = srcmesh.vertices_w_offset(gear=gear[-1])
         if geodesic_mask:
-            geodesic_info = {}
-            geodesic_info['vertex_adjacency'] = srcmesh.vertex_distances(gear=gear[0], tri_mask=render_mask, cache=False)
-            geodesic_info['region_tri'] = mattri_list
-            geodesic_info['region_vindx'] = vidx_list
             vtx0 = srcmesh.vertices(gear=gear[0])
             segs = srcmesh.segments(tri_mask=render_mask)
-            geodesic_info['seg_line'] = unary_union([shpgeo.LineString(vtx0[s]) for s in segs])
-        else:
-            geodesic_info = None
-        if affine_approx_tol == 0:
-            affine_approximator = None
-            covered_region = None
-        else:
-            affine_approximator = {}
+            plan['geodesic'] = {
+                'vertex_adjacency': sparse.csr_matrix(srcmesh.vertex_distances(gear=gear[0], tri_mask=render_mask, cache=False)),
+                'seg_line': unary_union([shpgeo.LineString(vtx0[s]) for s in segs])
+            }
+        if affine_approx_tol != 0:
             v0_a = srcmesh.vertices(gear=gear[0])
             v1_a = srcmesh.vertices_w_offset(gear=gear[-1])
             vidx_a = np.unique(srcmesh.edges(tri_mask=render_mask))
             A_a = spatial.fit_affine(v1_a[vidx_a], v0_a[vidx_a])
             v0_a_t = v0_a[vidx_a] @ A_a[:2,:2] + A_a[-1,:2]
             dis_a = np.max(np.sum((v1_a[vidx_a] - v0_a_t)**2, axis=-1)) ** 0.5
-            affine_approximator['global_affine'] = A_a
-            affine_approximator['global_residue'] = dis_a
-            covered_region = srcmesh.shapely_regions(gear=gear[-1], tri_mask=render_mask, offsetting=True)
-            covered_region = covered_region.buffer(-0.5).simplify(0.5)
-            shapely.prepare(covered_region)
-            if dis_a > affine_approx_tol:
-                str_tree, tids = srcmesh.triangles_STRtree(gear=gear[0], tri_mask=render_mask)
-                T0 = srcmesh.triangles[tids]
-                affine_approximator['vertices'] = (str_tree, T0, v0_a, v1_a)
+            plan['affine'] = {'global_affine': A_a, 'global_residue': dis_a,
+                              'triangles': srcmesh.triangles[render_mask],
+                              'vertices0': v0_a, 'vertices1': v1_a}
+            plan['covered_region'] = srcmesh.shapely_regions(gear=gear[-1], tri_mask=render_mask, offsetting=True)
+        regions = []
+        collision_region = []
+        for rstr, tidx, vidx, region in zip(rasterizer_list, tidx_list, vidx_list, region_tree.geometries):
+            rgn = {'polygon': region, 'vertices': rstr.vertices, 'triangles': rstr.triangles,
+                   'values': vertices_img[vidx], 'vertex_index': vidx}
+            regions.append(rgn)
+            if weight_params == const.MESH_TRIFINDER_WHATEVER:
+                continue
+            hitidx = np.intersect1d(tidx, collision_tidx)
+            if hitidx.size == 0:
+                continue
+            hit_rstr, _, _ = srcmesh.rasterizer(gear=gear[0], tri_mask=hitidx)
+            rgn['hit_vertices'] = hit_rstr.vertices
+            rgn['hit_triangles'] = hit_rstr.triangles
+            collision_region.append(srcmesh.shapely_regions(gear=gear[0], tri_mask=hitidx))
+            if weight_params == const.MESH_TRIFINDER_INNERMOST:
+                mpts = list(shpgeo.MultiPoint(hit_rstr.vertices).geoms)
+                rgn['hit_distance'] = region.boundary.distance(mpts)
+                rgn['hit_inside'] = region.intersects(mpts)
+            elif weight_params == const.MESH_TRIFINDER_LEAST_DEFORM:
+                deform = srcmesh.triangle_tform_deform(gear=gear[::-1], tri_mask=hitidx)
+                rgn['hit_deform_weight'] = np.exp(-2 * deform**2)
+            else:
+                raise ValueError
+            if weighted_material:
+                rgn['hit_multiplier'] = msh_wt[hitidx]
+        plan['regions'] = regions
+        if len(collision_region) > 0:
+            plan['collision_region'] = unary_union(collision_region)
+        return plan
+
+
+    @classmethod
+    def from_plan(cls, plan, resolution=None, bbox=None, **kwargs):
+        """
+        build the renderer from a render plan.
+        Args:
+            plan (dict or str): render plan from MeshRenderer.compile_plan, or
+                the file it was saved to.
+        Kwargs:
+            resolution: resolution of the renderer. If different from that of
+                the plan, the plan is rescaled.
+            bbox: if given, only keep the triangles that can be hit when
+                rendering inside this bounding box (in the output space).
+            affine_approx_tol: tolerance of the affine approximations.
+        Other kwargs refer to MeshRenderer.__init__.
+        """
+        kwargs.pop('weight_params', None)
+        affine_approx_tol = kwargs.pop('affine_approx_tol', 0)
+        if isinstance(plan, str):
+            plan = MeshRenderer.load_plan(plan)
+        if plan is None:
+            return None
+        if (resolution is not None) and (resolution != plan['resolution']):
+            plan = MeshRenderer._scale_plan(plan, plan['resolution'] / resolution)
+        offset0 = plan['offset']
+        weight_params = plan['weight_params']
+        if bbox is not None:
+            # margin for the pixel centers & the affine fitting window
+            bbox0 = np.array(bbox, dtype=np.float64).reshape(4) - np.tile(np.ravel(offset0), 2)
+            bbox0 = bbox0 + np.array([-2, -2, 2, 2])
+            def _in_bbox(vertices, triangles):
+                vtri = vertices[triangles]
+                tmin, tmax = vtri.min(axis=1), vtri.max(axis=1)
+                return np.all((tmax >= bbox0[:2]) & (tmin <= bbox0[2:]), axis=-1)
         interpolators = []
         weight_generator = []
-        collision_region = []
         weight_multiplier = []
-        for mattri, tidx, vidx, region in zip(mattri_list, tidx_list, vidx_list, region_tree.geometries):
-            v0 = vertices_img[vidx]
-            xinterp = matplotlib.tri.LinearTriInterpolator(mattri, v0[:,0])
-            yinterp = matplotlib.tri.LinearTriInterpolator(mattri, v0[:,1])
-            interpolators.append((xinterp, yinterp))
-            if weight_params == const.MESH_TRIFINDER_WHATEVER:
+        for rgn in plan['regions']:
+            triangles = rgn['triangles']
+            if bbox is not None:
+                triangles = triangles[_in_bbox(rgn['vertices'], triangles)]
+            interpolators.append(spatial.TriangleRasterizer(rgn['vertices'], triangles, values=rgn['values']))
+            if (weight_params == const.MESH_TRIFINDER_WHATEVER) or ('hit_triangles' not in rgn):
                 weight_generator.append(None)
                 weight_multiplier.append(None)
+                continue
+            hit_triangles = rgn['hit_triangles']
+            if bbox is not None:
+                hit_tmask = _in_bbox(rgn['hit_vertices'], hit_triangles)
+                hit_triangles = hit_triangles[hit_tmask]
             else:
-                hitidx = np.intersect1d(tidx, collision_tidx)
-                if hitidx.size == 0:
-                    weight_generator.append(None)
-                    weight_multiplier.append(None)
-                    continue
-                mpl_tri, _, _ = srcmesh.mpl_tri(gear=gear[0], tri_mask=hitidx)
-                collision_region.append(srcmesh.shapely_regions(gear=gear[0], tri_mask=hitidx))
-                try:
-                    mpl_tri.get_trifinder()
-                except RuntimeError:
-                    mpl_tri = mattri
-                    hitidx = tidx
-                if weight_params == const.MESH_TRIFINDER_INNERMOST:
-                    cx = mpl_tri.x
-                    cy = mpl_tri.y
-                    mpts = list(shpgeo.MultiPoint(np.stack((cx, cy), axis=-1)).geoms)
-                    dis0 = region.boundary.distance(mpts) + 1
-                    inside = region.intersects(mpts)
-                    dis0[~inside] *= -1
-                    weight_generator.append(matplotlib.tri.LinearTriInterpolator(mpl_tri, dis0))
-                elif weight_params == const.MESH_TRIFINDER_LEAST_DEFORM:
-                    deform = srcmesh.triangle_tform_deform(gear=gear[::-1], tri_mask=hitidx)
-                    wt = np.exp(-2 * deform**2)
-                    weight_generator.append((mpl_tri.get_trifinder(), wt))
-                else:
-                    raise ValueError
-                if not weighted_material:
-                    weight_multiplier.append(None)
-                else:
-                    wt = msh_wt[hitidx]
-                    weight_multiplier.append((mpl_tri.get_trifinder(), wt))
-        if len(collision_region) > 0:
-            collision_region = unary_union(collision_region)
+                hit_tmask = slice(None)
+            if weight_params == const.MESH_TRIFINDER_INNERMOST:
+                dis0 = rgn['hit_distance'] + 1
+                dis0[~rgn['hit_inside']] *= -1
+                weight_generator.append(spatial.TriangleRasterizer(rgn['hit_vertices'], hit_triangles, values=dis0))
+                hit_rstr = None
+            else:
+                hit_rstr = spatial.TriangleRasterizer(rgn['hit_vertices'], hit_triangles)
+                weight_generator.append((hit_rstr, rgn['hit_deform_weight'][hit_tmask]))
+            if 'hit_multiplier' not in rgn:
+                weight_multiplier.append(None)
+            else:
+                if hit_rstr is None:
+                    hit_rstr = spatial.TriangleRasterizer(rgn['hit_vertices'], hit_triangles)
+                weight_multiplier.append((hit_rstr, rgn['hit_multiplier'][hit_tmask]))
+        region_tree = shapely.STRtree([rgn['polygon'] for rgn in plan['regions']])
+        if 'geodesic' in plan:
+            geodesic_info = {'vertex_adjacency': plan['geodesic']['vertex_adjacency'],
+                             'seg_line': plan['geodesic']['seg_line'],
+                             'region_tri': interpolators,
+                             'region_vindx': [rgn['vertex_index'] for rgn in plan['regions']]}
         else:
-            collision_region = None
-        resolution = srcmesh.resolution
+            geodesic_info = None
+        if (affine_approx_tol == 0) or ('affine' not in plan):
+            affine_approximator = None
+            covered_region = None
+        else:
+            affine_plan = plan['affine']
+            affine_approximator = {'global_affine': affine_plan['global_affine'],
+                                   'global_residue': affine_plan['global_residue']}
+            covered_region = plan['covered_region'].buffer(-0.5).simplify(0.5)
+            shapely.prepare(covered_region)
+            if affine_plan['global_residue'] > affine_approx_tol:
+                v0_a, v1_a = affine_plan['vertices0'], affine_plan['vertices1']
+                T0 = affine_plan['triangles']
+                if bbox is not None:
+                    T0 = T0[_in_bbox(v0_a, T0)]
+                pps = shapely.polygons(v0_a[T0].reshape(-1, 3, 2))
+                shapely.prepare(pps)
+                affine_approximator['vertices'] = (shapely.STRtree(pps), T0, v0_a, v1_a)
         return cls(interpolators, offset=offset0, region_tree=region_tree,
             weight_params=weight_params, weight_generator=weight_generator,
             weight_multiplier=weight_multiplier,
-            collision_region=collision_region, resolution=resolution,
+            collision_region=plan.get('collision_region', None), resolution=plan['resolution'],
             geodesic_info=geodesic_info, affine_approximator=affine_approximator,
             affine_approx_tol=affine_approx_tol, covered_region=covered_region,
             **kwargs)
 
 
+    @staticmethod
+    def _scale_plan(plan, scale):
+        """rescale a render plan by scale (old resolution / new resolution)."""
+        c = 0.5 * (scale - 1)
+        geo_tform = [scale, 0, 0, scale, c, c]
+        plan_s = {'resolution': plan['resolution'] / scale,
+                  'offset': plan['offset'] * scale,
+                  'weight_params': plan['weight_params']}
+        regions = []
+        for rgn in plan['regions']:
+            rgn_s = rgn.copy()
+            rgn_s['polygon'] = shapely.affinity.affine_transform(rgn['polygon'], geo_tform)
+            for key in ('vertices', 'values', 'hit_vertices'):
+                if key in rgn:
+                    rgn_s[key] = spatial.scale_coordinates(rgn[key], scale)
+            if 'hit_distance' in rgn:
+                rgn_s['hit_distance'] = rgn['hit_distance'] * scale
+            regions.append(rgn_s)
+        plan_s['regions'] = regions
+        for key in ('collision_region', 'covered_region'):
+            if key in plan:
+                plan_s[key] = shapely.affinity.affine_transform(plan[key], geo_tform)
+        if 'geodesic' in plan:
+            plan_s['geodesic'] = {'vertex_adjacency': plan['geodesic']['vertex_adjacency'] * scale,
+                                  'seg_line': shapely.affinity.affine_transform(plan['geodesic']['seg_line'], geo_tform)}
+        if 'affine' in plan:
+            affine_plan = plan['affine']
+            A_a = np.array(affine_plan['global_affine'], copy=True)
+            A_a[-1,:2] = scale * A_a[-1,:2] + c - c * (A_a[0,:2] + A_a[1,:2])
+            plan_s['affine'] = {'global_affine': A_a,
+                                'global_residue': affine_plan['global_residue'] * scale,
+                                'triangles': affine_plan['triangles'],
+                                'vertices0': spatial.scale_coordinates(affine_plan['vertices0'], scale),
+                                'vertices1': spatial.scale_coordinates(affine_plan['vertices1'], scale)}
+        return plan_s
+
+
+    @staticmethod
+    def plan_key(srcmesh, gear=(const.MESH_GEAR_MOVING, const.MESH_GEAR_INITIAL), **kwargs):
+        """
+        hash of the mesh content and the options that determine its render plan.
+        The vertices are normalized to DEFAULT_RESOLUTION, so that the same mesh
+        at different resolutions (e.g. different mip levels) share the plan.
+        """
+        scale = srcmesh.resolution / DEFAULT_RESOLUTION
+        hasher = hashlib.sha1()
+        for g in gear:
+            # + 0 to get rid of negative zeros
+            vertices = np.round(spatial.scale_coordinates(srcmesh.vertices(gear=g), scale), 3) + 0.0
+            offset = np.round(srcmesh.offset(gear=g) * scale, 3) + 0.0
+            hasher.update(vertices.astype(np.float64).tobytes())
+            hasher.update(offset.astype(np.float64).tobytes())
+        render_weight_threshold = kwargs.get('render_weight_threshold', 0)
+        render_mask = srcmesh.triangle_mask_for_render(render_weight_threshold=render_weight_threshold)
+        hasher.update(srcmesh.triangles.astype(np.int64).tobytes())
+        hasher.update(np.packbits(render_mask).tobytes())
+        hasher.update(srcmesh.weight_multiplier_for_render().astype(np.float32).tobytes())
+        options = [str(kwargs.get('weight_params', const.MESH_TRIFINDER_INNERMOST)),
+                   bool(kwargs.get('include_flipped', False)),
+                   float(render_weight_threshold),
+                   bool(kwargs.get('geodesic_mask', False)),
+                   kwargs.get('affine_approx_tol', 0) != 0,
+                   [str(g) for g in gear]]
+        hasher.update(json.dumps(options).encode())
+        return hasher.hexdigest()
+
+
+    @staticmethod
+    def cached_plan_file(srcmesh, render_plan_dir, gear=(const.MESH_GEAR_MOVING, const.MESH_GEAR_INITIAL), **kwargs):
+        """
+        return the render plan file of a mesh in render_plan_dir, compile and
+        save it first if it does not exist yet. None if nothing to render.
+        """
+        plan_file = storage.join_paths(render_plan_dir, MeshRenderer.plan_key(srcmesh, gear=gear, **kwargs) + '.h5')
+        if storage.file_exists(plan_file):
+            return plan_file
+        plan = MeshRenderer.compile_plan(srcmesh, gear=gear, **kwargs)
+        if plan is None:
+            return None
+        storage.makedirs(render_plan_dir)
+        MeshRenderer.save_plan(plan, plan_file)
+        return plan_file
+
+
+    @staticmethod
+    def save_plan(plan, fname):
+        """
+        save a render plan to an uncompressed HDF5 file, so that the workers
+        loading the same plan read it through the shared OS page cache. The
+        shapely geometries are saved as WKB.
+        """
+        def _save_geometry(grp, key, geo):
+            grp.create_dataset(key, data=np.frombuffer(shapely.to_wkb(geo), dtype=np.uint8))
+        driver, fname_local = storage.parse_file_driver(fname)
+        if driver == 'file':
+            # write to a temporary file first so that concurrent readers never
+            # see a partial plan
+            tmpname = fname_local + f'.{os.getpid()}.tmp'
+        else:
+            tmpname = fname
+        with H5File(tmpname, 'w') as f:
+            f.attrs['resolution'] = plan['resolution']
+            f.attrs['weight_params'] = plan['weight_params']
+            f.create_dataset('offset', data=plan['offset'])
+            for key in ('collision_region', 'covered_region'):
+                if key in plan:
+                    _save_geometry(f, key, plan[key])
+            f.attrs['num_regions'] = len(plan['regions'])
+            for k, rgn in enumerate(plan['regions']):
+                grp = f.create_group(f'regions/{k}')
+                for key, val in rgn.items():
+                    if key == 'polygon':
+                        _save_geometry(grp, key, val)
+                    else:
+                        grp.create_dataset(key, data=val)
+            if 'affine' in plan:
+                grp = f.create_group('affine')
+                for key, val in plan['affine'].items():
+                    grp.create_dataset(key, data=val)
+            if 'geodesic' in plan:
+                grp = f.create_group('geodesic')
+                A = plan['geodesic']['vertex_adjacency']
+                grp.create_dataset('adjacency_data', data=A.data)
+                grp.create_dataset('adjacency_indices', data=A.indices)
+                grp.create_dataset('adjacency_indptr', data=A.indptr)
+                grp.create_dataset('adjacency_shape', data=np.array(A.shape))
+                _save_geometry(grp, 'seg_line', plan['geodesic']['seg_line'])
+        if driver == 'file':
+            os.replace(tmpname, fname_local)
+
+
+    @staticmethod
+    def load_plan(fname):
+        def _load_geometry(grp, key):
+            return shapely.from_wkb(grp[key][()].tobytes())
+        plan = {}
+        with H5File(fname, 'r') as f:
+            plan['resolution'] = float(f.attrs['resolution'])
+            plan['weight_params'] = int(f.attrs['weight_params'])
+            plan['offset'] = f['offset'][()]
+            for key in ('collision_region', 'covered_region'):
+                if key in f:
+                    plan[key] = _load_geometry(f, key)
+            regions = []
+            for k in range(int(f.attrs['num_regions'])):
+                grp = f[f'regions/{k}']
+                rgn = {key: grp[key][()] for key in grp.keys() if key != 'polygon'}
+                rgn['polygon'] = _load_geometry(grp, 'polygon')
+                regions.append(rgn)
+            plan['regions'] = regions
+            if 'affine' in f:
+                plan['affine'] = {key: f['affine'][key][()] for key in f['affine'].keys()}
+            if 'geodesic' in f:
+                grp = f['geodesic']
+                A = sparse.csr_matrix((grp['adjacency_data'][()], grp['adjacency_indices'][()],
+                                       grp['adjacency_indptr'][()]), shape=tuple(grp['adjacency_shape'][()]))
+                plan['geodesic'] = {'vertex_adjacency': A, 'seg_line': _load_geometry(grp, 'seg_line')}
+        return plan
+
+
     def link_image_loader(self, imgloader):
         self._image_loader = imgloader
 
@@ -205,13 +469,13 @@ class MeshRenderer:
                         if wg is None:
                             continue
                         if self._weight_params == const.MESH_TRIFINDER_INNERMOST:
-                            dis_m = wg(pxy[0], pxy[1])
+                            dis_m = wg.interpolate(pxy[0], pxy[1])[0]
                             if dis_m.mask:
                                 continue
                             dis = dis_m.data
                         else:
-                            trfd, wt0 = wg
-                            tid = trfd(pxy[0], pxy[1])
+                            rstr, wt0 = wg
+                            tid = rstr.find(pxy[0], pxy[1])
                             if tid < 0:
                                 continue
                             dis = wt0[tid]
@@ -270,6 +534,13 @@ class MeshRenderer:
                 the interpolated results as weight.
             out_resolution: output resolution. If set to None, assume the output
                 resolution is the same as the intrinsic renderer resoluton.
+            field_sampling_step: if larger than 1, evaluate the field on a
+                coarse lattice with this spacing (in output pixels) and fill in
+                the rest by bilinear interpolation. Lattice cells whose
+                estimated interpolation error exceeds field_sampling_tol are
+                evaluated exactly.
+            field_sampling_tol: error tolerance (in input pixels) of the
+                coarse-lattice interpolation.
         Return:
             x-field (ndarray): deformation field in x direction. None if
                 bounding box not intersecting the interpolator.
@@ -282,6 +553,8 @@ class MeshRenderer:
         compute_wt =  kwargs.get('compute_wt', True)
         out_resolution = kwargs.get('out_resolution', None)
         offsetting = kwargs.get('offsetting', True)
+        sampling_step = kwargs.get('field_sampling_step', self._field_sampling_step)
+        sampling_tol = kwargs.get('field_sampling_tol', self._field_sampling_tol)
         invalid_output = (None, None, None)
         bbox0 = common.numpy_array(bbox, copy=False).reshape(4)
         if offsetting:
@@ -291,16 +564,15 @@ class MeshRenderer:
             region_id = self.region_finder_for_points(bcntr, offsetting=False).item()
         if region_id == -1:
             return invalid_output
-        interpX, interpY = self._interpolators[region_id]
+        interp = self._interpolators[region_id]
         xs = np.linspace(bbox0[0], bbox0[2], num=round(bbox0[2]-bbox0[0]), endpoint=False, dtype=float)
         ys = np.linspace(bbox0[1], bbox0[3], num=round(bbox0[3]-bbox0[1]), endpoint=False, dtype=float)
         if out_resolution is not None:
             scale = out_resolution / self.resolution
             xs = spatial.scale_coordinates(xs, scale)
             ys = spatial.scale_coordinates(ys, scale)
-        xx, yy = np.meshgrid(xs, ys)
-        map_x = interpX(xx, yy)
-        map_y = interpY(xx, yy)
+        map_x, map_y = MeshRenderer._interpolate_on_grid(interp, xs, ys,
+                                                         step=sampling_step, tol=sampling_tol)
         mask = map_x.mask | map_y.mask
         if np.all(mask, axis=None):
             return invalid_output
@@ -317,13 +589,12 @@ class MeshRenderer:
                     hit_id = self.region_finder_for_points(bcntr, offsetting=False).item()
                     if hit_id == -1:
                         return invalid_output
-                    hit_mtri = self._geodesic_info['region_tri'][hit_id]
-                    t_finder = hit_mtri.get_trifinder()
-                    hit_tidx = t_finder(bcntr[0], bcntr[1]).item()
+                    hit_rstr = self._geodesic_info['region_tri'][hit_id]
+                    hit_tidx = hit_rstr.find(bcntr[0], bcntr[1]).item()
                     if hit_tidx == -1:
                         return invalid_output
-                    hit_vidx_loc = hit_mtri.triangles[hit_tidx]
-                    hit_dis = ((hit_mtri.x[hit_vidx_loc] - bcntr[0]) ** 2 + (hit_mtri.y[hit_vidx_loc] - bcntr[1]) ** 2) ** 0.5
+                    hit_vidx_loc = hit_rstr.triangles[hit_tidx]
+                    hit_dis = np.sum((hit_rstr.vertices[hit_vidx_loc] - np.array(bcntr)) ** 2, axis=-1) ** 0.5
                     hit_vidx_glob = self._geodesic_info['region_vindx'][hit_id][hit_vidx_loc]
                     dis_t = csgraph.shortest_path(self._geodesic_info['vertex_adjacency'],
                                                   directed=False, return_predecessors=False,
@@ -332,35 +603,34 @@ class MeshRenderer:
                     dis_t = dis_t + hit_dis.reshape(3, 1)
                     dis_g0 = np.min(dis_t, axis=0)
                     self._cached_geodesic_distance[bcntr] = dis_g0
-                mtri = self._geodesic_info['region_tri'][region_id]
+                rstr = self._geodesic_info['region_tri'][region_id]
                 vidx = self._geodesic_info['region_vindx'][region_id]
                 dis_g = dis_g0[vidx]
-                dis_e = ((mtri.x - bcntr[0])**2 + (mtri.y - bcntr[1])**2)**0.5
+                dis_e = np.sum((rstr.vertices - np.array(bcntr)) ** 2, axis=-1) ** 0.5
                 with np.errstate(divide='ignore', invalid='ignore'):
                     dis_ratio = np.nan_to_num(dis_e/dis_g, nan=1)
-                ginterp = matplotlib.tri.LinearTriInterpolator(mtri, dis_ratio)
-                wt = np.nan_to_num(ginterp(xx, yy).data, nan=0)
+                wt = np.nan_to_num(rstr.interpolate_grid(xs, ys, values=dis_ratio)[0].data, nan=0)
                 weight = weight * wt.clip(0,1)
         else:
             weight_generator = self.weight_generator[region_id]
             weight_multiplier = self.weight_multiplier[region_id]
             if compute_wt and (weight_generator is not None):
                 if self._weight_params == const.MESH_TRIFINDER_INNERMOST:
-                    wt = weight_generator(xx, yy)
+                    wt = weight_generator.interpolate_grid(xs, ys)[0]
                     if not np.all(wt.mask, axis=None):
                         wtmx = wt.max()
                         weight = weight * np.nan_to_num(wt.data, copy=False, nan=wtmx)
                 elif self._weight_params == const.MESH_TRIFINDER_LEAST_DEFORM:
-                    trfd, wt0 = weight_generator
-                    tid = trfd(xx, yy)
+                    rstr, wt0 = weight_generator
+                    tid, _ = rstr.rasterize(xs, ys)
                     omask = tid < 0
                     if not np.all(tid < 0, axis=None):
                         wt = wt0[tid]
                         wt[omask] = 1
                         weight = weight * wt
             if compute_wt and (weight_multiplier is not None):
-                trfd, wt0 = weight_multiplier
-                tid = trfd(xx, yy)
+                rstr, wt0 = weight_multiplier
+                tid, _ = rstr.rasterize(xs, ys)
                 omask = tid < 0
                 if not np.all(tid < 0, axis=None):
                     wt = wt0[tid]
@@ -369,17 +639,95 @@ class MeshRenderer:
         return x_field, y_field, weight
 
 
+    @staticmethod
+    def _interpolate_on_grid(interpolator, xs, ys, step=0, tol=0.1):
+        """
+        evaluate the vertex values of a triangle rasterizer on the grid defined
+        by xs & ys.
+        Args:
+            interpolator (spatial.TriangleRasterizer): rasterizer with vertex
+                values to interpolate.
+            xs, ys: sorted 1d coordinates of the grid columns and rows.
+        Kwargs:
+            step: if larger than 1, sample the interpolator on a lattice with
+                this spacing and bilinearly upsample. The error of each lattice
+                cell is estimated at its center and edge midpoints, and cells
+                with estimated error larger than tol/2 (the margin accounts for
+                the maximum error falling between the probes) are evaluated
+                exactly. The validity of every pixel is tested by rasterizing
+                the grid, and cells with any pixel outside the mesh are also
+                evaluated exactly, so the mask is exact.
+            tol: error tolerance of the upsampled values.
+        Return:
+            list of masked arrays of shape (len(ys), len(xs)).
+        """
+        nx, ny = len(xs), len(ys)
+        if (step is None) or (step <= 1) or (nx < 2 * step) or (ny < 2 * step):
+            return interpolator.interpolate_grid(xs, ys)
+        def _nodes(n):
+            nd = np.arange(0, n, step)
+            if nd[-1] != n - 1:
+                nd = np.append(nd, n - 1)
+            return nd
+        def _interp_matrix(pos, q):
+            # sparse linear interpolation matrix from node positions to q
+            j = np.clip(np.searchsorted(pos, q, side='right') - 1, 0, pos.size - 2)
+            t = (q - pos[j]) / (pos[j+1] - pos[j])
+            data = np.stack((1 - t, t), axis=-1).ravel()
+            indices = np.stack((j, j + 1), axis=-1).ravel()
+            indptr = np.arange(0, 2 * q.size + 1, 2)
+            return sparse.csr_matrix((data, indices, indptr), shape=(q.size, pos.size))
+        def _upsample(arr, pos_r, pos_c, qr, qc):
+            arr = (_interp_matrix(pos_c, qc) @ arr.T).T
+            return _interp_matrix(pos_r, qr) @ arr
+        tid, _ = interpolator.rasterize(xs, ys)
+        px, py = _nodes(nx), _nodes(ny)
+        # lattice nodes interleaved with the cell edge midpoints & centers
+        qx = np.insert(px.astype(float), np.arange(1, px.size), (px[:-1] + px[1:]) / 2)
+        qy = np.insert(py.astype(float), np.arange(1, py.size), (py[:-1] + py[1:]) / 2)
+        samples = interpolator.interpolate_grid(np.interp(qx, np.arange(nx), xs), np.interp(qy, np.arange(ny), ys))
+        err = np.zeros((qy.size, qx.size), dtype=float)
+        for smp in samples:
+            pred = _upsample(smp.data[::2, ::2], py, px, qy, qx)
+            err = np.maximum(err, np.abs(smp.data - pred))
+            err[np.ma.getmaskarray(smp)] = np.inf
+        err = np.nan_to_num(err, nan=np.inf)
+        err = np.maximum(np.maximum(err[:-2:2], err[1:-1:2]), err[2::2])
+        err = np.maximum(np.maximum(err[:, :-2:2], err[:, 1:-1:2]), err[:, 2::2])
+        exact_cell = err > (tol / 2)
+        cy = np.clip(np.searchsorted(py, np.arange(ny), side='right') - 1, 0, py.size - 2)
+        cx = np.clip(np.searchsorted(px, np.arange(nx), side='right') - 1, 0, px.size - 2)
+        mask = tid < 0
+        if np.any(mask):
+            rr, cc = np.nonzero(mask)
+            exact_cell[cy[rr], cx[cc]] = True
+        if np.all(exact_cell):
+            return interpolator.interpolate_grid(xs, ys, tid=tid)
+        exact_indx = None
+        if np.any(exact_cell):
+            exact_indx = np.nonzero(exact_cell[cy][:, cx])
+            exact_vals = interpolator.interpolate(xs[exact_indx[1]], ys[exact_indx[0]],
+                                                  tid=tid[exact_indx])
+        out = []
+        for k, smp in enumerate(samples):
+            fld = _upsample(smp.data[::2, ::2], py, px, np.arange(ny), np.arange(nx))
+            if exact_indx is not None:
+                fld[exact_indx] = exact_vals[k].data
+            out.append(np.ma.MaskedArray(fld, mask=mask.copy()))
+        return out
+
+
     def local_affine_tform(self, pt, offsetting=True, svd_clip=None):
         pt0 = common.numpy_array(pt, copy=False).ravel()
         if offsetting:
             pt0 = pt0 - self._offset.ravel()
         region_id = self.region_finder_for_points(pt0, offsetting=False).item()
-        interpX, interpY = self._interpolators[region_id]
-        axx, axy = interpX.gradient(pt0[0], pt0[1])
-        if axx.mask:
+        interp = self._interpolators[region_id]
+        tid = interp.find(pt0[0], pt0[1]).item()
+        if tid < 0:
             return None, None
-        ayx, ayy = interpY.gradient(pt0[0], pt0[1])
-        A = np.array([[axx.data, ayx.data], [axy.data, ayy.data]])
+        coef = interp.affine_coefficients()[tid]
+        A = coef[:2]
         if svd_clip is not None:
             u, s, vh = np.linalg.svd(A, compute_uv=True)
             if hasattr(svd_clip, '__len__'):
@@ -387,9 +735,7 @@ class MeshRenderer:
             else:
                 s = s.clip(1/(1+svd_clip), 1+svd_clip)
             A = u @ np.diag(s) @ vh
-        pt1_x = interpX(pt0[0], pt0[1])
-        pt1_y = interpY(pt0[0], pt0[1])
-        pt1 = np.array([pt1_x.data, pt1_y.data])
+        pt1 = pt0 @ coef[:2] + coef[2]
         t = pt1 - pt0 @ A
         return A, t
 
@@ -459,6 +805,8 @@ class MeshRenderer:
         Kwargs:
             out_resolution: output resolution. If set to None, assume the output
                 resolution is the same as the intrinsic renderer resoluton.
+            field_sampling_step, field_sampling_tol: coarse-lattice field
+                evaluation settings. Refer to field_w_weight.
         Return:
             x-field (ndarray): deformation field in x direction. None if
                 bounding box not intersecting the interpolator.
@@ -470,6 +818,8 @@ class MeshRenderer:
         offsetting = kwargs.get('offsetting', True)
         out_resolution = kwargs.get('out_resolution', None)
         affine_tolerance = kwargs.get('affine_tolerance', self._affine_approx_tol)
+        sampling_step = kwargs.get('field_sampling_step', self._field_sampling_step)
+        sampling_tol = kwargs.get('field_sampling_tol', self._field_sampling_tol)
         log_sigma = kwargs.get('log_sigma', 0)
         bbox0 = np.array(bbox).reshape(4)
         outwd = round(bbox0[2]-bbox0[0])
@@ -511,7 +861,8 @@ class MeshRenderer:
             if not field_generated:
                 if mode == const.RENDER_CONTIGEOUS:
                     x_field, y_field, weight = self.field_w_weight(bbox0, region_id=None,
-                        out_resolution=out_resolution, offsetting=False, compute_wt=True)
+                        out_resolution=out_resolution, offsetting=False, compute_wt=True,
+                        field_sampling_step=sampling_step, field_sampling_tol=sampling_tol)
                     if weight is None:
                         mask = None
                     else:
@@ -527,7 +878,8 @@ class MeshRenderer:
                     initialized = False
                     for rid in regions:
                         xf, yf, wt = self.field_w_weight(bbox0, region_id=rid,
-                            out_resolution=out_resolution, offsetting=False, compute_wt=True)
+                            out_resolution=out_resolution, offsetting=False, compute_wt=True,
+                            field_sampling_step=sampling_step, field_sampling_tol=sampling_tol)
                         if xf is None:
                             continue
                         if not initialized:
@@ -691,6 +1043,7 @@ def render_whole_mesh(mesh, image_loader, prefix, **kwargs):
     pattern = kwargs.pop('pattern', 'tr{ROW_IND}_tc{COL_IND}.png')
     scale = kwargs.pop('scale', 1)
     one_based = kwargs.pop('one_based', False)
+    render_plan_dir = kwargs.pop('render_plan_dir', None)
     if 'weight_params' in kwargs and isinstance(kwargs['weight_params'], str):
         kwargs['weight_params'] = const.TRIFINDER_MODE_LIST.index(kwargs['weight_params'])
     keywords = ['{ROW_IND}', '{COL_IND}', '{X_MIN}', '{Y_MIN}', '{X_MAX}', '{Y_MAX}']
@@ -832,6 +1185,10 @@ def render_whole_mesh(mesh, image_loader, prefix, **kwargs):
         return rendered
     if isinstance(image_loader, dal.AbstractImageLoader):
         image_loader = image_loader.init_dict()
+    if render_plan_dir is not None:
+        kwargs['render_plan'] = MeshRenderer.cached_plan_file(mesh, render_plan_dir, **kwargs)
+        if kwargs['render_plan'] is None:
+            return rendered
     if driver == 'image':
         target_func = partial(subprocess_render_mesh_tiles, image_loader, **kwargs)
     else:
@@ -861,13 +1218,20 @@ def render_whole_mesh(mesh, image_loader, prefix, **kwargs):
                 filenames_list.append(filenames[idx0:idx1])
             else:
                 bboxes_out_list.append(bboxes_out[idx0:idx1])
-        submeshes = mesh.submeshes_from_regions(bbox_unions, save_material=None, buffer=tile_size[0]//2)
+        if render_plan_dir is None:
+            submeshes = mesh.submeshes_from_regions(bbox_unions, save_material=None, buffer=tile_size[0]//2)
+        else:
+            # the workers build their renderers from the plan instead
+            submeshes = [None] * len(bbox_unions)
         args_list = []
         for k in range(len(submeshes)):
             msh = submeshes[k]
-            if msh is None:
+            if msh is not None:
+                msh_dict = msh.get_init_dict(save_material=True, vertex_flags=(const.MESH_GEAR_INITIAL, const.MESH_GEAR_MOVING), filter_material=False)
+            elif render_plan_dir is None:
                 continue
-            msh_dict = msh.get_init_dict(save_material=True, vertex_flags=(const.MESH_GEAR_INITIAL, const.MESH_GEAR_MOVING), filter_material=False)
+            else:
+                msh_dict = None
             bbox = bboxes_list[k]
             if driver == 'image':
                 fnames = filenames_list[k]
@@ -891,20 +1255,25 @@ def render_whole_mesh(mesh, image_loader, prefix, **kwargs):
 def subprocess_render_mesh_tiles(imgloader, mesh, bboxes, outnames, **kwargs):
     target_resolution = kwargs.pop('target_resolution')
     bboxes_out = kwargs.pop('bboxes_out', bboxes)
+    render_plan = kwargs.pop('render_plan', None)
     if isinstance(imgloader, (str, dict)):
         imgloader = dal.get_loader_from_json(imgloader)
-    if isinstance(mesh, str):
-        M = Mesh.from_h5(mesh)
-    elif isinstance(mesh, dict):
-        M = Mesh(**mesh)
-    else:
-        M = mesh
-    M.change_resolution(target_resolution)
     if isinstance(outnames, (dict, ts.TensorStore)):
         use_tensorstore = True
     else:
         use_tensorstore = False
-    renderer = MeshRenderer.from_mesh(M, **kwargs)
+    if render_plan is not None:
+        renderer = MeshRenderer.from_plan(render_plan, resolution=target_resolution,
+                                          bbox=common.bbox_union(bboxes), **kwargs)
+    else:
+        if isinstance(mesh, str):
+            M = Mesh.from_h5(mesh)
+        elif isinstance(mesh, dict):
+            M = Mesh(**mesh)
+        else:
+            M = mesh
+        M.change_resolution(target_resolution)
+        renderer = MeshRenderer.from_mesh(M, **kwargs)
     if renderer is None:
         if use_tensorstore:
             return []
@@ -972,7 +1341,21 @@ class VolumeRenderer:
             offset to (0,0) in the output space
         resolution: resolution of the renderer
         out_offset: xy offset of the output space
+        max_pending_commits: maximum number of chunk transactions a worker
+            leaves committing in the background while it renders the next
+            chunks. 0 to wait for each commit before moving on.
+        cost_weights: default weights of the job cost model, see
+            VolumeRenderer.DEFAULT_COST_WEIGHTS.
+        cost_model_file: json file to record the job timings to, and refit the
+            cost model from. Default to render_cost.json in flag_dir.
+        render_plan_dir: if set, compile the render plans of the sections into
+            this directory (or reuse the existing ones), and let the workers
+            build their renderers from the plans instead of the submeshes.
     """
+    # cost of rendering a chunk per: section overlapping it; section border
+    # crossing it; mesh triangle inside it; source tile it reads from.
+    DEFAULT_COST_WEIGHTS = {'sections': 1.0, 'borders': 1.0, 'triangles': 0.002, 'source_tiles': 0.5}
+
     def __init__(self, meshes, loaders, kvstore, z_indx=None, **kwargs):
         if z_indx is None:
             z_indx = np.arange(len(meshes))
@@ -984,10 +1367,14 @@ class VolumeRenderer:
         self._zmax = kwargs.get('z_max', None)
         self._jpeg_compression = kwargs.get('jpeg_compression', False)
         self._pad_to_tile_size = kwargs.get('pad_to_tile_size', True)
+        self._max_pending_commits = kwargs.get('max_pending_commits', 0)
         self._loaders = loaders
         driver = kwargs.get('driver', 'neuroglancer_precomputed')
         self.flag_dir = kwargs.get('flag_dir', None)
         self.checkpoint_dir = kwargs.get('checkpoint_dir', storage.join_paths(self.flag_dir, 'checkpoint'))
+        self._cost_weights = kwargs.get('cost_weights', VolumeRenderer.DEFAULT_COST_WEIGHTS)
+        self._cost_model_file = kwargs.get('cost_model_file', storage.join_paths(self.flag_dir, 'render_cost.json'))
+        self._render_plan_dir = kwargs.get('render_plan_dir', None)
         self._canvas_bbox = kwargs.get('canvas_bbox', None)
         if self._canvas_bbox is not None:
             default_offset = -np.array(self._canvas_bbox)[:2].reshape(1,2)
@@ -1007,9 +1394,27 @@ class VolumeRenderer:
 
 
     def plan_one_slab(self, z_ind=0, **kwargs):
+        """
+        divide the rendering of one slab of sections into tasks.
+        Kwargs:
+            lazy(bool): if True, return the tasks as a generator that only
+                extracts the submeshes of each task when it is requested, so
+                that the meshes of the whole slab do not need to be held in
+                memory at once.
+            loader_config(dict): the renderer settings, used to compile the
+                render plans if render_plan_dir is set.
+        Return:
+            render_seriers(list or generator): keyword arguments of the tasks
+                for subprocess_render_partial_ts_slab. The chunks are divided
+                by the costs predicted by self.cost_model, and the total cost
+                features of each task are given in its 'cost_features' entry.
+            check_points(dict): z -> boolean flags of the chunks to render.
+        """
         num_workers = kwargs.get('num_workers', 1)
+        lazy = kwargs.get('lazy', False)
         max_tile_per_job = kwargs.get('max_tile_per_job', None)
         cache_capacity = kwargs.pop('cache_capacity', None)
+        loader_config = kwargs.get('loader_config', {})
         _, _, Z0, _, _, Z1 = self.writer.write_grids
         z0, z1 = Z0[z_ind], Z1[z_ind]
         flag_name = kwargs.get('flag_name', f'z{z0}_{z1}')
@@ -1037,6 +1442,9 @@ class VolumeRenderer:
         bboxes_tree = shapely.STRtree(list(shapely_boxes))
         num_xy_grids = id_x.size
         hit_counts = np.zeros(num_xy_grids, dtype=np.uint16)
+        border_counts = np.zeros(num_xy_grids, dtype=np.uint16)
+        tri_counts = np.zeros(num_xy_grids, dtype=np.float64)
+        src_tile_counts = np.zeros(num_xy_grids, dtype=np.float64)
         full_meshes = {}
         loaders = {}
         for z, rm in zip(z_to_render, self.region_generator(indx=z_to_render)):
@@ -1049,26 +1457,41 @@ class VolumeRenderer:
                 bb[idxt] = True
                 check_points[z] = bb
             hit_counts += check_points[z]
-            full_meshes[z] = rm[1]
+            bb = np.zeros(num_xy_grids, dtype=bool)
+            bb[bboxes_tree.query(rr.boundary, predicate='intersects')] = True
+            border_counts += bb & check_points[z]
+            tri_centers = rm[1].triangle_centers(gear=const.MESH_GEAR_MOVING)
+            tidx, idxt = bboxes_tree.query(shapely.points(tri_centers), predicate='intersects')
+            tri_counts += np.bincount(idxt, minlength=num_xy_grids) * check_points[z]
             loaders[z] = self.loader_lut.get(z, None)
+            src_tile_counts += self._source_tile_counts(rm[1], loaders[z], tidx, idxt, num_xy_grids) * check_points[z]
+            full_meshes[z] = rm[1]
         if len(full_meshes) == 0:
             return render_seriers, check_points
+        if self._render_plan_dir is not None:
+            render_plans = self._prepare_render_plans(full_meshes, num_workers=num_workers, **loader_config)
+        else:
+            render_plans = None
         midx_hits = np.nonzero(hit_counts > 0)[0]
         bboxes = bboxes[midx_hits]
         hit_counts = hit_counts[midx_hits]
-        hit_counts_acc = np.insert(np.cumsum(hit_counts), 0, 0)
-        num_tiles = hit_counts_acc[-1]
+        chunk_features = {'sections': hit_counts.astype(np.float64),
+                          'borders': border_counts[midx_hits].astype(np.float64),
+                          'triangles': tri_counts[midx_hits],
+                          'source_tiles': src_tile_counts[midx_hits]}
+        chunk_costs = self.cost_model.predict(chunk_features)
+        num_tiles = np.sum(hit_counts)
         num_tile_per_job = max(1, num_tiles // num_workers)
-        if max_tile_per_job is not None:
-            num_tile_per_job = min(num_tile_per_job, max_tile_per_job)
+        max_tile_cap = max_tile_per_job
         if cache_capacity is not None:
             chunk_mb = np.prod(self.writer.write_chunk_shape[:2]) * self.writer.number_of_channels / (1024 ** 2)
             max_chunk_per_proc = max(1, cache_capacity / (chunk_mb * num_workers))
-            num_tile_per_job = min(num_tile_per_job, max_chunk_per_proc)
+            max_tile_cap = max_chunk_per_proc if max_tile_cap is None else min(max_tile_cap, max_chunk_per_proc)
+        if max_tile_cap is not None:
+            num_tile_per_job = min(num_tile_per_job, max_tile_cap)
         N_jobs = max(1, round(num_tiles / num_tile_per_job))
-        indices_tile = np.round(np.linspace(0, num_tiles, num=N_jobs+1, endpoint=True))
-        indices_chunk = np.searchsorted(hit_counts_acc, indices_tile, side='left')
-        indices_chunk = np.unique(indices_chunk).astype(np.uint64)
+        # the limits on the tiles per job are for memory: keep them as hard caps
+        indices_chunk = common.divide_by_cost(chunk_costs, N_jobs, counts=hit_counts, max_count=max_tile_cap)
         out_ts = self.ts_spec
         bbox_regions = shapely.box(bboxes[:,0], bboxes[:,1], bboxes[:,2], bboxes[:,3])
         bboxes_unions = []
@@ -1081,6 +1504,7 @@ class VolumeRenderer:
                 continue
             mindx = midx_hits[idx0:idx1]
             b_flag = {z: check_points[z][mindx] for z in z_to_render if (z in check_points)}
+            cost_features = {s: float(np.sum(v[idx0:idx1])) for s, v in chunk_features.items()}
             bkw = { 'task_id': task_id,
                     'loaders': loaders,
                     'meshes': {},
@@ -1089,19 +1513,96 @@ class VolumeRenderer:
                     'target_resolution': self.resolution,
                     'mip': self.mip,
                     'offset': self._offset,
+                    'max_pending_commits': self._max_pending_commits,
+                    'cost_features': cost_features,
                     'flags': b_flag}
+            if render_plans is not None:
+                bkw['render_plans'] = render_plans
             task_id = task_id + 1
             render_seriers.append(bkw)
             bboxes_unions.append(unary_union(bbox_regions[idx0:idx1]))
-        for z, mesh in full_meshes.items():
-            submeshes = mesh.submeshes_from_regions(bboxes_unions, save_material=None, buffer=b_dilate)
-            for msh, bkw in zip(submeshes, render_seriers):
+        if render_plans is not None:
+            # the workers build the renderers from the plans
+            return render_seriers, check_points
+        if lazy:
+            render_seriers = VolumeRenderer._attach_submeshes(render_seriers, bboxes_unions, full_meshes, b_dilate)
+        else:
+            for z, mesh in full_meshes.items():
+                submeshes = mesh.submeshes_from_regions(bboxes_unions, save_material=None, buffer=b_dilate)
+                for msh, bkw in zip(submeshes, render_seriers):
+                    if msh is None:
+                        bkw['meshes'][z] = None
+                    else:
+                        msh_dict = msh.get_init_dict(save_material=True, vertex_flags=(const.MESH_GEAR_INITIAL, const.MESH_GEAR_MOVING), filter_material=False)
+                        bkw['meshes'][z] = msh_dict
+        return render_seriers, check_points
+
+
+    def _source_tile_counts(self, mesh, loader, tidx, idxt, num_xy_grids):
+        """
+        number of source tiles of the loader each chunk reads from, estimated
+        by the source positions of the triangles inside the chunks.
+        Args:
+            mesh: the mesh of the section at the render resolution.
+            loader: the image loader of the section.
+            tidx, idxt: triangle - chunk index pairs of the triangles inside.
+            num_xy_grids: total number of chunks.
+        Return:
+            counts(ndarray): source tile count of each chunk. Zeros if the
+                loader is not divided into tiles.
+        """
+        counts = np.zeros(num_xy_grids, dtype=np.float64)
+        loader = VolumeRenderer._get_loader(loader, mip=self.mip)
+        if (loader is None) or (not hasattr(loader, 'file_bboxes')) or (tidx.size == 0):
+            return counts
+        file_bboxes = np.array(list(loader.file_bboxes(margin=0))).reshape(-1, 4)
+        if file_bboxes.shape[0] == 0:
+            return counts
+        src_centers = mesh.triangle_centers(gear=const.MESH_GEAR_INITIAL) + mesh.offset(gear=const.MESH_GEAR_INITIAL)
+        src_centers = spatial.scale_coordinates(src_centers[tidx], mesh.resolution / loader.resolution)
+        tile_tree = shapely.STRtree(shapely.box(file_bboxes[:,0], file_bboxes[:,1], file_bboxes[:,2], file_bboxes[:,3]))
+        pidx, fidx = tile_tree.query(shapely.points(src_centers), predicate='intersects')
+        chunk_tile = np.unique(idxt[pidx] * file_bboxes.shape[0] + fidx)
+        counts += np.bincount(chunk_tile // file_bboxes.shape[0], minlength=num_xy_grids)
+        return counts
+
+
+    def _prepare_render_plans(self, meshes, num_workers=1, **kwargs):
+        """
+        make sure the render plans of the meshes exist in render_plan_dir, and
+        compile the missing ones in parallel.
+        Return:
+            render_plans(dict): z -> render plan file. None if nothing to render.
+        """
+        render_plans = {}
+        args_list = []
+        for z, mesh in meshes.items():
+            plan_file = storage.join_paths(self._render_plan_dir, MeshRenderer.plan_key(mesh, **kwargs) + '.h5')
+            if storage.file_exists(plan_file):
+                render_plans[z] = plan_file
+            else:
+                msh_dict = mesh.get_init_dict(save_material=True, vertex_flags=(const.MESH_GEAR_INITIAL, const.MESH_GEAR_MOVING), filter_material=False)
+                args_list.append((z, msh_dict))
+        target_func = partial(subprocess_compile_render_plan, render_plan_dir=self._render_plan_dir, **kwargs)
+        for z, plan_file in submit_to_workers(target_func, args=args_list, num_workers=num_workers):
+            render_plans[z] = plan_file
+        return render_plans
+
+
+    @staticmethod
+    def _attach_submeshes(render_seriers, regions, full_meshes, buffer):
+        """yield the rendering tasks with the submeshes in their regions filled in."""
+        for bkw, rgn in zip(render_seriers, regions):
+            meshes = {}
+            for z, mesh in full_meshes.items():
+                msh = mesh.submeshes_from_regions(rgn, save_material=None, buffer=buffer)[0]
                 if msh is None:
-                    bkw['meshes'][z] = None
+                    meshes[z] = None
                 else:
-                    msh_dict = msh.get_init_dict(save_material=True, vertex_flags=(const.MESH_GEAR_INITIAL, const.MESH_GEAR_MOVING), filter_material=False)
-                    bkw['meshes'][z] = msh_dict
-        return render_seriers, check_points
+                    meshes[z] = msh.get_init_dict(save_material=True, vertex_flags=(const.MESH_GEAR_INITIAL, const.MESH_GEAR_MOVING), filter_material=False)
+            task = bkw.copy()
+            task['meshes'] = meshes
+            yield task
 
 
     def render_volume(self, skip_indx=None , **kwargs):
@@ -1121,26 +1622,36 @@ class VolumeRenderer:
             flag_name = f'z{Z0[z_ind]}_{Z1[z_ind]}'
             flag_file = storage.join_paths(self.flag_dir, flag_name + '.json')
             checkpoint_file = storage.join_paths(self.checkpoint_dir, flag_name + '.h5')
-            render_seriers, checkpoints = self.plan_one_slab(z_ind=z_ind, num_workers=num_workers, flag_name=flag_name, max_tile_per_job=max_tile_per_job, cache_capacity=cache_capacity)
-            if len(render_seriers) == 0:
+            render_seriers, checkpoints = self.plan_one_slab(z_ind=z_ind, num_workers=num_workers, flag_name=flag_name, max_tile_per_job=max_tile_per_job,
+                                                             cache_capacity=cache_capacity, lazy=True, loader_config=kwargs.get('loader_config', {}))
+            render_seriers = iter(render_seriers)
+            first_task = next(render_seriers, None)
+            if first_task is None:
                 continue
-            morton_LUT = {s['task_id']: s['morton_indx'] for s in render_seriers}
+            morton_LUT = {}
+            cost_LUT = {}
             if cache_capacity is None:
                 max_tasks_per_child = None
             else:
                 max_tasks_per_child = 1
             logger.info(f'start rendering block z={Z0[z_ind]}->{Z1[z_ind]}')
-            actual_num_workers = min(num_workers, len(render_seriers))
-            for bkw in render_seriers:
-                bkw.update(kwargs)
+            def task_generator():
+                for bkw in itertools.chain((first_task,), render_seriers):
+                    morton_LUT[bkw['task_id']] = bkw['morton_indx']
+                    cost_LUT[bkw['task_id']] = bkw.pop('cost_features')
+                    bkw.update(kwargs)
+                    bkw['logger'] = logger_info
+                    yield bkw
             t_check = time.time()
             res_cnt = 0
-            for res in submit_to_workers(subprocess_render_partial_ts_slab, kwargs=render_seriers, num_workers=actual_num_workers, max_tasks_per_child=max_tasks_per_child):
-                task_id, flag_b, errmsg = res
+            for res in submit_to_workers(subprocess_render_partial_ts_slab, kwargs=task_generator(), num_workers=num_workers, max_tasks_per_child=max_tasks_per_child):
+                task_id, flag_b, errmsg, t_task = res
                 res_cnt += 1
                 if len(errmsg) > 0:
                     err_raised = True
                     logger.error(errmsg)
+                elif t_task is not None:
+                    self.cost_model.record(cost_LUT[task_id], t_task)
                 morton_idx = morton_LUT[task_id]
                 added_chunk = np.zeros(morton_idx.size, dtype=bool)
                 for zz, flg in flag_b.items():
@@ -1172,6 +1683,8 @@ class VolumeRenderer:
                             json.dump(z_rendered, f)
                     if not err_raised and (checkpoint_file is not None):
                         storage.remove_file(checkpoint_file)
+            self.cost_model.save()
+            self.cost_model.fit()
             logger.info(f'blocks z={Z0[z_ind]}->{Z1[z_ind]}: added {num_chunks} chunks | {(time.time()-t0)/60} min')
         return self.writer.spec
 
@@ -1212,6 +1725,13 @@ class VolumeRenderer:
                 yield R, M
 
 
+    @property
+    def cost_model(self):
+        if not hasattr(self, '_cost_model'):
+            self._cost_model = common.RenderCostModel(self._cost_weights, record_file=self._cost_model_file)
+        return self._cost_model
+
+
     @property
     def mesh_lut(self):
         if not hasattr(self, '_mesh_lut'):
@@ -1382,30 +1902,51 @@ class VolumeRenderer:
         return loader
 
 
+def subprocess_compile_render_plan(z, mesh, render_plan_dir, **kwargs):
+    M = VolumeRenderer._get_mesh(mesh)
+    return z, MeshRenderer.cached_plan_file(M, render_plan_dir, **kwargs)
+
+
 def subprocess_render_partial_ts_slab(loaders, meshes, morton_indx, out_ts, **kwargs):
+    t0 = time.time()
     task_id = kwargs.pop('task_id', None)
     target_resolution = kwargs.pop('target_resolution')
     mip = kwargs.pop('mip', None)
     loader_config = kwargs.pop('loader_config', {})
     offset = kwargs.pop('offset', np.zeros((1,2), dtype=np.int64))
     flags0 = kwargs.pop('flags', {})
+    logger_info = kwargs.pop('logger', None)
+    max_pending_commits = kwargs.pop('max_pending_commits', 0)
+    render_plans = {int(z): fname for z, fname in kwargs.pop('render_plans', {}).items()}
     flags = {}
     loaders = {int(z): VolumeRenderer._get_loader(ldr, mip=mip) for z, ldr in loaders.items()}
     meshes = {int(z): VolumeRenderer._get_mesh(msh) for z, msh in meshes.items()}
+    if isinstance(out_ts, dal.TensorStoreWriter):
+        writer = out_ts
+    else:
+        writer = dal.TensorStoreWriter.from_json_spec(out_ts)
+    id_x, id_y = writer.morton_xy_grid(morton_indx)
+    bboxes_out = writer.grid_indices_to_bboxes(id_x, id_y)
+    bboxes = bboxes_out - np.tile(offset, 2).reshape(1, 4)
     zindx = []
     renderers = {}
     to_skip = True
     err_str = ''
-    for z in set(loaders.keys()).intersection(set(meshes.keys())):
+    for z in set(loaders.keys()).intersection(set(meshes.keys()).union(render_plans.keys())):
         ldr = loaders[z]
-        msh = meshes[z]
-        if (ldr is None) or (msh is None):
+        msh = meshes.get(z, None)
+        plan = render_plans.get(z, None)
+        if (ldr is None) or ((msh is None) and (plan is None)):
             rndr = None
         elif (z in flags0) and (not np.any(flags0[z])):
             rndr = None
         else:
-            msh.change_resolution(target_resolution)
-            rndr = MeshRenderer.from_mesh(msh, **loader_config)
+            if plan is not None:
+                rndr = MeshRenderer.from_plan(plan, resolution=target_resolution,
+                                              bbox=common.bbox_union(bboxes), **loader_config)
+            else:
+                msh.change_resolution(target_resolution)
+                rndr = MeshRenderer.from_mesh(msh, **loader_config)
             if rndr is not None:
                 rndr.link_image_loader(ldr)
                 zindx.append(z)
@@ -1415,14 +1956,14 @@ def subprocess_render_partial_ts_slab(loaders, meshes, morton_indx, out_ts, **kw
                     to_skip = False
         renderers[z] = rndr
     if to_skip:
-        return task_id, flags, err_str
-    if isinstance(out_ts, dal.TensorStoreWriter):
-        writer = out_ts
-    else:
-        writer = dal.TensorStoreWriter.from_json_spec(out_ts)
-    id_x, id_y = writer.morton_xy_grid(morton_indx)
-    bboxes_out = writer.grid_indices_to_bboxes(id_x, id_y)
-    bboxes = bboxes_out - np.tile(offset, 2).reshape(1, 4)
+        return task_id, flags, err_str, None
+    pending_commits = deque()
+    def _finish_oldest_commit():
+        # chunks are only flagged as rendered once their commit succeeded
+        kb0, flags_b0, commit, bbox_3d0, imgs0 = pending_commits.popleft()
+        writer.finish_commit(commit, bboxes=bbox_3d0, imgs=imgs0)
+        for z in flags_b0:
+            flags[z][kb0] = False
     for kb in range(len(bboxes)):
         bbox, bbox_out = bboxes[kb], bboxes_out[kb]
         updated = False
@@ -1450,7 +1991,13 @@ def subprocess_render_partial_ts_slab(loaders, meshes, morton_indx, out_ts, **kw
                     err_str = err_str + f'\tz={z} {err}\n'
         if updated:
             try:
-                writer.write_chunks_w_transaction(bboxes=bbox_3d, imgs=imgs)
+                if max_pending_commits > 0:
+                    while len(pending_commits) >= max_pending_commits:
+                        _finish_oldest_commit()
+                    commit = writer.write_chunks_async(bboxes=bbox_3d, imgs=imgs)
+                    pending_commits.append((kb, flags_b, commit, bbox_3d, imgs))
+                else:
+                    writer.write_chunks_w_transaction(bboxes=bbox_3d, imgs=imgs)
             except Exception as err:
                 if isinstance(err, TimeoutError):
                     err_str = err_str + f'\tcommit error: Tensorstore timed out.\n'
@@ -1458,12 +2005,28 @@ def subprocess_render_partial_ts_slab(loaders, meshes, morton_indx, out_ts, **kw
                     err_str = err_str + f'\tcommit error: {err}\n'
                 break
             else:
-                for z in flags_b:
-                    flags[z][kb] = False
+                if max_pending_commits == 0:
+                    for z in flags_b:
+                        flags[z][kb] = False
+    while len(pending_commits) > 0:
+        try:
+            _finish_oldest_commit()
+        except Exception as err:
+            if isinstance(err, TimeoutError):
+                err_str = err_str + '\tcommit error: Tensorstore timed out.\n'
+            else:
+                err_str = err_str + f'\tcommit error: {err}\n'
     for z in zindx:
         val = flags[z]
         if not np.any(val):
             flags[z] = False
         elif np.all(val):
             flags[z] = True
-    return task_id, flags, err_str
+    metrics = defaultdict(float)
+    for z in zindx:
+        if not hasattr(loaders[z], 'metrics'):
+            continue
+        for key, val in loaders[z].metrics().items():
+            metrics[key] += val
+    logging.report_metrics(logging.get_logger(logger_info), metrics)
+    return task_id, flags, err_str, time.time() - t0
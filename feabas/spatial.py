@@ -558,6 +558,306 @@ def extract_coords_from_geocollections(G, convert_to_numpy=True):
     return pts
 
 
+class TriangleRasterizer:
+    """
+    Vectorized scanline rasterizer of triangle meshes. Locates the triangles
+    that enclose query points or the pixels of a regular grid, and linearly
+    interpolates vertex values within them.
+
+    Args:
+        vertices (N x 2 ndarray): x-y coordinates of the vertices.
+        triangles (M x 3 ndarray): vertex indices of the triangles.
+    Kwargs:
+        values (N x K ndarray): vertex values to interpolate by default.
+        priority (M ndarray): tie-break for locations covered by more than one
+            triangle: the triangle with the smallest priority wins, and equal
+            priorities are resolved by the triangle index.
+        eps: tolerance of the barycentric coordinates for a point on the edge
+            to be considered inside a triangle.
+    """
+    BLOCK_SIZE = 4 * 1024 * 1024    # maximum number of pixels/point-triangle pairs to process at once
+
+    def __init__(self, vertices, triangles, **kwargs):
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        values = kwargs.get('values', None)
+        priority = kwargs.get('priority', None)
+        self._eps = kwargs.get('eps', 1e-9)
+        if values is not None:
+            values = np.asarray(values, dtype=np.float64).reshape(self.vertices.shape[0], -1)
+        self._values = values
+        self._value_coef = None
+        tri_pt = self.vertices[self.triangles]
+        self._tri_min = tri_pt.min(axis=1)
+        self._tri_max = tri_pt.max(axis=1)
+        # barycentric coordinates as affine functions: b_i = c[i,0]*x + c[i,1]*y + c[i,2]
+        x0, x1, x2 = tri_pt[:,0,0], tri_pt[:,1,0], tri_pt[:,2,0]
+        y0, y1, y2 = tri_pt[:,0,1], tri_pt[:,1,1], tri_pt[:,2,1]
+        d = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+        self._valid = np.isfinite(d) & (d != 0)
+        d = np.where(self._valid, d, 1)
+        coef = np.empty((self.triangles.shape[0], 3, 3), dtype=np.float64)
+        coef[:,0,0] = (y1 - y2) / d
+        coef[:,0,1] = (x2 - x1) / d
+        coef[:,1,0] = (y2 - y0) / d
+        coef[:,1,1] = (x0 - x2) / d
+        coef[:,0,2] = -(coef[:,0,0] * x2 + coef[:,0,1] * y2)
+        coef[:,1,2] = -(coef[:,1,0] * x2 + coef[:,1,1] * y2)
+        coef[:,2,:] = -coef[:,0,:] - coef[:,1,:]
+        coef[:,2,2] += 1
+        self._coef = coef
+        if priority is None:
+            self._order = np.arange(self.triangles.shape[0])
+        else:
+            self._order = np.argsort(np.asarray(priority).ravel(), kind='stable')
+        self._rank = np.empty(self._order.size, dtype=np.int32)
+        self._rank[self._order] = np.arange(self._order.size)
+        # rank -> triangle id, with the sentinel rank M mapped to -1
+        self._order_ext = np.append(self._order, -1).astype(np.int32)
+        self._buckets = None
+
+
+    @property
+    def num_triangles(self):
+        return self.triangles.shape[0]
+
+
+    def rasterize(self, xs, ys, tid_out=None, bary_out=None):
+        """
+        find the triangles enclosing the pixels of a grid.
+        Args:
+            xs (ndarray): sorted x coordinates of the grid columns.
+            ys (ndarray): sorted y coordinates of the grid rows.
+        Kwargs:
+            tid_out (len(ys) x len(xs) int ndarray): preallocated output for
+                the triangle ids.
+            bary_out (len(ys) x len(xs) x 3 ndarray): if provided, fill in the
+                barycentric coordinates.
+        Return:
+            tid_out: triangle ids, -1 for pixels outside the mesh.
+            bary_out: barycentric coordinates. None if not provided.
+        """
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        ys = np.asarray(ys, dtype=np.float64).ravel()
+        nx, ny = xs.size, ys.size
+        if tid_out is None:
+            tid_out = np.empty((ny, nx), dtype=np.int32)
+        tid_out.fill(-1)
+        if (nx == 0) or (ny == 0):
+            return tid_out, bary_out
+        tidx = np.nonzero(self._valid &
+                          (self._tri_max[:,0] >= xs[0]) & (self._tri_min[:,0] <= xs[-1]) &
+                          (self._tri_max[:,1] >= ys[0]) & (self._tri_min[:,1] <= ys[-1]))[0]
+        r0 = np.searchsorted(ys, self._tri_min[tidx,1], side='left')
+        nr = np.searchsorted(ys, self._tri_max[tidx,1], side='right') - r0
+        pair_t = np.repeat(tidx, nr)
+        pair_r = np.repeat(r0 - np.cumsum(nr) + nr, nr) + np.arange(pair_t.size)
+        # column span of each triangle on each of the rows it crosses
+        C = self._coef[pair_t]
+        cst = C[:,:,1] * ys[pair_r].reshape(-1,1) + C[:,:,2] + self._eps
+        ax = C[:,:,0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bnd = -cst / ax
+        lower = np.max(np.where(ax > 0, bnd, -np.inf), axis=-1)
+        upper = np.min(np.where(ax < 0, bnd, np.inf), axis=-1)
+        c0 = np.searchsorted(xs, lower, side='left')
+        nc = (np.searchsorted(xs, upper, side='right') - c0).clip(0, None)
+        nc[np.any((ax == 0) & (cst < 0), axis=-1)] = 0
+        keep = nc > 0
+        pair_t, starts, nc = pair_t[keep], pair_r[keep] * nx + c0[keep], nc[keep]
+        best = np.full(nx * ny, self.num_triangles, dtype=self._rank.dtype)
+        ranks = self._rank[pair_t]
+        cum_nc = np.cumsum(nc)
+        splits = np.searchsorted(cum_nc, np.arange(self.BLOCK_SIZE, cum_nc[-1] if cum_nc.size > 0 else 0, self.BLOCK_SIZE), side='right')
+        for blk in np.split(np.arange(nc.size), splits):
+            if blk.size == 0:
+                continue
+            nc_b = nc[blk]
+            offset = np.repeat(starts[blk] - np.cumsum(nc_b) + nc_b, nc_b)
+            pxl_idx = offset + np.arange(offset.size)
+            np.minimum.at(best, pxl_idx, np.repeat(ranks[blk], nc_b))
+        tid_out[:] = np.take(self._order_ext, best.reshape(ny, nx))
+        if bary_out is not None:
+            for k, b in enumerate(self._evaluate_grid(self._coef.transpose(0, 2, 1), tid_out, xs, ys)):
+                bary_out[..., k] = b
+        return tid_out, bary_out
+
+
+    def find(self, x, y):
+        """
+        find the triangles enclosing a collection of points.
+        Args:
+            x, y (ndarray): the coordinates of the query points.
+        Return:
+            tid (ndarray): triangle ids of the same shape as x, -1 for points
+                outside the mesh.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        shp = x.shape
+        x, y = x.ravel(), y.ravel()
+        tid = np.full(x.size, -1, dtype=np.int32)
+        if (x.size == 0) or (not np.any(self._valid)):
+            return tid.reshape(shp)
+        origin, bsz, nbx, nby, indptr, bucket_tids = self._bucket_index()
+        bx = np.floor((x - origin[0]) / bsz)
+        by = np.floor((y - origin[1]) / bsz)
+        in_range = (bx >= 0) & (bx < nbx) & (by >= 0) & (by < nby)
+        bidx = np.where(in_range, by * nbx + bx, 0).astype(np.int64)
+        ncand = np.where(in_range, indptr[bidx+1] - indptr[bidx], 0)
+        # candidates are sorted by priority within each bucket: test them in
+        # rounds and retire each point at its first hit.
+        pending = np.nonzero(ncand > 0)[0]
+        rnd = 0
+        while pending.size > 0:
+            px, py = x[pending], y[pending]
+            t = bucket_tids[indptr[bidx[pending]] + rnd]
+            C = self._coef[t, :2]
+            b0 = C[:,0,0] * px + C[:,0,1] * py + C[:,0,2]
+            b1 = C[:,1,0] * px + C[:,1,1] * py + C[:,1,2]
+            hit = (b0 >= -self._eps) & (b1 >= -self._eps) & (b0 + b1 <= 1 + self._eps)
+            tid[pending[hit]] = t[hit]
+            rnd += 1
+            pending = pending[(~hit) & (ncand[pending] > rnd)]
+        return tid.reshape(shp)
+
+
+    def barycentric(self, x, y, tid=None):
+        """
+        barycentric coordinates of a collection of points.
+        Args:
+            x, y (ndarray): the coordinates of the query points.
+        Kwargs:
+            tid (ndarray): triangle ids of the points. Computed if not given.
+        Return:
+            tid (ndarray): triangle ids of the points, -1 if outside.
+            B (ndarray): barycentric coordinates of shape x.shape + (3,), NaN
+                for points outside the mesh.
+        """
+        if tid is None:
+            tid = self.find(x, y)
+        B = self._evaluate_points(self._coef.transpose(0, 2, 1), tid, x, y)
+        return tid, B
+
+
+    def affine_coefficients(self, values=None):
+        """
+        the linear interpolation of the vertex values as affine functions.
+        Kwargs:
+            values (N x K ndarray): vertex values. Default to the values given
+                at initialization.
+        Return:
+            coefficients (M x 3 x K ndarray): within triangle t, the value k at
+                (x, y) is coef[t,0,k]*x + coef[t,1,k]*y + coef[t,2,k].
+        """
+        if values is None:
+            if self._value_coef is None:
+                if self._values is None:
+                    raise ValueError('no vertex values to interpolate.')
+                self._value_coef = self.affine_coefficients(self._values)
+            return self._value_coef
+        values = np.asarray(values, dtype=np.float64).reshape(self.vertices.shape[0], -1)
+        return np.einsum('mij,mik->mjk', self._coef, values[self.triangles])
+
+
+    def interpolate(self, x, y, values=None, tid=None):
+        """
+        linearly interpolate vertex values at a collection of points.
+        Args:
+            x, y (ndarray): the coordinates of the query points.
+        Kwargs:
+            values (N x K ndarray): vertex values. Default to the values given
+                at initialization.
+            tid (ndarray): triangle ids of the points. Computed if not given.
+        Return:
+            list of K masked arrays of the same shape as x, masked outside the
+            mesh.
+        """
+        if tid is None:
+            tid = self.find(x, y)
+        V = self._evaluate_points(self.affine_coefficients(values), tid, x, y)
+        mask = np.broadcast_to((tid < 0)[..., None], V.shape)
+        return [np.ma.MaskedArray(V[..., k], mask=mask[..., k]) for k in range(V.shape[-1])]
+
+
+    def interpolate_grid(self, xs, ys, values=None, tid=None):
+        """
+        linearly interpolate vertex values on the pixels of a grid.
+        Args:
+            xs (ndarray): sorted x coordinates of the grid columns.
+            ys (ndarray): sorted y coordinates of the grid rows.
+        Kwargs:
+            values (N x K ndarray): vertex values. Default to the values given
+                at initialization.
+            tid (len(ys) x len(xs) ndarray): triangle ids of the grid pixels.
+                Computed if not given.
+        Return:
+            list of K masked arrays of shape len(ys) x len(xs), masked outside
+            the mesh.
+        """
+        if tid is None:
+            tid, _ = self.rasterize(xs, ys)
+        V = self._evaluate_grid(self.affine_coefficients(values), tid, xs, ys)
+        mask = tid < 0
+        return [np.ma.MaskedArray(v, mask=mask) for v in V]
+
+
+    def _bucket_index(self):
+        # uniform grid of buckets, each listing the triangles overlapping it
+        if self._buckets is None:
+            vidx = np.nonzero(self._valid)[0]
+            tmin, tmax = self._tri_min[vidx], self._tri_max[vidx]
+            origin = tmin.min(axis=0)
+            extent = tmax.max(axis=0) - origin
+            bsz = max(np.median(np.max(tmax - tmin, axis=-1)) / 2, 1e-6)
+            bsz = max(bsz, np.sqrt(np.prod(extent + bsz) / (4 * vidx.size + 1)))
+            nbx, nby = (np.floor(extent / bsz).astype(np.int64) + 1)
+            bmin = np.floor((tmin - origin) / bsz).astype(np.int64)
+            bmax = np.floor((tmax - origin) / bsz).astype(np.int64)
+            wx = bmax[:,0] - bmin[:,0] + 1
+            cnt = wx * (bmax[:,1] - bmin[:,1] + 1)
+            pair_t = np.repeat(np.arange(vidx.size), cnt)
+            k = np.arange(pair_t.size) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+            bx = bmin[pair_t, 0] + k % wx[pair_t]
+            by = bmin[pair_t, 1] + k // wx[pair_t]
+            bucket = by * nbx + bx
+            srt = np.lexsort((self._rank[vidx[pair_t]], bucket))
+            indptr = np.zeros(nbx * nby + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum(np.bincount(bucket, minlength=nbx * nby))
+            self._buckets = (origin, bsz, nbx, nby, indptr, vidx[pair_t[srt]])
+        return self._buckets
+
+
+    @staticmethod
+    def _evaluate_points(coef, tid, x, y):
+        tid = np.asarray(tid)
+        x = np.broadcast_to(np.asarray(x, dtype=np.float64), tid.shape)
+        y = np.broadcast_to(np.asarray(y, dtype=np.float64), tid.shape)
+        if coef.shape[0] == 0:
+            return np.full(tid.shape + coef.shape[-1:], np.nan)
+        C = coef[tid.clip(0, None)]
+        V = C[...,0,:] * x[..., None] + C[...,1,:] * y[..., None] + C[...,2,:]
+        V[tid < 0] = np.nan
+        return V
+
+
+    @staticmethod
+    def _evaluate_grid(coef, tid, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64).reshape(1, -1)
+        ys = np.asarray(ys, dtype=np.float64).reshape(-1, 1)
+        outside = tid < 0
+        if coef.shape[0] == 0:
+            return [np.full(tid.shape, np.nan) for _ in range(coef.shape[-1])]
+        V = []
+        for k in range(coef.shape[-1]):
+            fld = np.take(coef[:,0,k], tid, mode='clip') * xs
+            fld += np.take(coef[:,1,k], tid, mode='clip') * ys
+            fld += np.take(coef[:,2,k], tid, mode='clip')
+            fld[outside] = np.nan
+            V.append(fld)
+        return V
+
+
 class Geometry:
     """
     Class to represent a collection of 2d geometries that defines the shapes of
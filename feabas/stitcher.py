@@ -3,7 +3,6 @@ from collections import defaultdict, namedtuple
 from functools import partial
 import gc
 import json
-import matplotlib.tri
 import numpy as np
 import os
 from rtree import index
@@ -17,11 +16,11 @@ import time
 
 from feabas.concurrent import submit_to_workers
 from feabas.dal import StaticImageLoader, TensorStoreWriter
-from feabas.matcher import stitching_matcher
+from feabas.matcher import stitching_matcher, get_spectrum_cache
 from feabas.mesh import Mesh
 from feabas.optimizer import SLM, relax_mesh_most_deformed
 from feabas import common, caching, storage, logging
-from feabas.spatial import scale_coordinates, fit_affine
+from feabas.spatial import scale_coordinates, fit_affine, TriangleRasterizer
 import feabas.constant as const
 from feabas.config import SECTION_THICKNESS, data_resolution, CHECKPOINT_TIME_INTERVAL, MAXIMUM_DEFORM_ALLOWED, get_numpy_thread
 
@@ -377,21 +376,19 @@ class Stitcher:
         N_jobs = max(1, round(num_overlaps / num_overlaps_per_job))
         indx_j = np.linspace(0, num_overlaps, num=N_jobs+1, endpoint=True)
         indx_j = np.unique(np.round(indx_j).astype(np.int32))
-        # divide works
-        args_list = []
-        kwargs_list = []
+        # divide works, generated lazily as the workers become available
+        def job_generator():
+            for idx0, idx1 in zip(indx_j[:-1], indx_j[1:]):
+                ovlp_g = overlaps[idx0:idx1] # global indices of overlaps
+                mapper, ovlp = np.unique(ovlp_g, return_inverse=True, axis=None)
+                ovlp = ovlp.reshape(ovlp_g.shape)
+                bboxes = self.init_bboxes[mapper]
+                imgpaths = [self.imgrelpaths[s] for s in mapper]
+                yield {'overlaps': ovlp, 'imgpaths': imgpaths, 'bboxes': bboxes, 'index_mapper': mapper}
         num_new_matches = 0
         err_raised = False
-        for idx0, idx1 in zip(indx_j[:-1], indx_j[1:]):
-            ovlp_g = overlaps[idx0:idx1] # global indices of overlaps
-            mapper, ovlp = np.unique(ovlp_g, return_inverse=True, axis=None)
-            ovlp = ovlp.reshape(ovlp_g.shape)
-            bboxes = self.init_bboxes[mapper]
-            imgpaths = [self.imgrelpaths[s] for s in mapper]
-            args_list.append((ovlp, imgpaths, bboxes))
-            kwargs_list.append({'index_mapper': mapper})
         matched_counter = 0
-        for res in submit_to_workers(target_func, args=args_list, kwargs=kwargs_list, num_workers=num_workers):
+        for res in submit_to_workers(target_func, kwargs=job_generator(), num_workers=num_workers):
             matches, match_strains, brightness_contrast, ouch = res
             err_raised = err_raised or ouch
             num_new_matches += len(matches)
@@ -512,6 +509,7 @@ class Stitcher:
         image_to_mask_path = kwargs.get('image_to_mask_path', None)
         loader_config = kwargs.get('loader_config', {}).copy()
         matcher_config = kwargs.get('matcher_config', {}).copy()
+        matcher_config['spectrum_cache'] = get_spectrum_cache(matcher_config.get('spectrum_cache', None))
         instant_gc = kwargs.get('instant_gc', False)
         logger_info = kwargs.get('logger', None)
         logger = logging.get_logger(logger_info)
@@ -615,6 +613,7 @@ class Stitcher:
             error_messages[0] = error_messages[0].replace('<NUM_ERRORS>', str(err_count))
             msg = '\n'.join(error_messages)
             logger.error(msg)
+        logging.report_metrics(logger, image_loader.metrics())
         image_loader.clear_cache()
         if instant_gc:
             gc.collect()
@@ -1293,6 +1292,10 @@ class MontageRenderer:
         root_dir(str): if set, the paths in filepaths are relative path to this
             root directory.
     """
+    # cost of rendering an output tile per: the tile itself; source tile
+    # overlapping it.
+    DEFAULT_COST_WEIGHTS = {'chunks': 1.0, 'source_tiles': 0.5}
+
     def __init__(self, imgpaths, mesh_info, tile_sizes, **kwargs):
         self.resolution = kwargs.get('resolution', data_resolution())
         self._loader_settings = kwargs.get('loader_settings', {}).copy()
@@ -1311,6 +1314,7 @@ class MontageRenderer:
         self._affine_approximators = None
         self._rtree = None
         self._image_loader = None
+        self._blend_cache = None
 
 
     @classmethod
@@ -1366,6 +1370,7 @@ class MontageRenderer:
     def clear_cache(self, instant_gc=False):
         self._interpolants = None
         self._rtree = None
+        self._blend_cache = None
         if self._image_loader is not None:
             self._image_loader.clear_cache(instant_gc=False)
             self._image_loader = None
@@ -1446,10 +1451,8 @@ class MontageRenderer:
         wd0 = round(bbox[2] - x_min0)
         x0 = np.arange(x_min0, x_min0+wd0, 1/scale)
         y0 = np.arange(y_min0, y_min0+ht0, 1/scale)
+        bufs = None
         image_hp = None
-        image_lp = None
-        weight_sum = None
-        weight_max = None
         for hit in hits:
             indx = hit.id
             bbox_mesh = common.bbox_enlarge(hit.bbox, 2)
@@ -1460,39 +1463,33 @@ class MontageRenderer:
             slc_y = slice(np.min(msk_y), np.max(msk_y)+1, None)
             x_msh = x0[slc_x]
             y_msh = y0[slc_y]
-            xx, yy = np.meshgrid(x_msh, y_msh)
             offset = self._mesh_info[indx].moving_offsets.ravel()
-            xxt = xx - offset[0]
-            yyt = yy - offset[1]
             field_generated = False
             if affine_tolerance > 0:
                 A, t, res = self.affine_approximators[indx]
                 if res < affine_tolerance:
+                    xxt = (x_msh - offset[0]).reshape(1, -1)
+                    yyt = (y_msh - offset[1]).reshape(-1, 1)
                     x_field = xxt * A[0,0] + yyt * A[1,0] + t[0]
                     y_field = xxt * A[0,1] + yyt * A[1,1] + t[1]
                     field_generated = True
             if not field_generated:
-                x_interp, y_interp = self.interpolators[indx]
-                map_x = x_interp(xxt, yyt)
+                map_x, map_y = self.interpolators[indx].interpolate_grid(x_msh - offset[0], y_msh - offset[1])
                 mask = map_x.mask
                 if np.all(mask, axis=None):
                     continue
-                map_y = y_interp(xxt, yyt)
                 x_field = np.nan_to_num(map_x.data, nan=-1, copy=False)
                 y_field = np.nan_to_num(map_y.data, nan=-1, copy=False)
             tile_ht, tile_wd = self.tile_size(indx)
-            weight = np.minimum.reduce([x_field - clip_ltrb[0] + 0.5,
-                                    - x_field + tile_wd - clip_ltrb[2] - 0.5,
-                                    y_field - clip_ltrb[1] + 0.5,
-                                    - y_field + tile_ht - clip_ltrb[3] - 0.5])
+            weight = MontageRenderer._distance_to_tile_edges(x_field, y_field, tile_wd, tile_ht, clip_ltrb)
             mask = weight > 0
             if not np.any(mask, axis=None):
                 continue
-            expand_image = partial(common.expand_image, target_size=(y0.size, x0.size), slices=(slc_y, slc_x))
             imgt = common.render_by_subregions(x_field, y_field, mask, self.image_loader, fileid=indx, **kwargs)
             if imgt is None:
                 continue
             if blend is None:
+                expand_image = partial(common.expand_image, target_size=(y0.size, x0.size), slices=(slc_y, slc_x))
                 image_hp = expand_image(imgt)
                 weight_sum = expand_image(weight)
                 break
@@ -1504,56 +1501,61 @@ class MontageRenderer:
                     dist_mask = distance_transform_cdt(~mask_backgrnd)
                     weight = np.minimum(weight, dist_mask-1)
             if not np.issubdtype(imgt.dtype, np.floating):
-                imgt = imgt.astype(np.float32, copy=False)
-            imgshp = imgt.shape
+                imgt = imgt.astype(np.float32)
             weight = weight.clip(0, None).astype(np.float32)
-            if len(imgshp) > 2:
-                weight = np.stack((weight, )*imgt.shape[-1], axis=-1)
-            if image_hp is None:
-                image_hp = np.zeros_like(expand_image(imgt))
-                image_lp = np.zeros_like(image_hp)
-                weight_sum = np.zeros_like(expand_image(weight))
-                weight_max = np.zeros_like(weight_sum)
-                if blend == 'MAX':
-                    image_hp = image_hp - np.inf
-                elif blend == 'MIN':
-                    image_hp = image_hp + np.inf
-            weight_sum += expand_image(weight)
+            if bufs is None:
+                bufs = self._blend_buffers((y0.size, x0.size) + imgt.shape[2:], imgt.dtype, blend)
+                image_hp, image_lp, weight_sum, weight_max = bufs
+            # accumulate into the window of the output covered by the tile only
+            win = (slc_y, slc_x)
+            weight_sum[win] += weight
+            weight_c = weight.reshape(weight.shape + (1,) * (imgt.ndim - 2))
             if blend == 'LINEAR':
-                image_hp = expand_image(imgt * weight) + image_hp
+                imgt *= weight_c
+                image_hp[win] += imgt
             elif blend == 'NEAREST':
-                maskb = expand_image(weight) > weight_max
-                image_hp[maskb] = expand_image(imgt)[maskb]
-                weight_max[maskb] = expand_image(weight)[maskb]
+                maskb = weight > weight_max[win]
+                image_hp[win][maskb] = imgt[maskb]
+                weight_max[win][maskb] = weight[maskb]
             elif blend == 'PYRAMID':
-                sigmas = [sigma, sigma] + [0]*(len(imgshp)-2)
+                sigmas = [sigma, sigma] + [0]*(imgt.ndim-2)
                 imgt_f = gaussian_filter(imgt, sigma=sigmas)
-                imgt_h = imgt - imgt_f
-                image_lp = expand_image(imgt_f * weight) + image_lp
-                maskb = expand_image(weight) > weight_max
-                image_hp[maskb] = expand_image(imgt_h)[maskb]
-                weight_max[maskb] = expand_image(weight)[maskb]
+                imgt -= imgt_f
+                imgt_f *= weight_c
+                image_lp[win] += imgt_f
+                maskb = weight > weight_max[win]
+                image_hp[win][maskb] = imgt[maskb]
+                weight_max[win][maskb] = weight[maskb]
             elif blend == 'MAX':
-                maskb = expand_image(weight > 0)
-                image_hp[maskb] = np.maximum(image_hp[maskb], expand_image(imgt)[maskb])
+                maskb = weight > 0
+                image_hp[win][maskb] = np.maximum(image_hp[win][maskb], imgt[maskb])
             elif blend == 'MIN':
-                maskb = expand_image(weight > 0)
-                maskb = cv2.erode(maskb.astype(np.uint8), np.ones((3,3)))>0
-                image_hp[maskb] = np.minimum(image_hp[maskb], expand_image(imgt)[maskb])
+                maskb = cv2.erode((weight > 0).astype(np.uint8), np.ones((3,3))) > 0
+                # pixels on the window edges inside the output tile border the
+                # unrendered area
+                if slc_y.start > 0:
+                    maskb[0] = False
+                if slc_y.stop < y0.size:
+                    maskb[-1] = False
+                if slc_x.start > 0:
+                    maskb[:, 0] = False
+                if slc_x.stop < x0.size:
+                    maskb[:, -1] = False
+                image_hp[win][maskb] = np.minimum(image_hp[win][maskb], imgt[maskb])
             elif blend == 'NONE':
-                maskb = expand_image(weight > 0)
-                image_hp[maskb] = expand_image(imgt)[maskb]
+                maskb = weight > 0
+                image_hp[win][maskb] = imgt[maskb]
             else:
                 raise ValueError(f'unsupported blending mode {blend}')
-        if image_hp is None:
+        if image_hp is None:    # no tile rendered
             return None
         if blend == 'LINEAR':
-            img_out = image_hp / weight_sum.clip(weight_eps, None)
+            img_out = image_hp / weight_sum.clip(weight_eps, None).reshape(weight_sum.shape + (1,) * (image_hp.ndim - 2))
         elif blend == 'PYRAMID':
-            image_lp = image_lp / weight_sum.clip(weight_eps, None)
+            image_lp /= weight_sum.clip(weight_eps, None).reshape(weight_sum.shape + (1,) * (image_hp.ndim - 2))
             img_out = image_lp + image_hp
         else:
-            img_out = image_hp
+            img_out = image_hp.copy()
         img_out[weight_sum <= weight_eps] = fillval
         if np.issubdtype(dtype_out, np.integer):
             iinfo = np.iinfo(dtype_out)
@@ -1564,6 +1566,43 @@ class MontageRenderer:
         return img_out
 
 
+    @staticmethod
+    def _distance_to_tile_edges(x_field, y_field, tile_wd, tile_ht, clip_ltrb=(0,0,0,0)):
+        """
+        distance (in source pixels) of the source coordinates to the nearest
+        edge of the valid region of the source tile, used as blending weight.
+        """
+        weight = x_field - (clip_ltrb[0] - 0.5)
+        np.minimum(weight, (tile_wd - clip_ltrb[2] - 0.5) - x_field, out=weight)
+        np.minimum(weight, y_field - (clip_ltrb[1] - 0.5), out=weight)
+        np.minimum(weight, (tile_ht - clip_ltrb[3] - 0.5) - y_field, out=weight)
+        return weight
+
+
+    def _blend_buffers(self, shape, dtype, blend):
+        """
+        accumulators of the blending (image_hp, image_lp, weight_sum, weight_max)
+        for an output tile of the given shape. They are allocated once and
+        reused by later crops of the same output tile size.
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        if (self._blend_cache is None) or (self._blend_cache[0] != key):
+            self._blend_cache = (key, (np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype),
+                                       np.empty(shape[:2], dtype=np.float32), np.empty(shape[:2], dtype=np.float32)))
+        image_hp, image_lp, weight_sum, weight_max = self._blend_cache[1]
+        if blend == 'MAX':
+            image_hp.fill(-np.inf)
+        elif blend == 'MIN':
+            image_hp.fill(np.inf)
+        else:
+            image_hp.fill(0)
+        if blend == 'PYRAMID':
+            image_lp.fill(0)
+        weight_sum.fill(0)
+        weight_max.fill(0)
+        return image_hp, image_lp, weight_sum, weight_max
+
+
     def render_series_to_file(self, bboxes, filenames, **kwargs):
         if isinstance(filenames, (dict, ts.TensorStore, TensorStoreWriter)):
             use_tensorstore = True
@@ -1788,7 +1827,21 @@ class MontageRenderer:
 
 
     def divide_render_jobs(self, render_series, num_workers=1, **kwargs):
+        """
+        divide the output tiles into jobs of similar predicted costs.
+        Kwargs:
+            max_tile_per_job(int): maximum number of output tiles per job.
+            cost_model(common.RenderCostModel): model to predict the cost of
+                each output tile. If None, use the default weights.
+        Return:
+            bboxes_list, filenames_list, hits_list: the output tiles, output
+                names and source tiles of each job.
+            features_list: total cost features of each job.
+        """
         max_tile_per_job = kwargs.get('max_tile_per_job', None)
+        cost_model = kwargs.get('cost_model', None)
+        if cost_model is None:
+            cost_model = common.RenderCostModel(MontageRenderer.DEFAULT_COST_WEIGHTS)
         bboxes, filenames, hits = render_series
         if isinstance(bboxes, np.ndarray) and (bboxes.dtype == bool):
             bboxes = np.flatnonzero(bboxes)
@@ -1797,11 +1850,14 @@ class MontageRenderer:
         if max_tile_per_job is not None:
             num_tile_per_job = min(num_tile_per_job, max_tile_per_job)
         N_jobs = max(1, round(num_tiles / num_tile_per_job))
-        indices = np.round(np.linspace(0, num_tiles, num=N_jobs+1, endpoint=True))
-        indices = np.unique(indices).astype(np.uint32)
+        tile_features = {'chunks': np.ones(num_tiles, dtype=np.float64),
+                         'source_tiles': np.array([len(hit) for hit in hits], dtype=np.float64)}
+        indices = common.divide_by_cost(cost_model.predict(tile_features), N_jobs,
+                                        max_count=max_tile_per_job)
         bboxes_list = []
         filenames_list = []
         hits_list = []
+        features_list = []
         for idx0, idx1 in zip(indices[:-1], indices[1:]):
             idx0, idx1 = int(idx0), int(idx1)
             bboxes_list.append(bboxes[idx0:idx1])
@@ -1810,7 +1866,8 @@ class MontageRenderer:
             else:
                 filenames_list.append(filenames[idx0:idx1])
             hits_list.append(set(s for hit in hits[idx0:idx1] for s in hit))
-        return bboxes_list, filenames_list, hits_list
+            features_list.append({s: float(np.sum(v[idx0:idx1])) for s, v in tile_features.items()})
+        return bboxes_list, filenames_list, hits_list, features_list
 
 
     def tile_size(self, indx):
@@ -1881,10 +1938,7 @@ class MontageRenderer:
             self._interpolators = []
             for msh in self._mesh_info:
                 v1, T, v0 = msh.moving_vertices, msh.triangles, msh.fixed_vertices
-                mattri = matplotlib.tri.Triangulation(v1[:,0], v1[:,1], triangles=T)
-                xinterp = matplotlib.tri.LinearTriInterpolator(mattri, v0[:,0])
-                yinterp = matplotlib.tri.LinearTriInterpolator(mattri, v0[:,1])
-                self._interpolators.append((xinterp, yinterp))
+                self._interpolators.append(TriangleRasterizer(v1, T, values=v0))
         return self._interpolators
 
 
@@ -1948,6 +2002,8 @@ class MontageRenderer:
 
     @staticmethod
     def subprocess_render_montages(montage, bboxes, outnames, **kwargs):
+        t0 = time.time()
+        job_id = kwargs.pop('job_id', None)
         selected = kwargs.pop('selected', None)
         if isinstance(montage, str):
             M = MontageRenderer.from_h5(montage, selected=selected, **kwargs)
@@ -1961,7 +2017,8 @@ class MontageRenderer:
             M = montage
         else:
             raise TypeError
-        return M.render_series_to_file(bboxes, outnames, **kwargs)
+        num_chunks, rendered = M.render_series_to_file(bboxes, outnames, **kwargs)
+        return num_chunks, rendered, job_id, time.time() - t0
 
 
     def render_one_section(self, out_prefix, meta_name=None, **kwargs):
@@ -1972,6 +2029,7 @@ class MontageRenderer:
         render_settings = kwargs.get('render_settings', {}).copy()
         driver = kwargs.get('driver', 'image')
         mask_out = kwargs.get('mask_out', None)
+        cost_model_file = kwargs.get('cost_model_file', None)
         use_tensorstore = driver != 'image'
         if meta_name is not None:
             if storage.file_exists(meta_name):
@@ -2003,20 +2061,24 @@ class MontageRenderer:
                 rendered_mask[id_y, id_x] = checkpoints * 255
                 storage.makedirs(os.path.dirname(mask_out), exist_ok=True)
                 common.imwrite(mask_out, rendered_mask)
-        bboxes_list, filenames_list, hits_list = self.divide_render_jobs(render_series,
-            num_workers=num_workers, max_tile_per_job=20)
+        cost_model = common.RenderCostModel(MontageRenderer.DEFAULT_COST_WEIGHTS, record_file=cost_model_file)
+        bboxes_list, filenames_list, hits_list, features_list = self.divide_render_jobs(render_series,
+            num_workers=num_workers, max_tile_per_job=20, cost_model=cost_model)
         if not use_tensorstore:
             metadata = {}
         target_func = partial(MontageRenderer.subprocess_render_montages, **render_settings)
         args_list = []
+        kwargs_list = []
         num_chunks = 0
-        for bboxes, filenames, hits in zip(bboxes_list, filenames_list, hits_list):
+        for job_id, (bboxes, filenames, hits) in enumerate(zip(bboxes_list, filenames_list, hits_list)):
             init_args = self.init_args(selected=hits)
             args_list.append((init_args, bboxes, filenames))
+            kwargs_list.append({'job_id': job_id})
         t_check = time.time()
         res_cnt = 0
-        for res in submit_to_workers(target_func, args=args_list, num_workers=num_workers):
-            nmck, meta = res
+        for res in submit_to_workers(target_func, args=args_list, kwargs=kwargs_list, num_workers=num_workers):
+            nmck, meta, job_id, t_job = res
+            cost_model.record(features_list[job_id], t_job)
             num_chunks += nmck
             res_cnt += 1
             if use_tensorstore:
@@ -2029,6 +2091,7 @@ class MontageRenderer:
                         f.create_dataset('to_render', data=checkpoints, compression="gzip")
             else:
                 metadata.update(meta)
+        cost_model.save()
         if meta_name is not None:
             if use_tensorstore:
                 if not np.any(checkpoints):
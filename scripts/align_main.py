@@ -8,7 +8,7 @@ import time
 import gc
 
 from feabas import config, logging, storage
-from feabas.concurrent import submit_to_workers
+from feabas.concurrent import submit_to_workers, start_worker_pool
 import feabas.constant as const
 
 os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(pow(2,40)) # for large masks in meshing
@@ -99,6 +99,21 @@ def generate_mesh_main(match_list=None):
     logging.terminate_logger(*logger_info)
 
 
+def match_section_batch(tasks, out_dir, conf, **kwargs):
+    from feabas.aligner import match_section_list_from_initial_matches
+    logger_info = kwargs.pop('logger', None)
+    logger = logging.get_logger(logger_info)
+    t0 = time.time()
+    for mname, num_matches in match_section_list_from_initial_matches(tasks, out_dir, conf, logger=logger_info, **kwargs):
+        tname = os.path.basename(mname).replace('.h5', '')
+        if num_matches is not None:
+            if num_matches > 0:
+                logger.info(f'{tname}: {num_matches} matches, {round((time.time()-t0)/60,3)} min since start.')
+            else:
+                logger.warning(f'{tname}: {num_matches} matches, {round((time.time()-t0)/60,3)} min since start.')
+        gc.collect()
+
+
 def match_main(match_list):
     stitch_config = config.stitch_configs().get('rendering', {})
     loader_config = {key: val for key, val in stitch_config.items() if key in ('pattern', 'one_based', 'fillval')}
@@ -110,10 +125,41 @@ def match_main(match_list):
     else:
         stitch_dir = storage.join_paths(root_dir, 'stitch')
         spec_dir = storage.join_paths(stitch_dir, 'ts_specs')
-    logger_info = logging.initialize_main_logger(logger_name='align_matching', mp=False)
+    batched_matching = align_config.get('batched_matching', {}).copy()
+    max_active = batched_matching.get('max_active', 1)
+    logger_info = logging.initialize_main_logger(logger_name='align_matching', mp=(max_active > 1) and (num_workers > 1))
     logger = logging.get_logger(logger_info[0])
     if len(match_list) == 0:
         return
+    def _get_loaders(mname):
+        secnames = os.path.splitext(os.path.basename(mname))[0].split(match_name_delimiter)
+        if stitch_render_driver == 'image':
+            return [get_image_loader(storage.join_paths(stitched_image_dir, s), **loader_config) for s in secnames]
+        specs = [dal.get_tensorstore_spec(storage.join_paths(spec_dir, s+'.json'), mip=working_mip_level) for s in secnames]
+        loaders = [{'ImageLoaderType': 'TensorStoreLoader', 'json_spec': spec} for spec in specs]
+        for ldr in loaders:
+            ldr.update(loader_config)
+        return loaders
+    if max_active > 1:
+        # the pairs are distributed over the workers, each matching max_active
+        # pairs at a time with their blocks pooled into larger FFT batches
+        match_list = [mname for mname in match_list
+                      if not storage.file_exists(storage.join_paths(match_dir, os.path.basename(mname)), use_cache=True)]
+        conf = align_config.copy()
+        conf['loader_config'] = conf.get('loader_config', {}).copy()
+        for key in ('cache_size', 'cache_capacity'):
+            if conf['loader_config'].get(key, None) is not None:
+                conf['loader_config'][key] = conf['loader_config'][key] // (num_workers * max_active)
+        chunk_size = max(1, min(4 * max_active, math.ceil(len(match_list) / num_workers)))
+        args_list = (([(mname, mesh_dir, _get_loaders(mname), not storage.file_exists(mname))
+                       for mname in match_list[k:(k+chunk_size)]], match_dir, conf)
+                     for k in range(0, len(match_list), chunk_size))
+        target_func = partial(match_section_batch, logger=logger_info[0], **batched_matching)
+        for _ in submit_to_workers(target_func, args=args_list, num_workers=num_workers):
+            pass
+        logger.info('matching finished.')
+        logging.terminate_logger(*logger_info)
+        return
     for mname in match_list:
         outname = storage.join_paths(match_dir, os.path.basename(mname))
         if storage.file_exists(outname, use_cache=True):
@@ -121,18 +167,9 @@ def match_main(match_list):
         t0 = time.time()
         tname = os.path.basename(mname).replace('.h5', '')
         logger.info(f'start {tname}')
-        secnames = os.path.splitext(os.path.basename(mname))[0].split(match_name_delimiter)
-        if stitch_render_driver == 'image':
-            loaders = [get_image_loader(storage.join_paths(stitched_image_dir, s), **loader_config) for s in secnames]
-        else:
-            specs = [dal.get_tensorstore_spec(storage.join_paths(spec_dir, s+'.json'), mip=working_mip_level) for s in secnames]
-            loader0 = {'ImageLoaderType': 'TensorStoreLoader', 'json_spec': specs[0]}
-            loader1 = {'ImageLoaderType': 'TensorStoreLoader', 'json_spec': specs[1]}
-            loader0.update(loader_config)
-            loader1.update(loader_config)
-            loaders = [loader0, loader1]
+        loaders = _get_loaders(mname)
         ignore_initial_match = not storage.file_exists(mname)
-        num_matches = match_section_from_initial_matches(mname, mesh_dir, loaders, match_dir, align_config, ignore_initial_match=ignore_initial_match)
+        num_matches = match_section_from_initial_matches(mname, mesh_dir, loaders, match_dir, align_config, ignore_initial_match=ignore_initial_match, logger=logger)
         if num_matches is not None:
             if num_matches > 0:
                 logger.info(f'{tname}: {num_matches} matches, {round((time.time()-t0)/60,3)} min.')
@@ -424,6 +461,8 @@ if __name__ == '__main__':
 
     indx = slice(stt_idx, stp_idx, step)
     storage.makedirs(mesh_dir)
+    if mode in ('rendering', 'tensorstore_rendering') and align_config.pop('cache_render_plans', False):
+        align_config['render_plan_dir'] = storage.join_paths(align_dir, 'render_plans')
     if (mode == 'meshing') or (mode == 'matching'):
         if storage.file_exists(match_filename):
             with storage.File(match_filename, 'r') as f:
@@ -438,6 +477,7 @@ if __name__ == '__main__':
                 match_list.append(s)
         else:
             match_list = sorted(storage.list_folder_content(storage.join_paths(thumb_match_dir, '*.h5')))
+    start_worker_pool(num_workers=num_workers)
     if mode == 'meshing':
         generate_mesh_main(match_list=match_list)
     elif mode == 'matching':
@@ -4,7 +4,7 @@ import os
 import time
 
 import feabas
-from feabas.concurrent import submit_to_workers
+from feabas.concurrent import submit_to_workers, start_worker_pool
 from feabas import config, logging, storage
 
 
@@ -270,6 +270,7 @@ if __name__ == '__main__':
         stp_idx = None
     indx = slice(stt_idx, stp_idx, step)
 
+    start_worker_pool(num_workers=num_workers)
     if mode == 'rendering':
         tform_list = sorted(storage.list_folder_content(storage.join_paths(mesh_dir, '*.h5')))
         if len(args.filter) > 0:
@@ -278,6 +279,7 @@ if __name__ == '__main__':
         if args.reverse:
             tform_list = tform_list[::-1]
         stitch_configs.setdefault('meta_dir', render_meta_dir)
+        stitch_configs.setdefault('cost_model_file', storage.join_paths(stitch_dir, 'render_cost.json'))
         render_main(tform_list, image_outdir, mask_dir=render_mask_dir, histeq_dir=histeq_dir, **stitch_configs)
     elif mode == 'optimization':
         match_list = sorted(storage.list_folder_content(storage.join_paths(match_dir, '*.h5')))
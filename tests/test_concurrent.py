@@ -0,0 +1,26 @@
+import numpy as np
+
+from feabas.concurrent import submit_to_process_pool
+
+
+def _write_and_read(arr, value):
+    try:
+        arr[0] = value
+        written = True
+    except ValueError:
+        written = False
+    return written, float(arr[0]), float(arr[-1])
+
+
+def test_shared_arrays_are_isolated_between_tasks():
+    arr = np.zeros(4 * 1024**2 // 8)    # 4 MiB
+    arr[-1] = -1
+    args = [(arr, k + 1) for k in range(4)]
+    results = list(submit_to_process_pool(_write_and_read, args=args, num_workers=2,
+                                          shared_memory_threshold=1, ordered=True))
+    assert results == [(False, 0.0, -1.0)] * 4
+    assert arr[0] == 0
+
+
+if __name__ == '__main__':
+    test_shared_arrays_are_isolated_between_tasks()
@@ -0,0 +1,18 @@
+import numpy as np
+from scipy import sparse
+
+from feabas.optimizer import CrosslinkOperator
+
+
+def test_crosslink_diagonal_with_projection():
+    rng = np.random.default_rng(0)
+    B = sparse.random(30, 40, density=0.1, random_state=1, format='csr')
+    w = rng.random(30)
+    P = sparse.random(15, 40, density=0.15, random_state=2, format='csr')
+    op = CrosslinkOperator(B, w, crosslink_lambda=0.7, projection=P,
+                           explicit=sparse.identity(15, format='csr'))
+    assert np.allclose(op.diagonal(), op.assemble().diagonal())
+
+
+if __name__ == '__main__':
+    test_crosslink_diagonal_with_projection()
@@ -0,0 +1,100 @@
+"""
+Replay image-loader cache access traces with different replacement policies
+and compare their hit rates. Traces are recorded by setting cache_trace_dir in
+the loader configurations (one key per line, see caching.CacheTraceRecorder).
+Without --trace_dir, synthetic traces of the typical access patterns are used:
+    zorder: Z-order sweep over a tile grid reading the 2x2 neighborhoods of
+        each output tile (e.g. render_whole_mesh / plan_render_series).
+    overlap: pairwise matching of the overlaps of a tile grid, row by row
+        (e.g. Stitcher.subprocess_match_list_of_overlaps).
+    mixed: alternating chunks of the above, as when matching and rendering
+        jobs share the loader settings.
+"""
+
+import argparse
+import glob
+import os
+
+import numpy as np
+
+from feabas import caching
+
+
+def replay(keys, cache_type, cache_size):
+    cache = caching.generate_cache(cache_type, maxlen=cache_size)
+    hits = 0
+    for key in keys:
+        if key in cache:
+            cache[key]
+            hits += 1
+        else:
+            cache[key] = key
+    return hits / max(1, len(keys))
+
+
+def load_trace(fname):
+    with open(fname, 'r') as f:
+        keys = [s.rstrip('\n') for s in f]
+    return keys
+
+
+def _morton_order(n):
+    yy, xx = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    code = np.zeros_like(xx)
+    for b in range(int(np.ceil(np.log2(max(n, 2))))):
+        code |= ((xx >> b) & 1) << (2*b)
+        code |= ((yy >> b) & 1) << (2*b+1)
+    idx = np.argsort(code.ravel(), kind='stable')
+    return yy.ravel()[idx], xx.ravel()[idx]
+
+
+def synthetic_trace(pattern, grid_size=40, rng=None):
+    if rng is None:
+        rng = np.random.default_rng(0)
+    keys = []
+    if pattern == 'zorder':
+        for y, x in zip(*_morton_order(grid_size)):
+            for dy, dx in ((0,0), (0,1), (1,0), (1,1)):
+                if (y+dy < grid_size) and (x+dx < grid_size):
+                    keys.append(f'tile_{y+dy}_{x+dx}')
+    elif pattern == 'overlap':
+        for y in range(grid_size):
+            for x in range(grid_size):
+                for dy, dx in ((0,1), (1,0), (1,1)):
+                    if (y+dy < grid_size) and (x+dx < grid_size):
+                        keys.append(f'tile_{y}_{x}')
+                        keys.append(f'tile_{y+dy}_{x+dx}')
+    elif pattern == 'mixed':
+        zorder = synthetic_trace('zorder', grid_size, rng)
+        overlap = synthetic_trace('overlap', grid_size, rng)
+        chunk = 4 * grid_size
+        for k in range(0, max(len(zorder), len(overlap)), chunk):
+            keys.extend(overlap[k:(k+chunk)])
+            keys.extend(zorder[k:(k+chunk)])
+    else:
+        raise ValueError(f'unknown pattern {pattern}')
+    return keys
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="compare cache replacement policies on access traces")
+    parser.add_argument("--trace_dir", metavar="trace_dir", type=str, default=None)
+    parser.add_argument("--policies", metavar="policies", type=str, nargs='+', default=['fifo', 'lru', 'lfu', 'mfu', 'arc'])
+    parser.add_argument("--cache_sizes", metavar="cache_sizes", type=int, nargs='+', default=[10, 25, 50, 150])
+    parser.add_argument("--grid_size", metavar="grid_size", type=int, default=40)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.trace_dir is not None:
+        tlist = sorted(glob.glob(os.path.join(args.trace_dir, '*.txt')))
+        traces = {os.path.basename(s): load_trace(s) for s in tlist}
+    else:
+        traces = {p: synthetic_trace(p, args.grid_size) for p in ('zorder', 'overlap', 'mixed')}
+    header = ['trace', 'accesses', 'cache_size'] + args.policies
+    print(', '.join(header))
+    for tname, keys in traces.items():
+        for cache_size in args.cache_sizes:
+            rates = [replay(keys, policy, cache_size) for policy in args.policies]
+            print(', '.join([tname, str(len(keys)), str(cache_size)] + [f'{r:.3f}' for r in rates]))